@@ -0,0 +1,49 @@
+"""Time node deletion as the repository grows.
+
+Usage: python benchmarks/bench_delete.py [sizes...]
+
+Each size builds an in-memory repository with that many papers (plus
+topics and bibtex entries) and deletes 100 papers and 5 topics. The time
+per paper deletion should stay flat as the repository grows; topics get
+more papers as the repository grows, so their time tracks their degree.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from paperapp.paper_repo import PaperRepo
+
+
+def build(size):
+    p = PaperRepo()
+    topics = [ p.new_topic(None, 'Topic %d' % (i,)) for i in range(50) ]
+    for i in range(size):
+        bibtex = p.new_bibtex(None, 'article', None, { 'title': 'Title %d' % (i,), 'author': 'Author' })
+        p.new_paper(None, 'Paper %d' % (i,), related_to=topics[i % len(topics)], bibtex=bibtex)
+    return p
+
+def bench(size, deletions=100):
+    p = build(size)
+    papers = p.get_nodes_by_type('artifact')
+    to_delete = [ papers[i * (len(papers) // deletions)] for i in range(deletions) ]
+    start = time.perf_counter()
+    for paper in to_delete:
+        p._delete_node(paper)
+    paper_time = (time.perf_counter() - start) / deletions
+
+    topics = p.get_nodes_by_type('topic')[:5]
+    start = time.perf_counter()
+    for topic in topics:
+        p._delete_node(topic)
+    topic_time = (time.perf_counter() - start) / len(topics)
+    p.verify()
+    return paper_time, topic_time
+
+if __name__ == '__main__':
+    sizes = [ int(s) for s in sys.argv[1:] ] or [ 1000, 2000, 4000, 8000 ]
+    print("%8s %16s %16s" % ('papers', 'paper (ms/del)', 'topic (ms/del)'))
+    for size in sizes:
+        paper_time, topic_time = bench(size)
+        print("%8d %16.3f %16.3f" % (size, paper_time * 1000, topic_time * 1000))
@@ -0,0 +1,53 @@
+"""Report import times for the paperapp modules, using python -X importtime.
+
+Usage: python benchmarks/bench_import.py
+
+For each statement, the cumulative import time (in ms, best of 5 runs in
+fresh interpreters) of the slowest top-level modules is listed. Optional
+dependencies (whoosh, extractors, magic, bibtexparser, jinja2) should only
+show up for the statements that need them.
+"""
+import os
+import sys
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+STATEMENTS = [
+    "import paperapp.papercli",
+    "import paperapp.paper_repo",
+    "import paperapp.paper_bibtex",
+    "import paperapp.materializer",
+    "import paperapp.search_index",
+    "from paperapp.search_index import SearchIndex; import tempfile; SearchIndex(tempfile.mkdtemp())",
+]
+
+def import_times(statement):
+    """{ top-level module: cumulative microseconds } for one run."""
+    result = subprocess.run([ sys.executable, '-X', 'importtime', '-c', statement ], cwd=ROOT,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in result.stderr.split("\n"):
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '): # top-level, not nested
+            times[name.strip()] = int(cumulative)
+    return times, result.returncode
+
+if __name__ == '__main__':
+    for statement in STATEMENTS:
+        best = {}
+        for _ in range(5):
+            times, returncode = import_times(statement)
+            if returncode != 0:
+                break
+            for name, us in times.items():
+                best[name] = min(us, best.get(name, us))
+        if returncode != 0:
+            print("%s\n    failed (missing optional dependency?)" % (statement,))
+            continue
+        total = sum(best.values())
+        print("%s\n    total %.1f ms" % (statement, total / 1000))
+        for name, us in sorted(best.items(), key=lambda t: -t[1])[:6]:
+            print("    %-30s %8.1f ms" % (name, us / 1000))
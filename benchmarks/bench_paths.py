@@ -0,0 +1,91 @@
+"""Count the stat and mkdir calls made to register files and look up their paths.
+
+Usage: python benchmarks/bench_paths.py [files]
+
+os.stat and os.mkdir are wrapped to count calls (os.path.isdir and
+os.path.exists go through os.stat). The counts are given for the current
+FileRepo and for the previous path computation, which checked and created
+the three hashed directories on every lookup.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from paperapp.file_repo import FileRepo
+
+
+def legacy_number_to_file(self, file_id):
+    file_id_as_str = str(file_id)
+    while len(file_id_as_str) < 4:
+        file_id_as_str = "0" + file_id_as_str
+
+    chars = [c for c in file_id_as_str]
+    _file = None
+    for i in range(0, 3):
+        if _file is None:
+            _file = str(chars.pop())
+        else:
+            _file = os.path.join(_file, chars.pop())
+        _dir = os.path.join(self.file_folder, _file)
+        if not os.path.isdir(_dir):
+            os.mkdir(_dir)
+
+    chars.reverse()
+
+    return os.path.join(_file, "".join(chars))
+
+class CountingOs:
+    def __init__(self):
+        self.counts = { 'stat' : 0, 'mkdir' : 0 }
+        self.originals = { name: getattr(os, name) for name in self.counts }
+
+    def __enter__(self):
+        for name, original in self.originals.items():
+            setattr(os, name, self._wrap(name, original))
+        return self
+
+    def __exit__(self, *args):
+        for name, original in self.originals.items():
+            setattr(os, name, original)
+
+    def _wrap(self, name, original):
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return original(*args, **kwargs)
+        return counted
+
+def bench(size, legacy):
+    with tempfile.TemporaryDirectory() as data_folder:
+        drop_folder = os.path.join(data_folder, 'drop')
+        file_folder = os.path.join(data_folder, 'files')
+        os.mkdir(drop_folder)
+        os.mkdir(file_folder)
+        paths = []
+        for i in range(size):
+            path = os.path.join(drop_folder, '%d.txt' % (i,))
+            with open(path, 'w') as f:
+                f.write('File %d\n' % (i,))
+            paths.append(path)
+
+        file_repo = FileRepo(file_folder)
+        if legacy:
+            file_repo._number_to_file = legacy_number_to_file.__get__(file_repo)
+            file_repo._number_to_new_file = file_repo._number_to_file
+        hashes = {}
+        with CountingOs() as register:
+            for path in paths:
+                file_repo.register_file(path, hashes)
+        with CountingOs() as lookup:
+            for i in range(size):
+                file_repo.get_absolute_path_to_file(i)
+    return register.counts, lookup.counts
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print("%8s %10s %16s %16s" % ('', 'operation', 'stat (per file)', 'mkdir (total)'))
+    for name, legacy in [ ('previous', True), ('current', False) ]:
+        register, lookup = bench(size, legacy)
+        for operation, counts in [ ('register', register), ('lookup', lookup) ]:
+            print("%8s %10s %16.2f %16d" % (name, operation, counts['stat'] / size, counts['mkdir']))
@@ -0,0 +1,48 @@
+"""Time file registration as the file repository grows.
+
+Usage: python benchmarks/bench_register.py [sizes...]
+
+Each size registers that many small distinct files into an empty file
+repository, reporting the time per file for the first and the last 500.
+With constant-time id allocation both should be about the same.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from paperapp.file_repo import FileRepo
+
+
+def bench(size, window=500):
+    with tempfile.TemporaryDirectory() as data_folder:
+        drop_folder = os.path.join(data_folder, 'drop')
+        file_folder = os.path.join(data_folder, 'files')
+        os.mkdir(drop_folder)
+        os.mkdir(file_folder)
+        paths = []
+        for i in range(size):
+            path = os.path.join(drop_folder, '%d.txt' % (i,))
+            with open(path, 'w') as f:
+                f.write('File %d\n' % (i,))
+            paths.append(path)
+
+        file_repo = FileRepo(file_folder)
+        hashes = {}
+        times = []
+        for path in paths:
+            start = time.perf_counter()
+            file_repo.register_file(path, hashes)
+            times.append(time.perf_counter() - start)
+    first = sum(times[:window]) / len(times[:window])
+    last = sum(times[-window:]) / len(times[-window:])
+    return first, last
+
+if __name__ == '__main__':
+    sizes = [ int(s) for s in sys.argv[1:] ] or [ 1000, 5000, 20000 ]
+    print("%8s %16s %16s" % ('files', 'first (ms/file)', 'last (ms/file)'))
+    for size in sizes:
+        first, last = bench(size)
+        print("%8d %16.3f %16.3f" % (size, first * 1000, last * 1000))
@@ -1,8 +1,6 @@
 import sys
 
 from paperapp.papercli import cli
-from paperapp.materializer import materialize
-from paperapp.paper_bibtex import generate_bibtex
 
 if __name__ == '__main__':
     cli()
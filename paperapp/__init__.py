@@ -1,3 +1,9 @@
 class PaperError(Exception):
     def __init__(self, msg):
         Exception.__init__(self, msg)
+
+class PaperValidationError(PaperError):
+    """All the problems found while verifying a model, in the errors list."""
+    def __init__(self, errors):
+        PaperError.__init__(self, "\n".join(errors))
+        self.errors = errors
@@ -0,0 +1,117 @@
+import json
+import os
+import yaml
+
+
+# append-only change log for a YAML model
+class ChangeJournal:
+
+    def __init__(self, path_to_journal):
+        """Sidecar log of node changes for a model saved as YAML.
+
+        Each line is a JSON record, either ``{"op": "put", "node": {...}}``
+        with the full content of a node (references to other nodes are
+        stored as ``{"@ref": id}``) or ``{"op": "del", "id": ...}``. Records
+        are idempotent, replaying them on top of a YAML file that already
+        contains them is harmless.
+        """
+        self.path = path_to_journal
+        self.pending = {} # node id -> 'put' or 'del', in order of last change
+        self.size = 0     # records on disk
+        if os.path.exists(self.path):
+            self.size = len(self.read())
+
+    def put(self, node_id):
+        self.pending.pop(node_id, None)
+        self.pending[node_id] = 'put'
+
+    def delete(self, node_id):
+        self.pending.pop(node_id, None)
+        self.pending[node_id] = 'del'
+
+    def flush(self, id_to_node):
+        """Append the pending changes to the log. Returns the number of records written."""
+        if not self.pending:
+            return 0
+        lines = []
+        for node_id, op in self.pending.items():
+            if op == 'put' and node_id in id_to_node:
+                record = { 'op' : 'put', 'node' : encode_node(id_to_node[node_id]) }
+            else:
+                record = { 'op' : 'del', 'id' : node_id }
+            lines.append(json.dumps(record, sort_keys=True) + "\n")
+        with open(self.path, 'a') as f:
+            f.write("".join(lines))
+            f.flush()
+        self.pending = {}
+        self.size += len(lines)
+        return len(lines)
+
+    def read(self):
+        """All records on disk, a truncated last line (interrupted write) is ignored."""
+        records = []
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+        return records
+
+    def clear(self):
+        """Forget all the records, called once the YAML file is up to date."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.pending = {}
+        self.size = 0
+
+
+class Ref:
+    """A reference to a node read from the journal, to be resolved once all records are applied."""
+    def __init__(self, node_id):
+        self.id = node_id
+
+def encode_node(node):
+    return { k: _encode_value(v) for k, v in node.items() }
+
+def _encode_value(v):
+    if type(v) == dict:
+        if 'id' in v:
+            return { '@ref' : v['id'] }
+        return { '@yaml' : yaml.dump(v) }
+    if type(v) == list:
+        return [ _encode_value(vv) for vv in v ]
+    if v is None or type(v) in (str, int, float, bool):
+        return v
+    return { '@yaml' : yaml.dump(v) }
+
+def decode_node(encoded):
+    return { k: _decode_value(v) for k, v in encoded.items() }
+
+def _decode_value(v):
+    if type(v) == dict:
+        if '@ref' in v:
+            return Ref(v['@ref'])
+        return yaml.load(v['@yaml'], Loader=yaml.FullLoader)
+    if type(v) == list:
+        return [ _decode_value(vv) for vv in v ]
+    return v
+
+def resolve_refs(node, id_to_node):
+    """Replace the Ref placeholders in a decoded node, dangling references are dropped."""
+    for k in list(node.keys()):
+        v = node[k]
+        if type(v) == Ref:
+            if v.id in id_to_node:
+                node[k] = id_to_node[v.id]
+            else:
+                del node[k]
+        elif type(v) == list:
+            resolved = [ id_to_node[vv.id] if type(vv) == Ref else vv
+                         for vv in v if type(vv) != Ref or vv.id in id_to_node ]
+            if resolved or not v:
+                node[k] = resolved
+            else:
+                del node[k]
@@ -21,8 +21,10 @@ def process_lines(lines, related_to=None, citing=None, file_folder='.', render=F
             for k in [ 'on-disk', 'read', 'found-in', 'found-date', 'external', 'bibtex' ]:
                   if k in current:
                         res.append("{}['{}'] = {}".format(p, k, current[k]))
+            res.append("p.touch({})".format(p))
             if ('bibtex' in current) and citing:
                   res.append("p['{}']['target'].append({})".format(citing, p))
+                  res.append("p.touch('{}')".format(citing))
             if render:
                   res.append("render_node(p,{})\n\n\n\n".format(p))
             return res
@@ -79,4 +81,5 @@ def process_lines(lines, related_to=None, citing=None, file_folder='.', render=F
         else:
             current['note'] = current.get('note', '') + "\n" + line
 
-    return res + output_current(current)
+    # one save (and one index commit) for the whole script, nothing is kept if a line fails
+    return [ "with p.batch():" ] + [ "    " + line for line in res + output_current(current) ]
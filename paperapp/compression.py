@@ -0,0 +1,55 @@
+import gzip
+import shutil
+
+# zstandard comes from the 'compression' extra, gzip is used when it is missing
+
+# formats that are stored uncompressed in practice and compress well
+COMPRESSIBLE = [
+    'application/postscript',
+    'application/msword',
+    'application/vnd.ms-excel',
+    'application/vnd.ms-powerpoint',
+    'application/xml',
+    'application/x-bibtex',
+    'text/rtf',
+]
+
+SUFFIXES = { 'zstd' : '.zst', 'gzip' : '.gz' }
+
+def compressible(mimetype):
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE
+
+def default_codec():
+    try:
+        import zstandard
+        return 'zstd'
+    except ImportError:
+        return 'gzip'
+
+def codec_for(path_to_file):
+    """The codec for a stored file, by its suffix, or None if it is not compressed."""
+    for codec, suffix in SUFFIXES.items():
+        if path_to_file.endswith(suffix):
+            return codec
+    return None
+
+def compress_file(fsrc, fdest, codec, chunk_size=1 << 20):
+    """Compress from one binary file object into another."""
+    if codec == 'zstd':
+        import zstandard
+        with zstandard.ZstdCompressor().stream_writer(fdest, closefd=False) as writer:
+            shutil.copyfileobj(fsrc, writer, chunk_size)
+    else:
+        with gzip.GzipFile(fileobj=fdest, mode='wb', mtime=0) as writer:
+            shutil.copyfileobj(fsrc, writer, chunk_size)
+
+def open_compressed(path_to_file):
+    """A binary file object with the decompressed contents, read as a stream."""
+    if codec_for(path_to_file) == 'zstd':
+        try:
+            import zstandard
+        except ImportError as e:
+            raise Exception("Reading '{}' needs the 'compression' extra (pip install paperapp_DrDub[compression]): {}".format(
+                path_to_file, e))
+        return zstandard.ZstdDecompressor().stream_reader(open(path_to_file, 'rb'), closefd=True)
+    return gzip.open(path_to_file, 'rb')
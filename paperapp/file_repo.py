@@ -1,21 +1,80 @@
+import contextlib
 import hashlib
-import shutil
+import heapq
+import io
+import json
 import datetime
 import os
+import shutil
 import stat
+import tempfile
+import threading
+
+from .pack_store  import PackStore
+from .compression import SUFFIXES, compressible, default_codec, codec_for, compress_file, open_compressed
 
-from magic import detect_from_content
+FICLONE = 0x40049409 # linux ioctl to share the extents of a file (reflink), in btrfs, xfs and others
 
 
 # file repo
 class FileRepo:
 
-    def __init__(self, path_to_file_folder):
+    CHUNK_SIZE  = 1 << 20 # bytes read at a time
+    HEADER_SIZE = 1 << 20 # bytes given to magic to detect the mimetype
+
+    ALLOCATOR_FILE = '.allocator' # next file number and free numbers, as JSON
+    MANIFEST_FILE  = '.manifest'  # number, hash, size, modification time and mimetype of the files, as JSON lines
+    PACK_FOLDER    = '.packs'     # pack files for small files, see PackStore
+    CACHE_FOLDER   = '.cache'     # decompressed copies of compressed files
+
+    # how files get into the repository, see register_file
+    STRATEGIES = [ 'copy', 'move', 'hardlink', 'reflink' ]
+
+    def __init__(self, path_to_file_folder, pack_threshold=0, compress=False):
+        """Files smaller than pack_threshold bytes are appended to pack files instead of stored each in
+        its own file, get_absolute_path_to_file extracts them when asked for. Packed files are read
+        regardless of pack_threshold.
+        With compress, files of mimetypes that compress well (text, PostScript, old Office formats) are
+        stored compressed with zstd (gzip if zstandard is not installed). open_file and read_file
+        decompress them as a stream and get_absolute_path_to_file decompresses them to a cache folder.
+        Compressed files are read regardless of compress. Files keep the hash of their original bytes."""
         if not os.path.isdir(path_to_file_folder):
             raise Exception("Folder with files repository not found: '%s'" % (path_to_file_folder,))
         self.file_folder = path_to_file_folder
+        self.pack_threshold = pack_threshold
+        self.codec = default_codec() if compress else None
+        self.packs = PackStore(os.path.join(self.file_folder, FileRepo.PACK_FOLDER))
+        self._packed = os.path.isdir(self.packs.pack_folder) # whether to look up files in the packs
+
+        # file number allocator: numbers below the high-water mark are in use unless in the free heap
+        self._next   = 0
+        self._free   = []
+        self._ids    = None # file numbers in use, built from the hashes passed to register_file
+        self._hashes = None # the hashes the id set was built from
+        self._known_dirs = set() # hashed directories known to exist, relative to the file folder
+        self._manifest = None # file number -> entry, read when first needed
+        self._linked = {} # processed source -> stored file sharing its inode, see finish_processed
+        self._unfinished = [] # manifest records of the files stored with a processed list, idem
+        self._copies = {} # thread -> copies made in its temporary_copies block
+        allocator_file = os.path.join(self.file_folder, FileRepo.ALLOCATOR_FILE)
+        if os.path.exists(allocator_file):
+            try:
+                with open(allocator_file) as f:
+                    saved = json.load(f)
+                self._next = saved['next']
+                self._free = saved['free']
+                heapq.heapify(self._free)
+            except (ValueError, KeyError, TypeError) as e:
+                print("Ignoring allocator {}: {}".format(allocator_file, e))
+
+    def __getstate__(self):
+        # worker processes only stage files, they do not need the allocator
+        state = dict(self.__dict__)
+        state.update({ '_free' : [], '_ids' : None, '_hashes' : None, '_known_dirs' : set(), '_manifest' : None,
+                       '_linked' : {}, '_unfinished' : [], '_copies' : {} })
+        return state
 
-    def register_file(self, path_to_file, hashes):
+    def register_file(self, path_to_file, hashes, strategy='copy', processed=None):
         """
         Register a file and returns a dictionary with the following keys:
            type: file
@@ -23,33 +82,155 @@ class FileRepo:
            date: current date in format yyyy/mm/dd
            text: original file name
         (if the file already exists, only the id is returned, not a dictionary)
-        A copy of the file is placed inside the repository.
-        The original file is left intact.
+        The file is placed inside the repository according to strategy:
+           copy: the file is copied, the original file is left intact.
+           move: the file is renamed into the repository (copied and deleted if it is in another device).
+                 If a processed list is given, the file is hardlinked instead and its path appended to it,
+                 the caller then deletes it with finish_processed. Until then, the file keeps its
+                 permissions (the stored file is made read-only once the source is gone).
+        With a processed list, whatever the strategy, the file is only added to the manifest by
+        finish_processed, so until then fsck takes it for an orphan.
+           hardlink: the file is hardlinked if it is already read-only, as both names share the
+                 permissions and the contents; otherwise (or if links are not possible) it is copied.
+           reflink: the file is cloned sharing its blocks, in filesystems that support it (copied otherwise).
         This method computes the MD5 hash for file so it won't store duplicates.
-        If the file already exists, its ID is returned.
+        If the file already exists, its ID is returned and the original file is left intact.
+        The file is read once, in chunks, to hash it (and copy it).
+        """
+        return self.store_file(self.stage_file(path_to_file, strategy), hashes, strategy, processed)
+
+    def stage_file(self, path_to_file, strategy='copy'):
         """
-        analysis = self._analyze_file(path_to_file)
+        First half of register_file: hash the file (and copy it for the copy strategy) without changing
+        the repository, so it can be done outside of any lock. The result is passed to store_file, or to
+        discard_staged if the file is not to be registered after all.
+        """
+        if strategy not in FileRepo.STRATEGIES:
+            raise Exception("Unknown strategy '%s', expected one of %s" % (strategy, ", ".join(FileRepo.STRATEGIES)))
+        return self._stage_file(path_to_file, strategy)
+
+    def store_file(self, staged, hashes, strategy='copy', processed=None):
+        """Second half of register_file: allocate an id for a staged file and put it in place."""
+        result = self._store_file(staged, hashes, strategy, processed)
+        self._save_allocator()
+        return result
+
+    def discard_staged(self, staged):
+        """Delete the temporary copy of a staged file that was not stored."""
+        incoming = staged.get('incoming')
+        if incoming is not None and os.path.exists(incoming):
+            os.unlink(incoming)
+
+    def _stage_file(self, path_to_file, strategy='copy'):
+        """Analyze a file and, for the copy strategy, copy it to a temporary file inside the repository,
+        whose path is returned in the analysis under 'incoming'. Files to compress are compressed there
+        instead, for any strategy, and the codec returned under 'codec'. The path to the file is returned
+        under 'source'. It does not change the repository, so it can run in a worker process.
+        """
+        if strategy != 'copy' or self._to_pack(path_to_file) or self.codec is not None:
+            analysis = self._analyze_file(path_to_file)
+            analysis['source'] = path_to_file
+            if self.codec is not None and compressible(analysis['mimetype']) and not self._to_pack(path_to_file):
+                fd, incoming = tempfile.mkstemp(prefix='.incoming-', dir=self.file_folder)
+                try:
+                    with open(path_to_file, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdest:
+                        compress_file(fsrc, fdest, self.codec, self.CHUNK_SIZE)
+                except BaseException:
+                    os.unlink(incoming)
+                    raise
+                analysis['incoming'] = incoming
+                analysis['codec'] = self.codec
+            return analysis
+        fd, incoming = tempfile.mkstemp(prefix='.incoming-', dir=self.file_folder)
+        try:
+            with os.fdopen(fd, 'wb') as copy_to:
+                analysis = self._analyze_file(path_to_file, copy_to)
+        except BaseException:
+            os.unlink(incoming)
+            raise
+        analysis['source'] = path_to_file
+        analysis['incoming'] = incoming
+        return analysis
+
+    def _stage_files(self, paths, jobs, strategy='copy'):
+        """Run _stage_file over several files in a pool of jobs processes, returns the analyses in order."""
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [ executor.submit(self._stage_file, path_to_file, strategy) for path_to_file in paths ]
+        staged = []
+        errors = []
+        for future in futures:
+            try:
+                staged.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            for analysis in staged:
+                if 'incoming' in analysis:
+                    os.unlink(analysis['incoming'])
+            raise errors[0]
+        return staged
+
+    def _store_file(self, analysis, hashes, strategy='copy', processed=None):
+        """Allocate an id for a file staged by _stage_file and put it in place (or drop it if it is a duplicate)."""
+        incoming = analysis.pop('incoming', None)
+        source   = analysis.pop('source')
+        codec    = analysis.pop('codec', None)
         md5hash  = analysis['md5hash']
         existing = hashes.get(md5hash)
         if existing:
+            if incoming is not None:
+                os.unlink(incoming)
             return { 'id' : existing }
 
-        inv_hashes = { t[1]: t[0] for t in hashes.items() }
-
-        new_id = 0
+        new_id  = self._allocate(hashes)
         file_id = 'file-%d' % (new_id,)
-        while file_id in inv_hashes:
-            new_id += 1
-            file_id = 'file-%d' % (new_id,)
 
-        # copy it
-        dest_file = os.path.join(self.file_folder, self._number_to_file(new_id))
-        shutil.copy(path_to_file, dest_file)
-        hashes[md5hash] = file_id
+        if incoming is None and self._to_pack(source):
+            try:
+                self.packs.add(new_id, source)
+            except BaseException:
+                self._release(new_id)
+                raise
+            self._packed = True
+            hashes[md5hash] = file_id
+            if strategy == 'move':
+                if processed is None:
+                    os.unlink(source)
+                else:
+                    processed.append(source)
+            self._manifest_put(new_id, md5hash, self.packs.size(new_id), 0, analysis['mimetype'], None,
+                               deferred=processed is not None)
+        else:
+            dest_file = os.path.join(self.file_folder, self._number_to_new_file(new_id))
+            if codec is not None:
+                dest_file += SUFFIXES[codec]
+            try:
+                if incoming is not None:
+                    os.replace(incoming, dest_file)
+                    linked = False
+                else:
+                    linked = self._place_file(source, dest_file, strategy, processed)
+            except BaseException:
+                self._release(new_id)
+                raise
+            hashes[md5hash] = file_id
+            if codec is not None and strategy == 'move':
+                if processed is None:
+                    os.unlink(source)
+                else:
+                    processed.append(source)
+
+            if linked and strategy == 'move':
+                # the source is still there and shares the inode, it is made read-only once deleted
+                self._linked[source] = dest_file
+            else:
+                os.chmod(dest_file, stat.S_IREAD|stat.S_IRGRP|stat.S_IROTH)
+            file_stat = os.stat(dest_file)
+            self._manifest_put(new_id, md5hash, file_stat.st_size, file_stat.st_mtime_ns, analysis['mimetype'], codec,
+                               deferred=processed is not None)
 
-        # set read-only
-        os.chmod(dest_file, stat.S_IREAD|stat.S_IRGRP|stat.S_IROTH)
-        
         now = datetime.datetime.now()
         result = analysis
         analysis.update({
@@ -60,41 +241,154 @@ class FileRepo:
             })
         return result
 
-    def process_folder(self, path_to_folder, hashes):
+    def _to_pack(self, path_to_file):
+        return self.pack_threshold > 0 and os.path.getsize(path_to_file) < self.pack_threshold
+
+    def _place_file(self, source, dest_file, strategy, processed):
+        """Put a file in the repository with the given strategy, falling back to copying it. Returns
+        whether the stored file is a hardlink to the source."""
+        if strategy == 'move' and processed is None:
+            try:
+                os.rename(source, dest_file)
+            except OSError: # another device
+                self._copy_file(source, dest_file)
+                os.unlink(source)
+            return False
+        linked = False
+        if strategy == 'move' or (strategy == 'hardlink' and os.stat(source).st_mode & 0o222 == 0):
+            try:
+                os.link(source, dest_file)
+                linked = True
+            except OSError: # another device, links not supported or stale file in the way
+                pass
+        if not linked:
+            self._copy_file(source, dest_file, clone=(strategy == 'reflink'))
+        if strategy == 'move':
+            processed.append(source)
+        return linked
+
+    def finish_processed(self, processed, unlink=True):
+        """Add the files stored with a processed list to the manifest, delete the files in the list
+        (see register_file) and make the stored files they were hardlinked to read-only. With unlink
+        set to False the files are kept and the manifest left alone, for when the stored files were
+        deleted instead (a batch rolled back)."""
+        if unlink and self._unfinished:
+            self._manifest_append(self._unfinished)
+        self._unfinished = []
+        for path_to_file in processed:
+            dest_file = self._linked.pop(path_to_file, None)
+            if unlink:
+                os.unlink(path_to_file)
+                if dest_file is not None and os.path.exists(dest_file):
+                    os.chmod(dest_file, stat.S_IREAD|stat.S_IRGRP|stat.S_IROTH)
+
+    def _copy_file(self, source, dest_file, clone=False):
+        """Copy through a temporary file. If clone, try first to share the blocks of the source (FICLONE)
+        or to have the kernel copy them (copy_file_range, which some filesystems also turn into a clone)."""
+        fd, incoming = tempfile.mkstemp(prefix='.incoming-', dir=self.file_folder)
+        try:
+            with open(source, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdest:
+                if not (clone and self._clone_file(fsrc, fdest)):
+                    shutil.copyfileobj(fsrc, fdest, self.CHUNK_SIZE)
+            os.replace(incoming, dest_file)
+        except BaseException:
+            if os.path.exists(incoming):
+                os.unlink(incoming)
+            raise
+
+    def _clone_file(self, fsrc, fdest):
+        """Returns False if neither FICLONE nor copy_file_range worked, the files are then left as they were."""
+        try:
+            import fcntl
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except (ImportError, OSError):
+            pass
+        if not hasattr(os, 'copy_file_range'):
+            return False
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                count = os.copy_file_range(fsrc.fileno(), fdest.fileno(), size - copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            pass
+        if copied == size:
+            return True
+        fsrc.seek(0)
+        fdest.seek(0)
+        fdest.truncate()
+        return False
+
+    def process_folder(self, path_to_folder, hashes, processed=None, jobs=1, strategy='move'):
         """
         All files in folder are registered and a list of dictionaries as returned by register_file is returned.
-        The files are deleted after registration.
+        The files are deleted after registration, unless a processed list is given. In that case, their
+        paths are appended to it and the caller deletes them with finish_processed.
+        By default, the files are moved into the repository: renamed when in the same device (copied
+        otherwise) or, if a processed list is given, hardlinked and left writable until finish_processed.
+        See register_file for the other strategies.
+        With jobs > 1, the files are hashed and analyzed (and copied) by that many worker processes, ids are
+        still allocated in order by this process.
         """
         # only process files in the folder, no subfolders
         _, _, files = next(os.walk(path_to_folder))
+        paths = [ os.path.join(path_to_folder, _file) for _file in files ]
+        return self.process_files(paths, hashes, processed=processed, jobs=jobs, strategy=strategy)
+
+    def process_files(self, paths, hashes, processed=None, jobs=1, strategy='move'):
+        """As process_folder, for a list of paths to files."""
+        if strategy not in FileRepo.STRATEGIES:
+            raise Exception("Unknown strategy '%s', expected one of %s" % (strategy, ", ".join(FileRepo.STRATEGIES)))
+
+        if jobs > 1 and len(paths) > 1:
+            staged = self._stage_files(paths, jobs, strategy)
+        else:
+            staged = None
 
         result = []
-        for _file in files:
-            _full_file = os.path.join(path_to_folder, _file)
-            result.append(self.register_file(_full_file, hashes))
-            os.unlink(_full_file)
+        try:
+            for idx, _full_file in enumerate(paths):
+                if staged is None:
+                    stored = self._store_file(self._stage_file(_full_file, strategy), hashes, strategy, processed)
+                else:
+                    stored = self._store_file(staged[idx], hashes, strategy, processed)
+                result.append(stored)
+                if strategy == 'move' and len(stored) > 1:
+                    pass # already taken care of
+                elif processed is None:
+                    os.unlink(_full_file)
+                else:
+                    processed.append(_full_file)
+        finally:
+            if staged is not None:
+                for analysis in staged[len(result):]:
+                    if 'incoming' in analysis:
+                        os.unlink(analysis['incoming'])
+            self._save_allocator()
 
         return result
 
     def _number_to_file(self, file_id):
+        """Path of a file number relative to the file folder: the digits in reverse, the first three are
+        directories and the rest the file name (file 12345 is 5/4/3/21). No disk access."""
         file_id_as_str = str(file_id)
         while len(file_id_as_str) < 4:
             file_id_as_str = "0" + file_id_as_str
 
-        chars = [c for c in file_id_as_str]
-        _file = None
-        for i in range(0, 3):
-            if _file is None:
-                _file = str(chars.pop())
-            else:
-                _file = os.path.join(_file, chars.pop())
-            _dir = os.path.join(self.file_folder, _file)
-            if not os.path.isdir(_dir):
-                os.mkdir(_dir)
+        return os.path.join(file_id_as_str[-1], file_id_as_str[-2], file_id_as_str[-3], file_id_as_str[-4::-1])
 
-        chars.reverse()
-        
-        return os.path.join(_file, "".join(chars))
+    def _number_to_new_file(self, file_id):
+        """As _number_to_file, creating its directories if needed."""
+        _file = self._number_to_file(file_id)
+        _dir = os.path.dirname(_file)
+        if _dir not in self._known_dirs:
+            os.makedirs(os.path.join(self.file_folder, _dir), exist_ok=True)
+            self._known_dirs.add(_dir)
+        return _file
 
     def _number_from_id(self, file_id):
         FILE = 'file-'
@@ -110,18 +404,107 @@ class FileRepo:
         """
         Get an absolute path to a given file.
         This method also verifies the actual entry exists.
+        Packed and compressed files are extracted the first time their path is asked for, the copies
+        are kept until clear_cache, or until the end of a temporary_copies block.
         """
         if type(file_id_or_number) is int:
             file_number = file_id_or_number
         else:
             file_number = self._number_from_id(file_id_or_number)
-        file_path = os.path.join(self.file_folder, self._number_to_file(file_number))
+        made = self._copies.get(threading.get_ident())
+        if self._packed and file_number in self.packs:
+            return self.packs.extract(file_number, made)
+        file_path = self._stored_file(file_number)
 
-        if not os.path.exists(file_path):
+        if file_path is None:
             raise Exception("File not found '%d'" % (file_number,))
 
+        if codec_for(file_path) is not None:
+            return self._decompressed_file(file_number, file_path, made)
         return file_path
 
+    def stored_path(self, file_id_or_number):
+        """Path to a given file as stored, None if it is packed or compressed (see open_file)."""
+        if type(file_id_or_number) is int:
+            file_number = file_id_or_number
+        else:
+            file_number = self._number_from_id(file_id_or_number)
+        if self._packed and file_number in self.packs:
+            return None
+        file_path = self._stored_file(file_number)
+        if file_path is None:
+            raise Exception("File not found '%d'" % (file_number,))
+        return file_path if codec_for(file_path) is None else None
+
+    @contextlib.contextmanager
+    def temporary_copies(self):
+        """Delete the copies of packed and compressed files made by get_absolute_path_to_file in
+        this thread when the with block ends, for reading each file once (such as when indexing).
+        Copies made before the block are kept. Nested blocks delete when the outermost one ends."""
+        ident = threading.get_ident()
+        if ident in self._copies:
+            yield
+            return
+        self._copies[ident] = []
+        try:
+            yield
+        finally:
+            for path in self._copies.pop(ident):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def _stored_file(self, file_number):
+        """Path to the file as stored (maybe compressed), None if there is no such file."""
+        file_path = os.path.join(self.file_folder, self._number_to_file(file_number))
+        if os.path.exists(file_path):
+            return file_path
+        for suffix in SUFFIXES.values():
+            if os.path.exists(file_path + suffix):
+                return file_path + suffix
+        return None
+
+    def _decompressed_file(self, file_number, file_path, made=None):
+        """Path to a read-only decompressed copy of a compressed file, made the first time it is asked for.
+        If made is given, the path is appended to it when the copy is made."""
+        path = os.path.join(self.file_folder, FileRepo.CACHE_FOLDER, str(file_number))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path))
+            with open_compressed(file_path) as fsrc, os.fdopen(fd, 'wb') as fdest:
+                shutil.copyfileobj(fsrc, fdest, self.CHUNK_SIZE)
+            os.chmod(tmp_file, stat.S_IREAD|stat.S_IRGRP|stat.S_IROTH)
+            os.replace(tmp_file, path)
+            if made is not None:
+                made.append(path)
+        return path
+
+    def clear_cache(self):
+        """Delete the decompressed and extracted copies made by get_absolute_path_to_file."""
+        for folder in [ os.path.join(self.file_folder, FileRepo.CACHE_FOLDER),
+                        os.path.join(self.packs.pack_folder, self.packs.EXTRACTED_FOLDER) ]:
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
+
+    def open_file(self, file_id_or_number):
+        """A binary file object to read a given file, compressed files are decompressed as it is read."""
+        if type(file_id_or_number) is int:
+            file_number = file_id_or_number
+        else:
+            file_number = self._number_from_id(file_id_or_number)
+        if self._packed and file_number in self.packs:
+            return io.BytesIO(self.packs.read(file_number))
+        file_path = self._stored_file(file_number)
+        if file_path is None:
+            raise Exception("File not found '%d'" % (file_number,))
+        if codec_for(file_path) is not None:
+            return open_compressed(file_path)
+        return open(file_path, 'rb')
+
+    def read_file(self, file_id_or_number):
+        """The contents of a given file, as bytes. Packed and compressed files are read without extracting them."""
+        with self.open_file(file_id_or_number) as f:
+            return f.read()
+
     def delete_file(self, file_id_or_number):
         """
         Delete a file_id. This method throws an exception if the file does not exist.
@@ -131,8 +514,239 @@ class FileRepo:
         else:
             file_number = self._number_from_id(file_id_or_number)
 
-        os.unlink(os.path.join(self.file_folder, self._number_to_file(file_id)))
+        if self._packed and file_number in self.packs:
+            self.packs.delete(file_number)
+        else:
+            file_path = self._stored_file(file_number)
+            if file_path is None:
+                raise Exception("File not found '%d'" % (file_number,))
+            os.unlink(file_path)
+            decompressed = os.path.join(self.file_folder, FileRepo.CACHE_FOLDER, str(file_number))
+            if codec_for(file_path) is not None and os.path.exists(decompressed):
+                os.unlink(decompressed)
+        self._release(file_number)
+        self._save_allocator()
+        self._manifest_append([ { 'number' : file_number, 'deleted' : True } ])
         return file_number
+
+    def manifest(self):
+        """The manifest, a dictionary from file number to a dictionary with the md5hash, size, mtime
+        (in nanoseconds) and mimetype of the file when registered or last checked by fsck."""
+        if self._manifest is None:
+            self._manifest = {}
+            manifest_file = os.path.join(self.file_folder, FileRepo.MANIFEST_FILE)
+            if os.path.exists(manifest_file):
+                with open(manifest_file) as f:
+                    for line in f:
+                        if not line.endswith("\n"):
+                            break # interrupted write
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break
+                        number = record.pop('number')
+                        if record.get('deleted'):
+                            self._manifest.pop(number, None)
+                        else:
+                            self._manifest[number] = record
+        return self._manifest
+
+    def _manifest_put(self, number, md5hash, size, mtime, mimetype, codec, deferred=False):
+        """Size and mtime are those of the stored file, mtime is 0 for packed files. If deferred,
+        the record is kept until finish_processed."""
+        record = { 'number' : number, 'md5hash' : md5hash, 'size' : size, 'mtime' : mtime, 'mimetype' : mimetype }
+        if codec is not None:
+            record['codec'] = codec
+        if deferred:
+            self._unfinished.append(record)
+        else:
+            self._manifest_append([ record ])
+
+    def _manifest_append(self, records):
+        """Registering and deleting only append to the manifest, it is rewritten by fsck."""
+        with open(os.path.join(self.file_folder, FileRepo.MANIFEST_FILE), 'a') as f:
+            f.write("".join(json.dumps(record, sort_keys=True) + "\n" for record in records))
+        if self._manifest is not None:
+            for record in records:
+                record = dict(record)
+                number = record.pop('number')
+                if record.get('deleted'):
+                    self._manifest.pop(number, None)
+                else:
+                    self._manifest[number] = record
+
+    def _save_manifest(self):
+        manifest_file = os.path.join(self.file_folder, FileRepo.MANIFEST_FILE)
+        tmp_file = manifest_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            for number in sorted(self._manifest):
+                record = dict(self._manifest[number])
+                record['number'] = number
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+        os.replace(tmp_file, manifest_file)
+
+    def fsck(self, expected=None, quick=False, jobs=1):
+        """
+        Check the files on disk against expected, a dictionary from file number to file node (with its
+        md5hash and mimetype), usually from the model. Without expected, the files registered are
+        those in the manifest.
+        Returns a dictionary with lists of:
+           missing: numbers of registered files not on disk
+           corrupt: numbers of files whose contents do not match their hash (in the manifest or in expected)
+           orphan:  paths (relative to the file folder) of files on disk not registered
+        and the number of files 'checked' (hashed) and 'skipped'. With quick, files whose size and
+        modification time match the manifest are skipped. With jobs > 1, that many worker processes
+        hash the files. The manifest is then rewritten with the registered files: expected files
+        missing from it are added if they match and, with expected, the others are dropped.
+        """
+        manifest = self.manifest()
+        if expected is None:
+            registered = set(manifest)
+            expected = {}
+        else:
+            registered = set(expected)
+            for number in set(manifest) - registered:
+                del manifest[number]
+
+        on_disk = {} # number -> path, or None for packed files
+        orphan = []
+        for dirpath, dirnames, filenames in os.walk(self.file_folder):
+            rel_dir = os.path.relpath(dirpath, self.file_folder)
+            if rel_dir == '.':
+                for folder in [ FileRepo.PACK_FOLDER, FileRepo.CACHE_FOLDER ]:
+                    if folder in dirnames:
+                        dirnames.remove(folder)
+            for filename in filenames:
+                rel_file = os.path.normpath(os.path.join(rel_dir, filename))
+                if rel_dir == '.' and filename in [ FileRepo.ALLOCATOR_FILE, FileRepo.MANIFEST_FILE ]:
+                    continue
+                number = self._file_to_number(rel_file)
+                if number is None or number not in registered:
+                    orphan.append(rel_file)
+                else:
+                    on_disk[number] = os.path.join(self.file_folder, rel_file)
+        if self._packed:
+            for number in self.packs.index():
+                if number in registered:
+                    on_disk[number] = None
+                else:
+                    orphan.append("{}:{}".format(FileRepo.PACK_FOLDER, number))
+
+        missing = sorted(number for number in registered if number not in on_disk)
+
+        to_check = []
+        skipped = 0
+        for number in sorted(on_disk):
+            entry = manifest.get(number)
+            if quick and entry is not None:
+                if on_disk[number] is None:
+                    size, mtime = self.packs.size(number), 0
+                else:
+                    file_stat = os.stat(on_disk[number])
+                    size, mtime = file_stat.st_size, file_stat.st_mtime_ns
+                if entry['size'] == size and entry['mtime'] == mtime:
+                    skipped += 1
+                    continue
+            to_check.append(number)
+
+        paths = [ on_disk[number] for number in to_check ]
+        if jobs > 1 and len(paths) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                checked = list(executor.map(self._hash_file, paths, to_check, chunksize=16))
+        else:
+            checked = [ self._hash_file(path, number) for path, number in zip(paths, to_check) ]
+
+        corrupt = []
+        for number, (md5hash, size, mtime) in zip(to_check, checked):
+            entry = manifest.get(number)
+            node = expected.get(number)
+            recorded = set()
+            if entry is not None:
+                recorded.add(entry['md5hash'])
+            if node is not None and 'md5hash' in node:
+                recorded.add(node['md5hash'])
+            if recorded and recorded != set([ md5hash ]):
+                corrupt.append(number)
+                continue
+            manifest[number] = { 'md5hash' : md5hash, 'size' : size, 'mtime' : mtime,
+                                 'mimetype' : entry['mimetype'] if entry is not None else node.get('mimetype') }
+            if on_disk[number] is not None and codec_for(on_disk[number]) is not None:
+                manifest[number]['codec'] = codec_for(on_disk[number])
+        self._save_manifest()
+
+        return { 'missing' : missing, 'corrupt' : corrupt, 'orphan' : sorted(orphan),
+                 'checked' : len(to_check), 'skipped' : skipped }
+
+    def _hash_file(self, path_to_file, number):
+        """MD5 hash, size and modification time of a file, or of a packed file if path_to_file is None."""
+        if path_to_file is None:
+            content = self.packs.read(number)
+            return hashlib.md5(content).hexdigest(), len(content), 0
+        file_stat = os.stat(path_to_file)
+        md5 = hashlib.md5()
+        with (open_compressed(path_to_file) if codec_for(path_to_file) else open(path_to_file, 'rb')) as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                md5.update(chunk)
+        return md5.hexdigest(), file_stat.st_size, file_stat.st_mtime_ns
+
+    def _file_to_number(self, rel_file):
+        """Inverse of _number_to_file (compressed files included), None if the path is not in the layout."""
+        codec = codec_for(rel_file)
+        if codec is not None:
+            rel_file = rel_file[:-len(SUFFIXES[codec])]
+        parts = rel_file.split(os.sep)
+        if len(parts) != 4 or not all(part.isdigit() for part in parts):
+            return None
+        if any(len(part) != 1 for part in parts[:3]):
+            return None
+        number = int(parts[3][::-1] + parts[2] + parts[1] + parts[0])
+        if self._number_to_file(number) != rel_file:
+            return None
+        return number
+
+    def _allocate(self, hashes):
+        """The lowest free file number, marked as in use."""
+        if self._hashes is not hashes:
+            self._sync_ids(hashes)
+        while self._free:
+            number = heapq.heappop(self._free)
+            if number not in self._ids and number < self._next:
+                break
+        else:
+            number = self._next
+            self._next += 1
+        self._ids.add(number)
+        return number
+
+    def _release(self, number):
+        if self._ids is not None:
+            self._ids.discard(number)
+        if number < self._next:
+            heapq.heappush(self._free, number)
+
+    def _sync_ids(self, hashes):
+        """Rebuild the set of numbers in use from the hashes of the registered files, done once for a given
+        hashes dictionary. Numbers below the high-water mark not in use and not in the free heap (repositories
+        without allocator) are added to it.
+        """
+        self._ids = set(self._number_from_id(file_id) for file_id in hashes.values())
+        if self._ids:
+            self._next = max(self._next, max(self._ids) + 1)
+        free = set(self._free)
+        if len(free) + len(self._ids) < self._next:
+            free.update(number for number in range(self._next) if number not in self._ids)
+        self._free = [ number for number in free if number not in self._ids ]
+        heapq.heapify(self._free)
+        self._hashes = hashes
+
+    def _save_allocator(self):
+        allocator_file = os.path.join(self.file_folder, FileRepo.ALLOCATOR_FILE)
+        tmp_file = allocator_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({ 'next' : self._next, 'free' : sorted(set(self._free)) }, f)
+        os.replace(tmp_file, allocator_file)
         
     def analyze_file(self, file_id_or_number):
         """Recalculates the hash and mimetype for a file in the repo.
@@ -142,17 +756,28 @@ class FileRepo:
         else:
             file_number = self._number_from_id(file_id_or_number)
 
-        path_to_file = os.path.join(self.file_folder, self._number_to_file(file_number))
-        result = self._analyze_file(path_to_file)
+        result = self._analyze_file(self.get_absolute_path_to_file(file_number))
         result.update({
             'number' : file_number
             })
         return result
                      
-    def _analyze_file(self, path_to_file):
-        content   = open(path_to_file, 'rb').read()
-        md5hash   = hashlib.md5(content).hexdigest()
-        magic     = detect_from_content(content)
+    def _analyze_file(self, path_to_file, copy_to=None):
+        """Hash and detect the mimetype of a file, reading it in chunks so memory use does not depend on
+        its size. If copy_to (a binary file object) is given, the file is also copied there."""
+        from magic import detect_from_content # slow to import, only needed here
+
+        md5    = hashlib.md5()
+        header = b''
+        with open(path_to_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                md5.update(chunk)
+                if len(header) < self.HEADER_SIZE:
+                    header += chunk[:self.HEADER_SIZE - len(header)]
+                if copy_to is not None:
+                    copy_to.write(chunk)
+        md5hash   = md5.hexdigest()
+        magic     = detect_from_content(header)
         filetype  = magic.mime_type
         orig_name = os.path.basename(path_to_file)
         _, orig_ext  = os.path.splitext(orig_name)
@@ -0,0 +1,181 @@
+import os
+import select
+import time
+
+from . import PaperError
+
+
+# names of files still being written by browsers and editors
+PARTIAL_SUFFIXES = ( '.part', '.crdownload', '.download', '.tmp', '~' )
+
+
+class Inotify:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_NONBLOCK    = 0x00000800
+    IN_CLOEXEC     = 0x00080000
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        """Linux inotify through ctypes, raises OSError where it is not available."""
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify not available")
+        self.fd = self.libc.inotify_init1(Inotify.IN_NONBLOCK | Inotify.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+
+    def watch(self, path_to_folder):
+        if path_to_folder in self.watched:
+            return
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path_to_folder), Inotify.MASK) >= 0:
+            self.watched.add(path_to_folder)
+
+    def wait(self, timeout):
+        """Block until there are events or timeout seconds pass. The events are discarded, the
+        watcher rescans the folder after waking up."""
+        ready, _, _ = select.select([ self.fd ], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+
+    def __init__(self, paper, inbox, settle=2.0, interval=5.0, jobs=1, strategy='move', polling=False):
+        """Ingest the files that land in an inbox folder (and its subfolders) into a paper repository.
+
+        A file is ingested once its size and modification time have not changed for settle
+        seconds; hidden files and names of downloads in progress are left alone. The files ready
+        at a given time are registered together with PaperRepo.process_files, as a single batch
+        with one index commit. The repository saves itself before deleting the ingested files,
+        so killing the watcher leaves them in the inbox to ingest again. The copies already
+        stored in the file repository then stay there, and fsck reports them as orphans.
+
+        Changes are noticed with inotify when available, otherwise (or with polling) the inbox
+        is scanned every interval seconds.
+        """
+        if not os.path.isdir(inbox):
+            raise PaperError("Folder '%s' not found" % (inbox,))
+        if not paper.file_repo:
+            raise PaperError("File repository not defined.")
+        self.paper = paper
+        self.inbox = inbox
+        self.settle = settle
+        self.interval = interval
+        self.jobs = jobs
+        self.strategy = strategy
+        self.pending = {} # path -> ((size, mtime), time it was last seen changing)
+        self.failed = {}  # path -> (size, mtime) when it failed, retried if it changes
+        self.inotify = None
+        if not polling:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                print("Using polling, inotify not available: {}".format(e))
+
+    def run(self, cycles=None):
+        """Watch until interrupted, or for a number of cycles."""
+        cycle = 0
+        while True:
+            ready = self.scan()
+            if ready:
+                self.ingest(ready)
+            cycle += 1
+            if cycles is not None and cycle >= cycles:
+                break
+            self.wait()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def wait(self):
+        timeout = self.settle / 2 if self.pending else self.interval
+        if self.inotify is not None:
+            if not self.pending:
+                timeout = None # only wake up with events
+            self.inotify.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    def scan(self, now=None):
+        """Returns the files whose size and modification time have been stable for settle seconds."""
+        if now is None:
+            now = time.time()
+        ready = []
+        seen = set()
+        walked = set()
+        for dirpath, dirnames, filenames in os.walk(self.inbox):
+            dirnames[:] = [ dirname for dirname in dirnames if not dirname.startswith('.') ]
+            walked.add(dirpath)
+            if self.inotify is not None:
+                self.inotify.watch(dirpath)
+            for filename in filenames:
+                if filename.startswith('.') or filename.endswith(PARTIAL_SUFFIXES):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    file_stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                key = (file_stat.st_size, file_stat.st_mtime_ns)
+                seen.add(path)
+                if self.failed.get(path) == key:
+                    continue
+                if path in self.pending and self.pending[path][0] == key:
+                    if now - self.pending[path][1] >= self.settle:
+                        ready.append(path)
+                else:
+                    self.pending[path] = (key, now)
+        for path in list(self.pending):
+            if path not in seen:
+                del self.pending[path]
+        for path in list(self.failed):
+            if path not in seen:
+                del self.failed[path]
+        if self.inotify is not None:
+            self.inotify.watched &= walked # the kernel drops the watches of deleted folders
+        return sorted(ready)
+
+    def ingest(self, paths):
+        """Register the files in one batch. If that fails, they are registered one by one and the
+        ones that fail are skipped until they change."""
+        for path in paths:
+            del self.pending[path]
+        try:
+            nodes = self.paper.process_files(paths, jobs=self.jobs, strategy=self.strategy)
+            for path, node in zip(paths, nodes):
+                print("{} -> {}".format(path, node['id']))
+            return nodes
+        except Exception as e:
+            print("Batch of {} files failed ({}), registering them one by one".format(len(paths), e))
+        nodes = []
+        for path in paths:
+            try:
+                node = self.paper.process_files([ path ], strategy=self.strategy)[0]
+                print("{} -> {}".format(path, node['id']))
+                nodes.append(node)
+            except Exception as e:
+                print("Cannot register {}: {}".format(path, e))
+                try:
+                    file_stat = os.stat(path)
+                    self.failed[path] = (file_stat.st_size, file_stat.st_mtime_ns)
+                except OSError:
+                    pass
+        return nodes
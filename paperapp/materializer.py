@@ -1,6 +1,7 @@
 import os
 import re
 import codecs
+import shutil
 import yaml
 import mimetypes
 
@@ -66,16 +67,8 @@ def node_data(p, node, target=None, files_to_url=None):
         data.append(entry)
 
     backlinks={} # key, set(target)
-    for other in p.repo:
-        for k,v in other.items():
-            if not k in backlinks:
-                backlinks[k] = set()
-            if type(v) == list:
-                for vv in v:
-                    if type(vv) == dict and 'id' in vv and vv['id'] == node['id']:
-                        backlinks[k].add(other['id'])
-            elif type(v) == dict and 'id' in v and v['id'] == node['id']:
-                backlinks[k].add(other['id'])
+    for other_id, k in p.backlinks(node):
+        backlinks.setdefault(k, set()).add(other_id)
     backlinks_entries = list()
     for k in sorted(backlinks.keys()):
         v = backlinks[k]
@@ -96,39 +89,12 @@ def node_data(p, node, target=None, files_to_url=None):
 
     # transitive closure for topic backlinks
     if node['type'] == 'topic':
-        # compute descendants
-        children = dict()
-        for topic in p.get_nodes_by_type("topic"):
-            children[topic['id']] = set([])
-        for topic in p.get_nodes_by_type("topic"):
-            if 'related-to' in topic:
-                if type(topic['related-to']) == str:
-                    children[topic['related-to']].add(topic['id'])
-                elif type(topic['related-to']) == list:
-                    for t in topic['related-to']:
-                        children[t['related-to']['id']].add(topic['id'])
-                else:
-                    children[topic['related-to']['id']].add(topic['id'])
-        prev_len = 0
-        closure = children[ node['id'] ]
-        while len(closure) > prev_len:
-            prev_len = len(closure)
-            for _id in list(closure):
-                closure.update(children[_id])
-
-        if closure:
-            closure.add( node['id'] )
+        closure = p.topic_closure(node)
+        if len(closure) > 1:
             backlinks={} # key, set(target)
-            for other in p.repo:
-                for k,v in other.items():
-                    if not k in backlinks:
-                        backlinks[k] = set()
-                    if type(v) == list:
-                        for vv in v:
-                            if type(vv) == dict and 'id' in vv and vv['id'] in closure:
-                                backlinks[k].add(other['id'])
-                    elif type(v) == dict and 'id' in v and v['id'] in closure:
-                        backlinks[k].add(other['id'])
+            for topic_id in closure:
+                for other_id, k in p.backlinks(topic_id):
+                    backlinks.setdefault(k, set()).add(other_id)
 
             for k in sorted(backlinks.keys()):
                 v = backlinks[k]
@@ -153,7 +119,8 @@ def node_data(p, node, target=None, files_to_url=None):
 def materialize(p, target_path):
     """
     Materialize symlinks based on topics and reading lists.
-    The target path should not exist.
+    The target path should not exist. Files stored packed or compressed are copied, decompressed,
+    to pages/files, as there is no file in the repository to link to.
     """
     if os.path.exists(target_path):
         raise Exception("Cannot materialize on path that already exists: '%s'" % (target_path,))
@@ -174,11 +141,17 @@ def materialize(p, target_path):
     files_path = os.path.join(pages_path, "files")
     os.mkdir(files_path)
     files_to_url={}
+    files_to_path={}
     for file_node in p.get_nodes_by_type('file'):
         fname = file_node['id'] + mimetype_to_ext[file_node['mimetype']]        
-        os.symlink(os.path.relpath(p.file_repo.get_absolute_path_to_file(file_node['id']), files_path),
-                   os.path.join(files_path, fname))
+        stored_path = p.file_repo.stored_path(file_node['id'])
+        if stored_path is None:
+            with p.file_repo.open_file(file_node['id']) as fsrc, open(os.path.join(files_path, fname), 'wb') as fdest:
+                shutil.copyfileobj(fsrc, fdest)
+        else:
+            os.symlink(os.path.relpath(stored_path, files_path), os.path.join(files_path, fname))
         files_to_url[file_node['id']] = "files/" + fname        
+        files_to_path[file_node['id']] = os.path.join(files_path, fname)
     for node in p.repo:
         # generate page
         (data, backlinks) = node_data(p, node, files_to_url=files_to_url)
@@ -232,7 +205,7 @@ def materialize(p, target_path):
                     paper_num = '%d' % (i+1)
                     if len(papers) > 10 and len(paper_num) == 1:
                         paper_num = '0' + paper_num
-                    os.symlink(os.path.relpath(p.file_repo.get_absolute_path_to_file(paper['on-disk']['id']), reading_list),
+                    os.symlink(os.path.relpath(files_to_path[paper['on-disk']['id']], reading_list),
                                (os.path.join(reading_list,
                                              '%s-%s-%s%s' % (_list['id'],
                                                                paper_num, paper['id'], mimetype_to_ext[paper['on-disk']['mimetype']]))))
@@ -250,6 +223,6 @@ def materialize(p, target_path):
                 if 'status' in paper:
                     status = re.sub('[^a-z]', '-', paper['status'].lower())
                     file_name = '%s-%s' % (status, file_name)
-                os.symlink(os.path.relpath(p.file_repo.get_absolute_path_to_file(paper['on-disk']['id']), all_papers),
+                os.symlink(os.path.relpath(files_to_path[paper['on-disk']['id']], all_papers),
                            (os.path.join(all_papers, file_name + mimetype_to_ext[paper['on-disk']['mimetype']])))
 
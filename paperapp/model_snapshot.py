@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import pickle
+
+# a snapshot is a JSON header line with the version and the key of the YAML file, followed by
+# the pickled state. The header is checked before unpickling anything.
+
+# bump when the pickled state changes in incompatible ways
+SNAPSHOT_VERSION = 2
+
+
+def snapshot_file(yaml_file):
+    return yaml_file + ".snapshot"
+
+def snapshot_key(yaml_file):
+    """Size, modification time and MD5 hash of the YAML file, the snapshot is valid only if these match."""
+    stat = os.stat(yaml_file)
+    md5 = hashlib.md5()
+    with open(yaml_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return [ stat.st_size, stat.st_mtime_ns, md5.hexdigest() ]
+
+def load_snapshot(yaml_file, attributes):
+    """Returns the state saved by write_snapshot, or None if it is missing, stale or corrupt.
+    """
+    path = snapshot_file(yaml_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if type(header) != dict or header.get('version') != SNAPSHOT_VERSION:
+                return None
+            if header.get('key') != snapshot_key(yaml_file):
+                return None
+            state = pickle.load(f)
+        for attribute in attributes:
+            if attribute not in state:
+                return None
+        return state
+    except Exception as e:
+        print("Ignoring snapshot {}: {}".format(path, e))
+        return None
+
+def write_snapshot(yaml_file, key, state):
+    """Save the verified model for a given YAML file key (as computed by snapshot_key)."""
+    path = snapshot_file(yaml_file)
+    header = { 'version' : SNAPSHOT_VERSION, 'key' : key }
+    tmp_file = path + ".tmp"
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b"\n")
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, path)
+    except (OSError, pickle.PicklingError, RecursionError) as e:
+        print("Cannot write snapshot {}: {}".format(path, e))
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
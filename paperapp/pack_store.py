@@ -0,0 +1,156 @@
+import contextlib
+import json
+import mmap
+import os
+import stat
+import tempfile
+
+try:
+    import fcntl
+except ImportError: # not on Windows, packs are then not safe to share between processes
+    fcntl = None
+
+
+# pack files for small files in a file repository
+class PackStore:
+
+    PACK_SIZE = 64 << 20 # a new pack file is started past this size
+
+    INDEX_FILE = 'index'
+    EXTRACTED_FOLDER = 'extracted'
+
+    def __init__(self, path_to_pack_folder):
+        """Small files appended to large pack files, in a folder inside the file repository.
+
+        The index is a log of JSON lines, either ``{"number": n, "pack": p,
+        "offset": o, "size": s}`` or ``{"number": n, "deleted": true}``. Packs
+        are named ``pack-<p>`` and only grow, space from deleted files is not
+        reclaimed. Files are read through mmap; when a path is needed they
+        are extracted, read-only, to the ``extracted`` folder.
+
+        Appends hold an exclusive lock on the index, so several processes
+        can add to the same packs.
+        """
+        self.pack_folder = path_to_pack_folder
+        self._index = None # file number -> (pack, offset, size), read when first needed
+        self._maps  = {}   # pack -> mmap
+        self._current = None # pack being appended to
+
+    def __getstate__(self):
+        # mmaps cannot be sent to worker processes
+        state = dict(self.__dict__)
+        state['_maps'] = {}
+        return state
+
+    def index(self):
+        if self._index is None:
+            self._index = {}
+            index_file = os.path.join(self.pack_folder, PackStore.INDEX_FILE)
+            if os.path.exists(index_file):
+                with open(index_file) as f:
+                    for line in f:
+                        if not line.endswith("\n"):
+                            break # interrupted write
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break
+                        if record.get('deleted'):
+                            self._index.pop(record['number'], None)
+                        else:
+                            self._index[record['number']] = (record['pack'], record['offset'], record['size'])
+        return self._index
+
+    def __contains__(self, number):
+        return number in self.index()
+
+    def size(self, number):
+        return self.index()[number][2]
+
+    def add(self, number, path_to_file):
+        """Append a file to the current pack."""
+        if not os.path.isdir(self.pack_folder):
+            os.mkdir(self.pack_folder)
+        index = self.index()
+        with self._locked_index() as index_file:
+            try:
+                if self._current is None:
+                    self._current = max([ entry[0] for entry in index.values() ], default=0)
+                pack_file = self._pack_file(self._current)
+                end = os.path.getsize(pack_file) if os.path.exists(pack_file) else 0
+                if end > 0 and end + os.path.getsize(path_to_file) > self.PACK_SIZE:
+                    self._current += 1
+                pack = self._current
+
+                # the offset and size are those of the bytes written, whoever else appended before
+                with open(path_to_file, 'rb') as src, open(self._pack_file(pack), 'ab') as dest:
+                    offset = dest.tell()
+                    size = 0
+                    for chunk in iter(lambda: src.read(1 << 20), b''):
+                        dest.write(chunk)
+                        size += len(chunk)
+                index[number] = (pack, offset, size)
+                self._write_record(index_file, { 'number' : number, 'pack' : pack, 'offset' : offset, 'size' : size })
+            except BaseException:
+                self._current = None
+                raise
+
+    def read(self, number):
+        """The contents of a packed file, read through a mmap of its pack."""
+        pack, offset, size = self.index()[number]
+        if size == 0:
+            return b''
+        data = self._maps.get(pack)
+        if data is None or len(data) < offset + size:
+            if data is not None:
+                data.close()
+            with open(self._pack_file(pack), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[pack] = data
+        return data[offset:offset + size]
+
+    def extract(self, number, made=None):
+        """Path to a read-only copy of a packed file, made the first time it is asked for. If made is
+        given, the path is appended to it when the copy is made."""
+        path = os.path.join(self.pack_folder, PackStore.EXTRACTED_FOLDER, str(number))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.read(number))
+            os.chmod(tmp_file, stat.S_IREAD|stat.S_IRGRP|stat.S_IROTH)
+            os.replace(tmp_file, path)
+            if made is not None:
+                made.append(path)
+        return path
+
+    def delete(self, number):
+        del self.index()[number]
+        self._append({ 'number' : number, 'deleted' : True })
+        path = os.path.join(self.pack_folder, PackStore.EXTRACTED_FOLDER, str(number))
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def close(self):
+        for data in self._maps.values():
+            data.close()
+        self._maps = {}
+
+    def _pack_file(self, pack):
+        return os.path.join(self.pack_folder, 'pack-%d' % (pack,))
+
+    def _append(self, record):
+        with self._locked_index() as index_file:
+            self._write_record(index_file, record)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """The index opened for appending, locked until the block ends."""
+        with open(os.path.join(self.pack_folder, PackStore.INDEX_FILE), 'a') as index_file:
+            if fcntl is not None:
+                fcntl.flock(index_file.fileno(), fcntl.LOCK_EX)
+            yield index_file # closing it releases the lock
+
+    def _write_record(self, index_file, record):
+        index_file.write(json.dumps(record, sort_keys=True) + "\n")
+        index_file.flush()
@@ -6,10 +6,10 @@ import codecs
 
 from . import PaperError
 
-import bibtexparser
-from bibtexparser.bparser import BibTexParser
+# bibtexparser is imported when importing, generating does not need it
 
 def _get_parser():
+    from bibtexparser.bparser import BibTexParser
     parser = BibTexParser(common_strings = True)
     return parser
 
@@ -64,6 +64,7 @@ def import_bibtex(paper, _file, verbose=True, create_papers=False):
     ignored. If create_papers is true, a paper entry will be created for
     each bibtex.
     """
+    import bibtexparser
     with open(_file) as f:
         db = bibtexparser.load(f, _get_parser()) # might fail
     return _process(paper, db, verbose, create_papers, _file)
@@ -75,6 +76,7 @@ def import_bibtex_str(paper, bibtex_str, verbose=True, create_papers=False):
     ignored. If create_papers is true, a paper entry will be created for
     each bibtex and the list of returned IDs are of the papers created.
 """
+    import bibtexparser
     db = bibtexparser.loads(bibtex_str, _get_parser()) # might fail
     return _process(paper, db, verbose, create_papers)
 
@@ -89,38 +91,39 @@ def _process(paper, db, verbose=True, create_papers=False, meta=None):
         raise PaperError("Error parsing {}".format(comment))
 
     ids = []
-    for entry in db.entries:
-        _id = entry['ID']
-        # normalize
-        _id = list(_id)
-        for idx in range(0, len(_id)):
-            ch = _id[idx]
-            if not ('0' <= ch <= '9' or 'A' <= ch <= 'Z' or 'a' <= ch <= 'z' or ch in '-_'):
-                _id[idx] = '_'
-        _id = "".join(_id)
+    with paper.batch():
+        for entry in db.entries:
+            _id = entry['ID']
+            # normalize
+            _id = list(_id)
+            for idx in range(0, len(_id)):
+                ch = _id[idx]
+                if not ('0' <= ch <= '9' or 'A' <= ch <= 'Z' or 'a' <= ch <= 'z' or ch in '-_'):
+                    _id[idx] = '_'
+            _id = "".join(_id)
     
-        if _id in paper.id_to_node:
-            if verbose:
-                print('Skipping existing key %s' % (_id))
-                continue
-        else:
-            # create the bibtex entry
-            bibtex = paper.new_bibtex(_id, entry['ENTRYTYPE'], meta, entry)
-
-            if create_papers:
-                text = _id
-                if 'title' in entry:
-                    text = entry['title']
-                if 'author' in entry:
-                    text += " -- " + entry['author']
-                new_paper = paper.new_paper(None, text, bibtex=bibtex)
+            if _id in paper.id_to_node:
                 if verbose:
-                    print("Created new paper: {}".format(new_paper['id']))
-                ids.append(new_paper['id'])
+                    print('Skipping existing key %s' % (_id))
+                    continue
             else:
-                ids.append(_id)
+                # create the bibtex entry
+                bibtex = paper.new_bibtex(_id, entry['ENTRYTYPE'], meta, entry)
+
+                if create_papers:
+                    text = _id
+                    if 'title' in entry:
+                        text = entry['title']
+                    if 'author' in entry:
+                        text += " -- " + entry['author']
+                    new_paper = paper.new_paper(None, text, bibtex=bibtex)
+                    if verbose:
+                        print("Created new paper: {}".format(new_paper['id']))
+                    ids.append(new_paper['id'])
+                else:
+                    ids.append(_id)
                 
 
-    paper.auto_save()
+        paper.auto_save()
 
     return ids
@@ -2,6 +2,7 @@
 
 import os
 import re
+import asyncio
 import codecs
 import yaml
 import os
@@ -55,9 +56,21 @@ def new_node(paper, _id=None, _type="artifact", upload=False, prototype=None):
     def _set_upload(upload):
         fb = FileBrowser(upload)
 
-        def process_upload(source):
-            nf = paper.register_file(fb.path)
+        def registered(future):
+            try:
+                nf = future.result()
+            except Exception as e:
+                done_button.disabled = False
+                done_button.description = "pick file"
+                box.children = tuple([fb.widget(), done_button, widgets.HTML(value="Error: %s" % (e,))])
+                return
             _set_edit(nf['text'],uploaded_file=nf)
+
+        def process_upload(source):
+            # registered in the background, so the notebook is not frozen while hashing and extracting text
+            done_button.disabled = True
+            done_button.description = "registering..."
+            asyncio.ensure_future(paper.aregister_file(fb.path)).add_done_callback(registered)
         
         done_button = widgets.Button(description="pick file", background_color='#ffd0d0')
         done_button.on_click(process_upload)
@@ -74,7 +87,8 @@ def new_node(paper, _id=None, _type="artifact", upload=False, prototype=None):
                         node[k] = copy.copy(prototype[k]) # one level copy
         if uploaded_file:
             node['on-disk'] = uploaded_file
-        paper._new_node(node)
+        with paper.lock:
+            paper._new_node(node)
 
         box.children = tuple([ edit_node(paper, node)])
 
@@ -129,35 +143,43 @@ def edit_node(paper, node_or_key):
         for i in range(0,len(entries)):
             
             def delete_row(source):
-                if type(node[slot]) == list:
-                    del node[slot][source.idx]
-                    must_delete = len(node[slot]) == 0
-                    if len(node[slot]) == 1:
-                        node[slot] = node[slot][0]
-                else:
-                    must_delete = True
-                if must_delete:
-                    del node[slot]
+                with paper.lock:
+                    if type(node[slot]) == list:
+                        del node[slot][source.idx]
+                        must_delete = len(node[slot]) == 0
+                        if len(node[slot]) == 1:
+                            node[slot] = node[slot][0]
+                    else:
+                        must_delete = True
+                    if must_delete:
+                        del node[slot]
+                    paper.touch(node)
                 make_box()
 
             def add_row(source):
-                if type(node[slot]) != list:
-                    node[slot] = [ node[slot] ]
-                node[slot].insert(source.idx+1, 'New entry')
+                with paper.lock:
+                    if type(node[slot]) != list:
+                        node[slot] = [ node[slot] ]
+                    node[slot].insert(source.idx+1, 'New entry')
+                    paper.touch(node)
                 make_box()
 
             def move_up(source):
                 if source.idx != 0:
-                    to_move = node[slot][source.idx]
-                    del node[slot][source.idx]
-                    node[slot].insert(source.idx-1, to_move)
+                    with paper.lock:
+                        to_move = node[slot][source.idx]
+                        del node[slot][source.idx]
+                        node[slot].insert(source.idx-1, to_move)
+                        paper.touch(node)
                     make_box()
                 
             def move_dn(source):
                 if source.idx != len(entries) - 1:
-                    to_move = node[slot][source.idx]
-                    del node[slot][source.idx]
-                    node[slot].insert(source.idx+1, to_move)
+                    with paper.lock:
+                        to_move = node[slot][source.idx]
+                        del node[slot][source.idx]
+                        node[slot].insert(source.idx+1, to_move)
+                        paper.touch(node)
                     make_box()
             
             delbtn = widgets.Button(description="-", layout=widgets.Layout(width="30px"))
@@ -186,10 +208,12 @@ def edit_node(paper, node_or_key):
                     text = widgets.Textarea(description=slot,value=value)
 
                 def live_edit(source):
-                    if is_list:
-                        node[slot][idx] = text.value
-                    else:
-                        node[slot] = text.value
+                    with paper.lock:
+                        if is_list:
+                            node[slot][idx] = text.value
+                        else:
+                            node[slot] = text.value
+                        paper.touch(node)
                 
                 text.on_trait_change(live_edit, 'value')
                 return text
@@ -220,17 +244,19 @@ def edit_node(paper, node_or_key):
 
                     def change_target(source):
                         if dropdown.value:
-                            if dropdown.value == 'paper-none':
-                                if is_list:
-                                    node[slot][i] = ""
-                                else:
-                                    node[slot] = ""
-                            else:
-                                value = paper[dropdown.value]
-                                if is_list:
-                                    node[slot][i] = value
+                            with paper.lock:
+                                if dropdown.value == 'paper-none':
+                                    if is_list:
+                                        node[slot][i] = ""
+                                    else:
+                                        node[slot] = ""
                                 else:
-                                    node[slot] = value
+                                    value = paper[dropdown.value]
+                                    if is_list:
+                                        node[slot][i] = value
+                                    else:
+                                        node[slot] = value
+                                paper.touch(node)
 
                     dropdown.on_trait_change(change_target, 'value')
 
@@ -265,10 +291,12 @@ def edit_node(paper, node_or_key):
                         value = 'New string'
                     else:
                         value = { 'type':toggle.value }
-                    if is_list:
-                        node[slot][i] = value
-                    else:
-                        node[slot] = value
+                    with paper.lock:
+                        if is_list:
+                            node[slot][i] = value
+                        else:
+                            node[slot] = value
+                        paper.touch(node)
                     make_box()
 
                 toggle.on_trait_change(change_type, 'value')
@@ -294,7 +322,8 @@ def edit_node(paper, node_or_key):
         
         save_btn = widgets.Button(description="Save")
         def do_save(source):
-            paper.auto_save()
+            with paper.lock:
+                paper.auto_save()
             make_box()
         save_btn.on_click(do_save)
         
@@ -303,7 +332,9 @@ def edit_node(paper, node_or_key):
                                   layout=widgets.Layout(width="50%"),
                                   style={'description_width': 'initial'})
         def add_new_entry(source):
-            node[select.value] = 'New entry'
+            with paper.lock:
+                node[select.value] = 'New entry'
+                paper.touch(node)
             make_box()
         select.on_trait_change(add_new_entry, 'value')
         return widgets.HBox(children=( refresh_btn, save_btn, select ))
@@ -1,13 +1,21 @@
+import threading
 import yaml
 import os
 import datetime
 import random
 import hashlib
+import pickle
+import contextlib
+import json
+import itertools
+from collections.abc import Sequence
 
-from .             import PaperError
+from .             import PaperError, PaperValidationError
 from .paper_yaml   import Dumper, safe_unicode
 from .file_repo    import FileRepo
 from .search_index import SearchIndex
+from .change_journal import ChangeJournal, encode_node, decode_node, resolve_refs
+from .model_snapshot import load_snapshot, write_snapshot, snapshot_key
 
 # repo class
 class PaperRepo:
@@ -18,7 +26,15 @@ class PaperRepo:
                  index_folder=None,
                  data_folder=None,
                  auto_save=False,
-                 custom_types=None):
+                 custom_types=None,
+                 journal=False,
+                 snapshot=None,
+                 pack_threshold=0,
+                 compress=False,
+                 index_jobs=1,
+                 text_cache_folder=None,
+                 index_sync='now',
+                 isolated_extraction=False):
         """Create a paper repository object. 
 
         With no options, an empty one with no file repository nor search
@@ -35,11 +51,49 @@ class PaperRepo:
 
         Alternatively, a data_folder can be provided that will use
         ``paper-model.yaml`` as the yaml_file, ``files`` as the
-        file_folder and ``index`` as the index_folder.
+        file_folder, ``index`` as the index_folder and ``text-cache`` as
+        the text_cache_folder.
 
         Custom types can be provided, see get_default_types for the base
         types.
+
+        With journal set to True (and auto_save), changes are appended
+        to a ``.journal`` file next to the yaml_file instead of rewriting
+        the whole YAML after each change. The journal is folded into the
+        YAML after JOURNAL_THRESHOLD records or when calling checkpoint().
+        Existing journals are always replayed when loading. Nodes edited
+        directly (``p['paper-1']['status'] = 'read'``) need a call to
+        touch() to be journaled.
+
+        With snapshot set to True, the verified model is cached in a
+        ``.snapshot`` file next to the yaml_file and reused while the YAML
+        file stays unchanged (same size, modification time and MD5). By
+        default this is only done for a data_folder: snapshots are
+        pickles, only load them from folders you own.
+
+        With pack_threshold, files registered smaller than that many bytes
+        are appended to pack files in the file repository instead of each
+        taking its own file, see FileRepo.
+
+        With compress, files that compress well (text, HTML, PostScript,
+        old Office formats) are stored compressed, see FileRepo.
+
+        If the number of documents in the search index is not the number
+        of files, the index is reconciled with the file repository (see
+        reconcile_index) using index_jobs worker processes to extract
+        text. With index_sync set to 'background', this is done in a
+        thread holding the lock (see aregister_file), with 'later' it is
+        left for the caller. With a text_cache_folder, the text extracted
+        from each file is kept there and reused when reindexing.
+
+        Text is extracted in this process unless more than one job is
+        asked for. With isolated_extraction, it is always extracted in
+        worker processes, where extractors that hang time out (see
+        extract_texts); scripts must then keep their top-level code under
+        ``if __name__ == '__main__':``, as the workers import them again.
 """
+        if snapshot is None:
+            snapshot = bool(data_folder)
         if data_folder:
             if not os.path.exists(data_folder):
                 raise PaperError("Data folder must exist, got '{}'".format(data_folder))
@@ -48,20 +102,33 @@ class PaperRepo:
             yaml_file    = os.path.join(data_folder, "paper-model.yaml")
             file_folder  = os.path.join(data_folder, "files")
             index_folder = os.path.join(data_folder, "index")
+            if text_cache_folder is None:
+                text_cache_folder = os.path.join(data_folder, "text-cache")
             if not os.path.exists(file_folder):
                 os.mkdir(file_folder)
             if not os.path.exists(index_folder):
                 os.mkdir(index_folder)
 
         
+        self._type_views = {} # type -> tuple of nodes, cached from _nodes_by_type
+        self._topic_closure = {} # topic id -> tuple of topic ids under it, cached from _backlinks
+        self._repo = None # the nodes as loaded, until verify() builds id_to_node, see repo
+        state = None
         if yaml_file and os.path.exists(yaml_file):
-            with open(yaml_file, "r") as yamlf:
-                self.repo = yaml.load(yamlf, Loader=yaml.FullLoader)
-            if self.repo[0]['type'] == 'types':
-                self.types = self.repo[0]['types']
-                del self.repo[0]
+            if snapshot:
+                state = load_snapshot(yaml_file, PaperRepo.SNAPSHOT_ATTRIBUTES)
+            if state:
+                for attribute in PaperRepo.SNAPSHOT_ATTRIBUTES:
+                    setattr(self, attribute, state[attribute])
             else:
-                self.types = PaperRepo.get_default_types()
+                key = snapshot_key(yaml_file)
+                with open(yaml_file, "r") as yamlf:
+                    self.repo = yaml.load(yamlf, Loader=yaml.FullLoader)
+                if self.repo[0]['type'] == 'types':
+                    self.types = self.repo[0]['types']
+                    del self.repo[0]
+                else:
+                    self.types = PaperRepo.get_default_types()
         else:
             self.repo = []
             self.types = PaperRepo.get_default_types()
@@ -71,36 +138,359 @@ class PaperRepo:
             self.types = custom_types
 
         self.file_hashes = {}
-        self.verify()
-
-        self.file_repo = FileRepo(file_folder) if file_folder else None
+        if state is None or custom_types:
+            self.verify()
+            if snapshot and state is None and not custom_types and yaml_file and os.path.exists(yaml_file):
+                write_snapshot(yaml_file, key,
+                               { attribute: getattr(self, attribute) for attribute in PaperRepo.SNAPSHOT_ATTRIBUTES })
+
+        self._batch = None
+        self._journal = None
+        self.lock = threading.RLock() # serializes changes to the model, see the async methods
+        self.index_thread = None # reconciling the search index in the background, see index_sync
+        if yaml_file:
+            journal_file = ChangeJournal(yaml_file + ".journal")
+            if journal_file.size > 0:
+                self._replay_journal(journal_file)
+            if journal and auto_save:
+                self._journal = journal_file
+
+        self.file_repo = FileRepo(file_folder, pack_threshold=pack_threshold, compress=compress) if file_folder else None
+        if self.file_repo:
+            self._hashes_from_manifest()
         if auto_save:
             self._auto_save = yaml_file
         else:
             self._auto_save = None
 
-        self.search_index = SearchIndex(index_folder) if index_folder else None
+        self.search_index = SearchIndex(index_folder, text_cache_folder,
+                                        isolated=isolated_extraction) if index_folder else None
         if self.search_index:
             if not self.file_repo:
                 raise PaperError("Cannot have a search engine without a file repository.")
+            if index_sync not in [ 'now', 'background', 'later' ]:
+                raise PaperError("Unknown index_sync '%s', expected now, background or later" % (index_sync,))
             all_files = self.get_nodes_by_type('file')
-            if self.search_index.size() != len(all_files):
-                print("Index contains {} documents, file repository contains {} files. Reindexing...".format(
+            if self.search_index.size() != len(all_files) and index_sync != 'later':
+                print("Index contains {} documents, file repository contains {} files. Reconciling...".format(
                     self.search_index.size(), len(all_files)))
-                self.search_index.refresh(all_files, self.file_repo)
+                if index_sync == 'now':
+                    self.reconcile_index(index_jobs)
+                else:
+                    self.index_thread = threading.Thread(target=self.reconcile_index, args=(index_jobs,),
+                                                         daemon=True)
+                    self.index_thread.start()
 
         # defaults
         self.default_topic = None
         self.default_context = None # search or paper, used for 'found-in'
 
+    JOURNAL_THRESHOLD = 1000
+
+    # state kept in the snapshot cache, as computed by verify()
+    SNAPSHOT_ATTRIBUTES = [ 'types', 'id_to_node', 'counts_by_type', 'maxid_by_type', 'hashes',
+                            '_nodes_by_type', '_backlinks', '_out_edges',
+                            '_node_digests', '_digest_buckets', '_bucket_digests', '_stale_digests', '_root_digest' ]
+
     def save(self, path_to_yaml):
-        with open(path_to_yaml, 'w') as f:
-            f.write(yaml.dump([ { 'type' : 'types', 'types' : self.types } ] + self.repo, Dumper=Dumper))
+        tmp_file = path_to_yaml + ".tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(yaml.dump([ { 'type' : 'types', 'types' : self.types } ] + list(self.repo), Dumper=Dumper))
+        os.replace(tmp_file, path_to_yaml)
+        # the YAML now contains everything in the journal
+        journal_file = path_to_yaml + ".journal"
+        if self._journal is not None and self._journal.path == journal_file:
+            self._journal.clear()
+        elif os.path.exists(journal_file):
+            os.unlink(journal_file)
 
     def auto_save(self):
+        if self._batch is not None:
+            self._batch['changed'] = True
+            return
+        if self._auto_save is not None:
+            if self._journal is not None:
+                self._journal.flush(self.id_to_node)
+                if self._journal.size >= PaperRepo.JOURNAL_THRESHOLD:
+                    self.checkpoint()
+            else:
+                self.save(self._auto_save)
+
+    def checkpoint(self):
+        """Fold the journal into the YAML file."""
         if self._auto_save is not None:
             self.save(self._auto_save)
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Group changes in a transaction, ``with p.batch(): ...``
+
+        Saving, search index writes and file deletions are deferred until
+        the end of the block and done once. If an exception is raised, the
+        model is restored to its state before the block (node objects
+        held by the caller are then detached from the repository), files
+        copied into the file repository are removed and nothing is
+        indexed. If the process dies in the block instead, nothing is
+        saved and the files stored so far stay in the file repository,
+        where fsck reports them as orphans (files moved in are then still
+        hardlinked to their originals, which are left in place). Files
+        registered in the batch are not searchable until it ends. The batch holds self.lock until it ends, so it must end
+        in the thread that started it. Batches can be nested, only the
+        outermost one commits; if a nested block fails, the outermost one
+        rolls back and raises PaperError even if the exception was caught
+        in between.
+
+        Nodes created in the batch are simply removed on rollback. The
+        first change to an existing node makes a copy of the whole model
+        to restore; for nodes edited directly, that happens when calling
+        touch(), so an edit made before the node was touched in the batch
+        is kept.
+        """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        else:
+            self.commit()
+
+    def begin(self):
+        """Start a batch, see batch(). Must be followed by commit() or rollback()."""
+        self.lock.acquire()
+        if self._batch is not None:
+            self._batch['depth'] += 1
+            self.lock.release() # held once for the whole batch
+            return
+        self._batch = {
+            'depth'        : 1,
+            'changed'      : False,
+            'failed'       : False, # a nested block rolled back
+            'state'        : None, # the model before the first change to an existing node, see _before_change
+            'added'        : {},   # ids of the nodes created before that, in order
+            'maxid_by_type': dict(self.maxid_by_type),
+            'pending'      : dict(self._journal.pending) if self._journal is not None else None,
+            'to_index'     : [], # file ids
+            'to_unindex'   : [], # file ids
+            'new_files'    : [], # file numbers copied into the file repository
+            'deleted_files': [], # file ids to delete from the file repository
+            'unlinks'      : [], # processed files to delete
+            'jobs'         : 1,  # worker processes for text extraction
+            }
+
+    def commit(self):
+        """End a batch, applying the deferred changes."""
+        if self._batch is None:
+            raise PaperError("No batch in progress.")
+        self._batch['depth'] -= 1
+        if self._batch['depth'] > 0:
+            return
+        if self._batch['failed']:
+            self._batch['depth'] = 1
+            self.rollback()
+            raise PaperError("A nested batch failed, all the changes in the batch were rolled back.")
+        batch = self._batch
+        self._batch = None
+        try:
+            # save first, the stored files are only in the manifest after it: if interrupted
+            # before, they are orphans for fsck; after, the processed files are left behind
+            if batch['changed']:
+                self.auto_save()
+            for file_id in batch['deleted_files']:
+                self.file_repo.delete_file(file_id)
+            if self.file_repo:
+                self.file_repo.finish_processed(batch['unlinks'])
+            if self.search_index and (batch['to_index'] or batch['to_unindex']):
+                with self.file_repo.temporary_copies():
+                    self.search_index.update([ (file_id,
+                                                self.file_repo.get_absolute_path_to_file(self.id_to_node[file_id]['number']),
+                                                self.id_to_node[file_id]['mimetype'],
+                                                self.id_to_node[file_id].get('md5hash'))
+                                               for file_id in batch['to_index'] if file_id in self.id_to_node ],
+                                             batch['to_unindex'], jobs=batch['jobs'])
+        finally:
+            self.lock.release()
+
+    def rollback(self):
+        """Abandon a batch, restoring the model to its state when the batch started. In a nested
+        batch, the batch is only marked as failed, the outermost one rolls back."""
+        if self._batch is None:
+            return
+        if self._batch['depth'] > 1:
+            self._batch['depth'] -= 1
+            self._batch['failed'] = True
+            return
+        batch = self._batch
+        self._batch = None
+        try:
+            for number in batch['new_files']:
+                self.file_repo.delete_file(number)
+            if self.file_repo:
+                self.file_repo.finish_processed(batch['unlinks'], unlink=False)
+            if batch['state'] is not None:
+                state = pickle.loads(batch['state'])
+                for attribute in PaperRepo.SNAPSHOT_ATTRIBUTES:
+                    setattr(self, attribute, state[attribute])
+            self._type_views = {}
+            self._topic_closure = {}
+            for _id in reversed(list(batch['added'])):
+                if _id in self.id_to_node:
+                    self._delete_node(self.id_to_node[_id])
+            self.maxid_by_type = batch['maxid_by_type']
+            if self._journal is not None:
+                self._journal.pending = batch['pending']
+            if self.default_topic is not None:
+                self.default_topic = self.id_to_node.get(self.default_topic['id'])
+            if self.default_context is not None:
+                self.default_context = self.id_to_node.get(self.default_context['id'])
+        finally:
+            self.lock.release()
+
+    def _before_change(self, node_id):
+        """Called before changing an existing node: in a batch, the model is copied the first time,
+        unless the node was created in the batch."""
+        batch = self._batch
+        if batch is not None and batch['state'] is None and node_id not in batch['added']:
+            batch['state'] = pickle.dumps({ attribute: getattr(self, attribute)
+                                            for attribute in PaperRepo.SNAPSHOT_ATTRIBUTES },
+                                          protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _index_file(self, node, content=None):
+        if not self.search_index:
+            return
+        if self._batch is not None:
+            self._batch['to_index'].append(node['id'])
+        else:
+            with self.file_repo.temporary_copies():
+                self.search_index.index_content(node['id'],
+                                                self.file_repo.get_absolute_path_to_file(node['number']),
+                                                node['mimetype'], content=content, md5hash=node['md5hash'])
+
+    @contextlib.contextmanager
+    def _index_many(self):
+        """Group the index writes of a block in one commit, batches already do."""
+        if not self.search_index or self._batch is not None:
+            yield
+        else:
+            with self.file_repo.temporary_copies(), self.search_index.index_many():
+                yield
+
+    def _remove_file(self, file_id):
+        """Delete a file from disk and from the index, now or when the batch ends."""
+        if self._batch is not None:
+            if file_id in self._batch['to_index']:
+                self._batch['to_index'].remove(file_id)
+            elif self.search_index:
+                self._batch['to_unindex'].append(file_id)
+            self._batch['deleted_files'].append(file_id)
+        else:
+            self.file_repo.delete_file(file_id)
+            if self.search_index:
+                self.search_index.delete(file_id)
+
+    def touch(self, node_or_id):
+        """Flag a node as changed, needed when editing a node dictionary directly.
+
+        This updates the indexes (types, backlinks) for the node and
+        records the change in the journal.
+        """
+        with self.lock:
+            if type(node_or_id) == dict:
+                node_or_id = node_or_id['id']
+            self._before_change(node_or_id)
+            node = self.id_to_node.get(node_or_id)
+            if node is not None:
+                if node_or_id not in self._nodes_by_type.get(node['type'], {}):
+                    # the type was changed
+                    for _type in list(self._nodes_by_type.keys()):
+                        if node_or_id in self._nodes_by_type[_type]:
+                            self._index_type_remove(_type, node_or_id)
+                    self._index_type_add(node)
+                    self._topic_closure = {}
+                self._index_edges_remove(node_or_id)
+                self._index_edges_add(node)
+                self._stale_digests.add(node_or_id)
+            if self._journal is not None:
+                self._journal.put(node_or_id)
+
+    def backlinks(self, node_or_id, key=None):
+        """The (source id, key) pairs of the nodes pointing to a given node.
+
+        If key is given, only links through that key are returned."""
+        if type(node_or_id) == dict:
+            node_or_id = node_or_id['id']
+        links = self._backlinks.get(node_or_id, {})
+        if key is None:
+            return list(links.keys())
+        return [ link for link in links.keys() if link[1] == key ]
+
+    def _index_edges_add(self, node):
+        node_id = node['id']
+        edges = node_edges(node)
+        self._out_edges[node_id] = edges
+        for k, target in edges:
+            links = self._backlinks.setdefault(target, {})
+            links[(node_id, k)] = links.get((node_id, k), 0) + 1
+            if k == 'related-to' and node['type'] == 'topic':
+                self._topic_closure = {}
+
+    def _index_edges_remove(self, node_id):
+        is_topic = node_id in self._nodes_by_type.get('topic', {})
+        for k, target in self._out_edges.pop(node_id, []):
+            if k == 'related-to' and is_topic:
+                self._topic_closure = {}
+            links = self._backlinks[target]
+            links[(node_id, k)] -= 1
+            if links[(node_id, k)] == 0:
+                del links[(node_id, k)]
+                if not links:
+                    del self._backlinks[target]
+
+    def _index_type_add(self, node):
+        self._nodes_by_type.setdefault(node['type'], {})[node['id']] = node
+        self._type_views.pop(node['type'], None)
+
+    def _index_type_remove(self, _type, node_id):
+        nodes = self._nodes_by_type.get(_type)
+        if nodes is not None and node_id in nodes:
+            del nodes[node_id]
+            if not nodes:
+                del self._nodes_by_type[_type]
+            self._type_views.pop(_type, None)
+
+    def _replay_journal(self, journal):
+        """Apply the records in the journal on top of the loaded model."""
+        changed = []
+        for record in journal.read():
+            if record['op'] == 'del':
+                if record['id'] in self.id_to_node:
+                    self._delete_node(self.id_to_node[record['id']])
+            else:
+                node = decode_node(record['node'])
+                if node['id'] in self.id_to_node:
+                    existing = self.id_to_node[node['id']]
+                    existing.clear()
+                    existing.update(node)
+                    node = existing
+                else:
+                    self._new_node(node)
+                changed.append(node)
+        for node in changed:
+            resolve_refs(node, self.id_to_node)
+        self.verify()
+
+    @property
+    def repo(self):
+        """All the nodes, in the order they were added. Once verified, a read-only view of id_to_node,
+        so it follows the nodes added and deleted afterwards."""
+        if self._repo is None:
+            return _RepoNodes(self)
+        return self._repo
+
+    @repo.setter
+    def repo(self, nodes):
+        self._repo = nodes
+
     def __getitem__(self, key):
         """Get a node by a given key, note that setitem is not defined as
         it involves a number of substeps and require the caller to know
@@ -114,9 +504,16 @@ class PaperRepo:
         return iter(self.id_to_node.keys())
 
     def verify(self):
+        """Rebuild the counts and lookup tables and validate every node against the types.
+
+        All the problems found are reported together in a PaperValidationError.
+        """
+        errors = []
+        if self._repo is None:
+            self._repo = list(self.id_to_node.values())
         self.counts_by_type = {}
         self.maxid_by_type = {}
-        for node in self.repo:
+        for node in self._repo:
             if 'type' in node:
                 node_type = node['type']
                 self.counts_by_type[node_type] = self.counts_by_type.get(node_type, 0) + 1
@@ -130,11 +527,12 @@ class PaperRepo:
                     self.maxid_by_type[node_type] = max(self.maxid_by_type[node_type], intid)
 
         self.id_to_node = {}
-        for node in self.repo:
+        for node in self._repo:
             if 'id' in node:
                 node_id = node['id']
                 if node_id in self.id_to_node:
-                    raise PaperError("Duplicated id: '%s'" % node_id)
+                    errors.append("Duplicated id: '%s'" % node_id)
+                    continue
                 self.id_to_node[node_id] = node
             else: # manufacture an id from type
                 if 'type' in node:
@@ -147,22 +545,31 @@ class PaperRepo:
                     
                     self.id_to_node[node_id] = node
                 else:
-                    raise PaperError("No id and no type: '%s'" % yaml.dump(node))
-                    
-        for node in self.repo:
+                    errors.append("No id and no type: '%s'" % yaml.dump(node))
+        if errors:
+            raise PaperValidationError(errors)
+
+        # single pass over nodes (including the ones added by verify_node) and their edges
+        schema = self.compile_types()
+        self.hashes = {}
+        self._nodes_by_type = {}
+        self._type_views = {}
+        self._topic_closure = {}
+        self._backlinks = {} # target id -> { (source id, key): count }
+        self._out_edges = {} # source id -> [ (key, target id) ]
+        for node in self._repo:
             for k,v in node.items():
                 if type(v) == dict:
                     self.verify_node(k, v)
 
-        # verify all nodes now have a type
-        for node in self.repo:
             if not 'type' in node:
-                raise PaperError("Node id '%s' has no type" % node['id'])
-            self.verify_relations(node)
+                errors.append("Node id '%s' has no type" % node['id'])
+                continue
+            errors.extend(self._relation_errors(node, schema))
+            self._nodes_by_type.setdefault(node['type'], {})[node['id']] = node
+            self._index_edges_add(node)
 
-        # collect file hashes
-        self.hashes = {}
-        for node in self.repo:
+            # collect file hashes
             if node['type'] == 'file':
                 if 'md5hash' in node:
                     md5hash = node['md5hash']
@@ -175,46 +582,73 @@ class PaperRepo:
                         random.shuffle(l)
                         md5hash = hashlib.md5("".join(l).encode('utf-8')).hexdigest()
                 if md5hash in self.hashes:
-                    raise PaperError('Repeated file in repo: {} and {} have hash {}'.format(node['id'],
-                                                                                            self.hashes[md5hash],
-                                                                                            md5hash))
-                self.hashes[md5hash] = node['id']
+                    errors.append('Repeated file in repo: {} and {} have hash {}'.format(node['id'],
+                                                                                         self.hashes[md5hash],
+                                                                                         md5hash))
+                else:
+                    self.hashes[md5hash] = node['id']
+        self._repo = None # id_to_node has every node now
+        if errors:
+            raise PaperValidationError(errors)
 
         # compute hash
+        self._node_digests = {}
+        self._digest_buckets = [ {} for _ in range(PaperRepo.DIGEST_BUCKETS) ]
+        self._bucket_digests = [ None ] * PaperRepo.DIGEST_BUCKETS
+        self._stale_digests = set(self.id_to_node.keys())
+        self._root_digest = None
         return self.versionhash()
 
+    DIGEST_BUCKETS = 256
+
     def versionhash(self):
-        def stablehash(obj):
-            result = 0
-            if type(obj) == str or type(obj) == str:
-                for c in obj:
-                    result += ord(c)
-            if type(obj) == int or type(obj) == int:
-                result += obj
-            if type(obj) == float:
-                result += int(obj)
-            if type(obj) == list:
-                i = 1
-                for o in obj:
-                    result += i * stablehash(o)
-                    i += 7
-            if type(obj) == dict:
-                for k,v in obj.items():
-                    result += stablehash(k) ^ stablehash(v)
-            return result
-        return stablehash(self.repo)
+        """A digest of the whole model.
+
+        Each node has its own content digest (see node_digest), the nodes
+        are spread in DIGEST_BUCKETS buckets by id and the root hashes the
+        bucket digests. Only the nodes changed since the last call (and
+        their buckets) are hashed again."""
+        if self._stale_digests:
+            for node_id in self._stale_digests:
+                bucket = self._digest_bucket(node_id)
+                node = self.id_to_node.get(node_id)
+                if node is None:
+                    self._node_digests.pop(node_id, None)
+                    self._digest_buckets[bucket].pop(node_id, None)
+                else:
+                    digest = hashlib.blake2b(json.dumps(encode_node(node), sort_keys=True).encode('utf-8'),
+                                             digest_size=16).hexdigest()
+                    self._node_digests[node_id] = digest
+                    self._digest_buckets[bucket][node_id] = digest
+                self._bucket_digests[bucket] = None
+            self._stale_digests = set()
+            self._root_digest = None
+        if self._root_digest is None:
+            for bucket in range(PaperRepo.DIGEST_BUCKETS):
+                if self._bucket_digests[bucket] is None:
+                    nodes = self._digest_buckets[bucket]
+                    self._bucket_digests[bucket] = hashlib.blake2b(
+                        "".join("%s:%s\n" % (node_id, nodes[node_id]) for node_id in sorted(nodes)).encode('utf-8'),
+                        digest_size=16).hexdigest()
+            self._root_digest = hashlib.blake2b("".join(self._bucket_digests).encode('utf-8'),
+                                                digest_size=16).hexdigest()
+        return self._root_digest
+
+    def node_digest(self, node_or_id):
+        """Digest of the content of a node, other nodes it points to are hashed by id only."""
+        if type(node_or_id) == dict:
+            node_or_id = node_or_id['id']
+        if node_or_id in self._stale_digests:
+            self.versionhash()
+        return self._node_digests[node_or_id]
+
+    def _digest_bucket(self, node_id):
+        return int(hashlib.md5(node_id.encode('utf-8')).hexdigest()[:4], 16) % PaperRepo.DIGEST_BUCKETS
 
     def verify_node(self, k, node):
         """Verify the node has a type, an id and that it exists in the repo as a separate node"""
-        in_repo = False
-        if 'id' in node and node['id'] in self.id_to_node:
-            in_repo = True
-        else:
-            # brute force check if is in the repo
-            for other in self.repo:
-                if other == node:
-                    in_repo = True
-                    break
+        # nodes in the repo have all been given an id by now
+        in_repo = 'id' in node and node['id'] in self.id_to_node
 
         type_count = -1
         if not 'type' in node:
@@ -241,7 +675,9 @@ class PaperRepo:
 
         if not in_repo:
             print("Adding node id '%s' to repo" % (node_id,))
-            self.repo.append(node)
+            if self._repo is not None: # in verify(), which goes over the nodes added
+                self._repo.append(node)
+            self.id_to_node[node_id] = node
 
     DEFAULT_TYPES = None
 
@@ -294,28 +730,36 @@ class PaperRepo:
         return types
         
     
+    def compile_types(self):
+        """The types as { type: { key: frozenset of target types } }, for fast lookups."""
+        return { _type: { k: frozenset(targets) for k, targets in valid.items() }
+                 for _type, valid in self.types.items() }
+
     def verify_relations(self, node):
         """
-        Verify all the relations make sense for a given type.
+        Verify all the relations make sense for a given node.
         """
-        for node in self.repo:
-            _type = node['type']
-            if not _type in self.types:
-                raise PaperError('Type "%s" for node "%s" cannot be validated! Known types: %s' %
-                                (_type, yaml.dump(node),
-                                 ", ".join(list(self.types.keys()))))
-            valid = self.types[_type]
-            for k, v in node.items():
-                if not k in valid:
-                    raise PaperError('Key "%s" for node "%s" (of type "%s") is invalid! Valid keys: %s' %
-                                    (k, yaml.dump(node), _type,
-                                     ", ".join(list(valid.keys()))))
-                if type(v) == dict:
-                    target = v['type']
-                    if not target in valid[k]:
-                        raise PaperError('Value for key "%s" in node "%s" if of type "%s" which is invalid! Valid types are: %s' %
-                                        (k, yaml.dump(node), target,
-                                         ", ".join(valid[k])))
+        errors = self._relation_errors(node, self.compile_types())
+        if errors:
+            raise PaperValidationError(errors)
+
+    def _relation_errors(self, node, schema):
+        _type = node['type']
+        if not _type in schema:
+            return [ 'Type "%s" for node "%s" cannot be validated! Known types: %s' %
+                     (_type, node['id'], ", ".join(list(self.types.keys()))) ]
+        errors = []
+        valid = schema[_type]
+        for k, v in node.items():
+            if not k in valid:
+                errors.append('Key "%s" for node "%s" (of type "%s") is invalid! Valid keys: %s' %
+                              (k, node['id'], _type, ", ".join(list(valid.keys()))))
+            elif type(v) == dict:
+                target = v['type']
+                if not target in valid[k]:
+                    errors.append('Value for key "%s" in node "%s" if of type "%s" which is invalid! Valid types are: %s' %
+                                  (k, node['id'], target, ", ".join(self.types[_type][k])))
+        return errors
 
     def _resolve_list(self, list_or_elem, node, key):
         """
@@ -343,87 +787,76 @@ class PaperRepo:
                  node[key] = _list
 
     def _new_node(self, node):
-        _id   = node['id']
-        _type = node['type']
-        if _id in self.id_to_node:
-            raise PaperError("Node with id '%s' already exists: %s" % (_id, yaml.dump(self.id_to_node[_id])))
-        self.repo.append(node)
-        self.id_to_node[_id] = node
-        self.counts_by_type[_type] = self.counts_by_type.get(_type, 0) + 1
-        if _id[0:len(_type)+1] == _type+"-":
-            try:
-                intid = int(_id[len(_type)+1:])
-            except ValueError:
-                intid = 0
-            if not _type in self.maxid_by_type:
-                self.maxid_by_type[_type] = 0
-            self.maxid_by_type[_type] = max(self.maxid_by_type[_type], intid)
+        with self.lock:
+            _id   = node['id']
+            _type = node['type']
+            if _id in self.id_to_node:
+                raise PaperError("Node with id '%s' already exists: %s" % (_id, yaml.dump(self.id_to_node[_id])))
+            if self._batch is not None and self._batch['state'] is None:
+                self._batch['added'][_id] = None
+            self.id_to_node[_id] = node
+            self._index_type_add(node)
+            self.touch(_id)
+            self.counts_by_type[_type] = self.counts_by_type.get(_type, 0) + 1
+            if _id[0:len(_type)+1] == _type+"-":
+                try:
+                    intid = int(_id[len(_type)+1:])
+                except ValueError:
+                    intid = 0
+                if not _type in self.maxid_by_type:
+                    self.maxid_by_type[_type] = 0
+                self.maxid_by_type[_type] = max(self.maxid_by_type[_type], intid)
 
     def _delete_node(self, to_delete):
-        pos_to_delete = list()
-        for pos in range(0,len(self.repo)):
-            node = self.repo[pos]
-            if node == to_delete or node['id'] == to_delete['id']:
-                pos_to_delete.append(pos)
-            else:
-                keys_to_delete = list()
-                for k,v in node.items():
-                    if type(v) == list:
-                        pos_to_delete2 = list()
-                        for i in range(0,len(v)):
-                            if v[i] == to_delete or (type(v[i]) == dict and 'id' in v[i] and v[i]['id'] == to_delete['id']):
-                                pos_to_delete2.append(i)
-                        pos_to_delete2.reverse()
-                        for i in pos_to_delete2:
-                            del v[i]
-                        if len(v) == 0:
-                            keys_to_delete.append(k)
-                    elif type(v) == dict:
-                        keys_to_delete2 = list()
-                        for k2,v2 in v.items():
-                            if v2 == to_delete or (type(v2) == dict and 'id' in v2 and v2['id'] == to_delete['id']):
-                                keys_to_delete2.append(v2)
-                        for k2 in keys_to_delete2:
-                            del v[k2]
-                        if len(v) == 0:
-                            keys_to_delete.append(k)
-                    elif v == to_delete or (type(v) == dict and 'id' in v and v['id'] == to_delete['id']):
-                        keys_to_delete.append(k)
-
-                for k in keys_to_delete:
-                    del node[k]
-        pos_to_delete.reverse()
-        for i in pos_to_delete:
-            del self.repo[i]
-
-        # recalculate counts and id_to_node
-        self.verify()
+        """Remove a node and all references to it."""
+        self._unlink_node(to_delete, None)
 
     def _replace_node(self, to_delete, replacement):
-        pos = 0
-        pos_to_delete = list()
-        for node in self.repo:
-            if node == to_delete:
-                pos_to_delete.append(pos)
-            else:
-                for k,v in node.items():
-                    if type(v) == list:
-                        for i in range(0,len(v)):
-                            if v[i] == to_delete:
-                                v[i] = replacement
-                    elif type(v) == dict:
-                        for k2,v2 in v.items():
-                            if v2 == to_delete:
-                                v[k2] = replacement
-                    elif v == to_delete:
-                        node[k] = v
-            pos += 1
-        pos_to_delete.reverse()
-        for i in pos_to_delete:
-            del self.repo[i]
-
-        # recalculate counts and id_to_node
-        self.verify()
+        """Remove a node, references to it now point to the replacement."""
+        self._unlink_node(to_delete, replacement)
+
+    def _unlink_node(self, to_delete, replacement):
+        """Only the nodes pointing to to_delete (as found in the backlinks) are visited."""
+        with self.lock:
+            _id = to_delete['id']
+            self._before_change(_id)
+            keys_by_source = {}
+            for source_id, k in self.backlinks(_id):
+                if source_id != _id:
+                    keys_by_source.setdefault(source_id, []).append(k)
+                    self._before_change(source_id)
+
+            for source_id, keys in keys_by_source.items():
+                node = self.id_to_node[source_id]
+                for k in keys:
+                    v = node.get(k)
+                    if type(v) == dict and v.get('id') == _id:
+                        if replacement is None:
+                            del node[k]
+                        else:
+                            node[k] = replacement
+                    elif type(v) == list:
+                        if replacement is None:
+                            v[:] = [ vv for vv in v if not (type(vv) == dict and vv.get('id') == _id) ]
+                            if len(v) == 0:
+                                del node[k]
+                        else:
+                            v[:] = [ replacement if type(vv) == dict and vv.get('id') == _id else vv for vv in v ]
+                self.touch(node)
+
+            node = self.id_to_node.pop(_id, None)
+            if node is not None:
+                _type = node['type']
+                self.counts_by_type[_type] -= 1
+                if self.counts_by_type[_type] == 0:
+                    del self.counts_by_type[_type]
+                if _type == 'file' and self.hashes.get(node.get('md5hash')) == _id:
+                    del self.hashes[node['md5hash']]
+                self._index_edges_remove(_id)
+                self._index_type_remove(_type, _id)
+                self._stale_digests.add(_id)
+            if self._journal is not None:
+                self._journal.delete(_id)
 
     def _base_node(self, _id, _type, text=None, date=None, note=None):
         node = { 'id' : _id, 'type' : _type }
@@ -450,51 +883,57 @@ class PaperRepo:
     ##############################################################################################
     # CLI helpers
     def get_nodes_by_type(self, _type):
-        """All nodes for a given type, this returns nodes not node ids."""
-        return [node for node in self.repo if node['type'] == _type ]
+        """All nodes for a given type, in the order they were added.
+
+        This returns a tuple of nodes (not node ids) that is cached until
+        a node of that type is added or removed."""
+        view = self._type_views.get(_type)
+        if view is None:
+            view = tuple(self._nodes_by_type.get(_type, {}).values())
+            self._type_views[_type] = view
+        return view
+
+    def topic_closure(self, topic):
+        """The ids of a topic and all the topics under it (through 'related-to'), depth-first.
+
+        The result is cached until the 'related-to' entries of a topic change."""
+        if type(topic) == dict:
+            topic = topic['id']
+        closure = self._topic_closure.get(topic)
+        if closure is None:
+            seen = set([ topic ])
+            closure = []
+            stack = [ topic ]
+            while stack:
+                topic_id = stack.pop()
+                closure.append(topic_id)
+                children = [ source_id for source_id, _ in self.backlinks(topic_id, 'related-to')
+                             if source_id not in seen and self.id_to_node[source_id]['type'] == 'topic' ]
+                seen.update(children)
+                stack.extend(reversed(children))
+            closure = tuple(closure)
+            self._topic_closure[topic] = closure
+        return closure
 
     def get_nodes_on_topic(self, topic):
         """All nodes for a given topic, including subtopics. This returns nodes not node ids."""  
         if type(topic) == str:
             topic = self.id_to_node[topic]
 
-        children = dict()
-        topics = self.get_nodes_by_type("topic")
-        for top in topics:
-            children[top['id']] = set([])
-        for top in topics:
-            if 'related-to' in top:
-                if type(top['related-to']) == str:
-                    children[top['related-to']].add(top['id'])
-                elif type(top['related-to']) == list:
-                    for t in top['related-to']:
-                        children[t['related-to']['id']].add(top['id'])
-                else:
-                    children[top['related-to']['id']].add(top['id'])
-
-        prev_len = 0
-        closure = children[ topic['id'] ]
-        while len(closure) > prev_len:
-            prev_len = len(closure)
-            for _id in list(closure):
-                closure.update(children[_id])
-        topic_ids = closure
-        topic_ids.add(topic['id'])
-        
         result = []
-        for node in self.repo:
-            if 'related-to' in node:
-                topics = node['related-to']
-                if type(topics) is dict:
-                    if topics['id'] in topic_ids:
-                        result.append(node)
-                elif topic_ids.intersection([ other['id'] for other in topics]):
-                    result.append(node)
+        seen = set()
+        for topic_id in self.topic_closure(topic):
+            for source_id, _ in self.backlinks(topic_id, 'related-to'):
+                if source_id not in seen:
+                    seen.add(source_id)
+                    result.append(self.id_to_node[source_id])
         return result
 
-    def register_file(self, path_to_file):
+    def register_file(self, path_to_file, strategy='copy'):
         """
         Register the file and create a node for it. Returns the newly created node.
+        The strategy to put the file into the file repository is one of 'copy', 'move', 'hardlink'
+        or 'reflink', see FileRepo.register_file. In a batch, a moved file is deleted when the batch ends.
         """
         if not os.path.exists(path_to_file):
             raise PaperError("File '%s' not found" % (path_to_file,))
@@ -502,16 +941,26 @@ class PaperRepo:
         if not self.file_repo:
             raise PaperError("File repository not defined.")
 
-        node_or_key = self.file_repo.register_file(path_to_file, self.hashes)
+        staged = self.file_repo.stage_file(path_to_file, strategy)
+        try:
+            with self.lock:
+                return self._register_staged(staged, strategy)
+        except BaseException:
+            self.file_repo.discard_staged(staged)
+            raise
+
+    def _register_staged(self, staged, strategy, content=None):
+        """Second half of register_file, content is the text of the file if it was already extracted."""
+        node_or_key = self.file_repo.store_file(staged, self.hashes, strategy=strategy,
+                                                processed=self._batch['unlinks'] if self._batch is not None else None)
         if len(node_or_key) == 1:
             key = node_or_key['id']
             raise PaperError("File already registered, key: '%s'" % (key,))
         else:
             node = node_or_key
-        if self.search_index:
-            self.search_index.index_content(node['id'],
-                                            self.file_repo.get_absolute_path_to_file(node['number']),
-                                            node['mimetype'])
+        if self._batch is not None:
+            self._batch['new_files'].append(node['number'])
+        self._index_file(node, content)
         
         self._new_node(node)
         self.hashes[node['md5hash']] = node['id']
@@ -519,38 +968,54 @@ class PaperRepo:
         
         return node
 
-    def process_folder(self, path_to_folder):
+    def process_folder(self, path_to_folder, jobs=1, strategy='move'):
         """
         All files in folder are registered and a list of nodes for them is returned.
-        The files are deleted after registration.
+        The files are deleted after registration. By default they are hardlinked into the file
+        repository (copied if in another device) and deleted once registered, see register_file
+        for the other strategies.
+        With jobs > 1, hashing, copying and text extraction run in that many worker processes,
+        while ids, the model and the index writes are still handled by this process.
         """
         if not os.path.exists(path_to_folder):
             raise PaperError("Folder '%s' not found" % (path_to_folder,))
 
+        # only process files in the folder, no subfolders
+        _, _, files = next(os.walk(path_to_folder))
+        return self.process_files([ os.path.join(path_to_folder, _file) for _file in files ],
+                                  jobs=jobs, strategy=strategy)
+
+    def process_files(self, paths, jobs=1, strategy='move'):
+        """
+        As process_folder, for a list of paths to files. All the files are registered in one batch,
+        so the files are only deleted once the model is saved; if the process dies before, they are
+        left in place, see batch.
+        """
         if not self.file_repo:
             raise PaperError("File repository not defined.")
         
-        nodes_or_keys = self.file_repo.process_folder(path_to_folder, self.hashes)
-
         result = list()
-
-        changed = False
-        for node_or_key in nodes_or_keys:
-            if len(node_or_key) == 1:
-                key = node_or_key['id']
-                node = self.id_to_node[key]
-            else:
-                node = node_or_key
-                # hashes updated by file_repo
-                if self.search_index:
-                    self.search_index.index_content(node['id'],
-                                                    self.file_repo.get_absolute_path_to_file(node['number']),
-                                                    node['mimetype'])
-                self._new_node(node)
-                changed = True
-            result.append(node)
-        if changed:
-            self.auto_save()
+        with self.batch():
+            self._batch['jobs'] = max(self._batch['jobs'], jobs)
+            nodes_or_keys = self.file_repo.process_files(paths, self.hashes,
+                                                         processed=self._batch['unlinks'], jobs=jobs,
+                                                         strategy=strategy)
+
+            changed = False
+            for node_or_key in nodes_or_keys:
+                if len(node_or_key) == 1:
+                    key = node_or_key['id']
+                    node = self.id_to_node[key]
+                else:
+                    node = node_or_key
+                    # hashes updated by file_repo
+                    self._batch['new_files'].append(node['number'])
+                    self._index_file(node)
+                    self._new_node(node)
+                    changed = True
+                result.append(node)
+            if changed:
+                self.auto_save()
         
         return result
 
@@ -558,34 +1023,27 @@ class PaperRepo:
         """
         Delete a given file_id, also from disk.
         """
-        if self.file_repo:
+        if not self.file_repo:
             raise PaperError("File repository not defined.")
 
-        del self.hashes[self.id_to_node[file_id]['md5hash']]
-        self._delete_node(self.id_to_node[file_id])
-        self.file_repo.delete_file(file_id)
-        if self.search_index:
-            self.search_index.delete(file_id)
-        self.auto_save()
+        with self.lock:
+            self._delete_node(self.id_to_node[file_id])
+            self._remove_file(file_id)
+            self.auto_save()
         
     def replace_file(self, file_id, path_to_file):
         """
         Delete a given file_id, also from disk, register a new file and change its references to it.
         """
-        if self.file_repo:
+        if not self.file_repo:
             raise PaperError("File repository not defined.")
         
-        replacement = self.register_file(path_to_file)
-        self._replace_node(self.id_to_node[file_id], replacement)
-        self.hashes[replacement['md5hash']] = replacement['id']
-        
-        self.file_repo.delete_file(file_id)
-        if self.search_index:
-            self.search_index.delete(file_id)
-            self.search_index.index_content(replacement['id'],
-                                            self.file_repo.get_absolute_path_to_file(replacement['number']),
-                                            replacement['mimetype'])            
-        self.auto_save()
+        # register_file also indexes the new file, written together with the deletion
+        with self.lock, self._index_many():
+            replacement = self.register_file(path_to_file)
+            self._replace_node(self.id_to_node[file_id], replacement)
+            self._remove_file(file_id)
+            self.auto_save()
 
         return replacement
 
@@ -606,12 +1064,11 @@ class PaperRepo:
         return self._enhance_results(self.search_index.similarto(node['id'], limit, numterms))
 
     def _enhance_results(self, results):
-        all_papers = self.get_nodes_by_type('artifact')
         for idx, fileid in enumerate(results):
             paper = { 'id': "", 'text': "" }
-            for node in all_papers:
-                if 'on-disk' in node and ((type(node['on-disk']) is str and node['on-disk'] == fileid) or
-                                              (type(node['on-disk']) is dict and node['on-disk']['id'] == fileid)):
+            for source_id, _ in self.backlinks(fileid, 'on-disk'):
+                node = self.id_to_node[source_id]
+                if node['type'] == 'artifact':
                     paper = { 'id': node['id'], 'text': node.get('text', "") }
             results[idx] = { 'file'  : { 'id' : fileid, 'text' : self.id_to_node[fileid].get('text', "") }
                            , 'paper' : paper }
@@ -676,12 +1133,114 @@ class PaperRepo:
                 raise PaperError('Type "%s" can\'t be used as a context' % (search_or_paper['type']))
         self.default_context = search_or_paper
 
-    def reindex(self):
+    def reindex(self, jobs=1, multisegment=False):
+        """
+        Trigger a reindexing process. With jobs > 1, the text is extracted by that many worker
+        processes, see SearchIndex.refresh. Packed and compressed files are decompressed to temporary
+        copies, deleted afterwards.
+        """
+        with self.lock, self.file_repo.temporary_copies():
+            all_files = self.get_nodes_by_type('file')
+            self.search_index.refresh(all_files, self.file_repo, jobs=jobs, multisegment=multisegment)
+
+    def reconcile_index(self, jobs=1):
+        """
+        Update the search index to the files in the model, indexing only the files missing from it or
+        whose hash changed and deleting documents of files no longer there, see SearchIndex.reconcile.
+        Returns the number of documents 'added', 'deleted' and 'changed'.
+        self.lock is only held to compare the model and the index and to write, not while extracting
+        the texts, so the model can be changed while it runs in the background.
+        """
+        if not self.search_index:
+            raise PaperError("Search index not initialized.")
+        with self.file_repo.temporary_copies():
+            return self.search_index.reconcile(lambda: [ dict(node) for node in self.get_nodes_by_type('file') ],
+                                               self.file_repo, jobs=jobs, lock=self.lock)
+
+    def fsck(self, quick=False, jobs=1):
+        """
+        Check the files in the file repository against their hashes, see FileRepo.fsck.
+        Returns a dictionary with the file ids 'missing' from disk and with 'corrupt' contents, the
+        'orphan' paths in the file repository not in the model and the number of files 'checked'
+        and 'skipped' (with quick, files unchanged since registered or last checked are not hashed).
+        """
+        if not self.file_repo:
+            raise PaperError("File repository not defined.")
+
+        expected = { node['number']: node for node in self.get_nodes_by_type('file') if 'number' in node }
+        result = self.file_repo.fsck(expected, quick=quick, jobs=jobs)
+        number_to_id = lambda number: expected[number]['id'] if number in expected else 'file-%d' % (number,)
+        result['missing'] = list(map(number_to_id, result['missing']))
+        result['corrupt'] = list(map(number_to_id, result['corrupt']))
+        return result
+
+    # asynchronous counterparts of the slow methods, for event loops such as Jupyter's. The work runs
+    # in the default executor of the loop and changes to the model are serialized through self.lock,
+    # which the methods changing the model and batches hold as well, as should code editing node
+    # dictionaries directly (up to calling touch) while they run. asyncio is imported
+    # in each of them, as importing it is slow and scripts do not need it.
+
+    async def aregister_file(self, path_to_file, strategy='copy'):
         """
-        Trigger a reindexing process.
+        As register_file, without blocking the event loop. The file is hashed, copied and its text
+        extracted before taking the lock, only the new node is added while holding it.
         """
-        all_files = self.get_nodes_by_type('file')
-        self.search_index.refresh(all_files, self.file_repo)
+        if not os.path.exists(path_to_file):
+            raise PaperError("File '%s' not found" % (path_to_file,))
+
+        if not self.file_repo:
+            raise PaperError("File repository not defined.")
+
+        import asyncio
+        loop = asyncio.get_running_loop()
+        staged = await loop.run_in_executor(None, self.file_repo.stage_file, path_to_file, strategy)
+        try:
+            content = None
+            if self.search_index and staged['md5hash'] not in self.hashes:
+                content = await loop.run_in_executor(None, self.search_index.extract,
+                                                     path_to_file, staged['mimetype'], staged['md5hash'])
+            return await loop.run_in_executor(None, self._locked, self._register_staged, staged, strategy, content)
+        except BaseException:
+            self.file_repo.discard_staged(staged)
+            raise
+
+    async def aprocess_folder(self, path_to_folder, jobs=1, strategy='move'):
+        """As process_folder, without blocking the event loop."""
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, self._locked, self.process_folder,
+                                                                path_to_folder, jobs, strategy)
+
+    async def asearch(self, query_str, limit=20):
+        """As search, without blocking the event loop."""
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, self._locked, self.search, query_str, limit)
+
+    async def asimilarto(self, fileid, limit=20, numterms=50):
+        """As similarto, without blocking the event loop."""
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, self._locked, self.similarto,
+                                                                fileid, limit, numterms)
+
+    def _locked(self, function, *args):
+        with self.lock:
+            return function(*args)
+
+    def _hashes_from_manifest(self):
+        """verify() gives a random hash to files without md5hash, use the one in the file manifest instead."""
+        unhashed = [ node for node in self.get_nodes_by_type('file') if 'md5hash' not in node and 'number' in node ]
+        if not unhashed:
+            return
+        manifest = self.file_repo.manifest()
+        id_to_hash = { file_id: md5hash for md5hash, file_id in self.hashes.items() }
+        for node in unhashed:
+            entry = manifest.get(node['number'])
+            if entry is None or entry['md5hash'] in self.hashes:
+                continue
+            print("Using hash from the file manifest for {}".format(node['id']))
+            self.hashes.pop(id_to_hash.get(node['id']), None)
+            self.hashes[entry['md5hash']] = node['id']
+            node['md5hash'] = entry['md5hash']
+            self.touch(node)
         
     # all these would be easier using **kwargs but I want to have the method signature to serve
     # as documentation for the users
@@ -807,6 +1366,7 @@ class PaperRepo:
         if type(paper) == str:
             paper = self.id_to_node[paper]
         paper_id = paper['id']
+        self._before_change(reading_list['id'])
         if not 'artifacts' in reading_list:
             reading_list['artifacts'] = []
         artifacts = reading_list['artifacts']
@@ -816,6 +1376,7 @@ class PaperRepo:
                 artifacts.insert(0, paper)
             else:
                 artifacts.append(paper)
+            self.touch(reading_list)
             self.auto_save()
 
         return reading_list
@@ -878,6 +1439,7 @@ class PaperRepo:
             relation['source'] = paper
             relation['target'] = []
             self._new_node(relation)
+        self._before_change(relation['id'])
 
         for other in papers:
             if type(other) == str:
@@ -885,10 +1447,69 @@ class PaperRepo:
 
             relation['target'].append(other)
 
+        self.touch(relation)
         self.auto_save()
         return relation
 
 
+def node_edges(node):
+    """The (key, target id) pairs for the nodes referenced by a node."""
+    edges = []
+    for k, v in node.items():
+        if type(v) == dict:
+            if 'id' in v:
+                edges.append((k, v['id']))
+        elif type(v) == list:
+            for vv in v:
+                if type(vv) == dict and 'id' in vv:
+                    edges.append((k, vv['id']))
+    return edges
+
+
+class _RepoNodes(Sequence):
+    """The nodes of a PaperRepo in the order they were added, read from its id_to_node. Indexing walks
+    the nodes from the closest end, so loop over the view rather than over its indices; slices are
+    lists built once."""
+
+    def __init__(self, paper):
+        self._paper = paper
+
+    def __len__(self):
+        return len(self._paper.id_to_node)
+
+    def __iter__(self):
+        return iter(self._paper.id_to_node.values())
+
+    def __reversed__(self):
+        return reversed(self._paper.id_to_node.values())
+
+    def __getitem__(self, index):
+        nodes = self._paper.id_to_node.values()
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(nodes))
+            if step < 0:
+                return list(nodes)[index]
+            return list(itertools.islice(nodes, start, stop, step))
+        if index < -len(nodes) or index >= len(nodes):
+            raise IndexError("node index out of range")
+        if index < 0:
+            return next(itertools.islice(reversed(nodes), -index - 1, None))
+        return next(itertools.islice(nodes, index, None))
+
+    def index(self, value, start=0, stop=None):
+        start, stop, _ = slice(start, stop).indices(len(self))
+        for idx, node in itertools.islice(enumerate(self), start, stop):
+            if node is value or node == value:
+                return idx
+        raise ValueError("node not in repo")
+
+    def __eq__(self, other):
+        return list(self) == (list(other) if isinstance(other, _RepoNodes) else other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 # list of nodes with jquery style magic
 
 class NodeList(list):
@@ -1,9 +1,6 @@
 import sys
 
-from .paper_repo   import PaperRepo
-from .materializer import materialize
-from .paper_bibtex import generate_bibtex
-from .code2py      import process_lines
+# each command imports only what it needs, to keep startup fast
 
 
 def cli():
@@ -12,12 +9,62 @@ def cli():
     else:
         code = sys.argv[1]
     if code == 'materialize':
+        from .paper_repo   import PaperRepo
+        from .materializer import materialize
         p = PaperRepo(sys.argv[2], sys.argv[3])
         materialize(p, sys.argv[4])
     elif code == 'bibtex':
+        from .paper_repo   import PaperRepo
+        from .paper_bibtex import generate_bibtex
         p = PaperRepo(sys.argv[2], sys.argv[3])
         generate_bibtex(p, sys.argv[4])
+    elif code == 'fsck':
+        from .paper_repo   import PaperRepo
+        quick = '--quick' in sys.argv
+        jobs = int(sys.argv[sys.argv.index('--jobs') + 1]) if '--jobs' in sys.argv else 1
+        p = PaperRepo(sys.argv[2], sys.argv[3])
+        result = p.fsck(quick=quick, jobs=jobs)
+        for problem in [ 'missing', 'corrupt', 'orphan' ]:
+            for entry in result[problem]:
+                print("{}: {}".format(problem, entry))
+        print("{} files checked, {} skipped".format(result['checked'], result['skipped']))
+        if result['missing'] or result['corrupt'] or result['orphan']:
+            sys.exit(1)
+    elif code == 'reindex':
+        from .paper_repo   import PaperRepo
+        from .search_index import SearchIndex, throughput
+        jobs = int(sys.argv[sys.argv.index('--jobs') + 1]) if '--jobs' in sys.argv else 1
+        # opened without index, to rebuild it only once
+        p = PaperRepo(sys.argv[2], sys.argv[3])
+        cache = sys.argv[sys.argv.index('--cache') + 1] if '--cache' in sys.argv else None
+        p.search_index = SearchIndex(sys.argv[4], cache)
+        if '--incremental' in sys.argv:
+            result = p.reconcile_index(jobs=jobs)
+            print("{} added, {} deleted, {} changed".format(result['added'], result['deleted'], result['changed']))
+        else:
+            p.reindex(jobs=jobs, multisegment='--multisegment' in sys.argv)
+        print("{} files indexed".format(p.search_index.size()))
+        for name, figures in throughput().items():
+            print("{}: {} files, {:.1f} files/s, {:.2f} MB/s".format(
+                name, figures['files'], figures['files_per_second'], figures['bytes_per_second'] / 1e6))
+    elif code == 'watch':
+        import signal
+        from .paper_repo     import PaperRepo
+        from .folder_watcher import FolderWatcher
+        jobs = int(sys.argv[sys.argv.index('--jobs') + 1]) if '--jobs' in sys.argv else 1
+        interval = float(sys.argv[sys.argv.index('--interval') + 1]) if '--interval' in sys.argv else 5.0
+        p = PaperRepo(data_folder=sys.argv[2], auto_save=True, index_jobs=jobs)
+        watcher = FolderWatcher(p, sys.argv[3], interval=interval, jobs=jobs, polling='--polling' in sys.argv)
+        # stop like with Ctrl-C, a batch in progress is rolled back
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
     elif code == 'code2py':
+        from .code2py      import process_lines
         print("\n".join(process_lines(sys.stdin, render=True)))
     else:
         print("""papercli usage:
@@ -26,6 +73,12 @@ def cli():
 
   papercli bibtex yaml filerepo citingrel
 
+  papercli fsck yaml filerepo [--quick] [--jobs N]
+
+  papercli reindex yaml filerepo index [--jobs N] [--multisegment] [--cache textcache] [--incremental]
+
+  papercli watch datafolder inbox [--jobs N] [--interval seconds] [--polling]
+
   papercly code2py < notes
 """)
 
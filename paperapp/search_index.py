@@ -1,31 +1,54 @@
+import atexit
+import contextlib
 import hashlib
 import shutil
 import datetime
 import os
-import io
+import signal
+import threading
+import time
 
-import pypandoc
-import pdftotext
-import textract
+from . import PaperError
+from .text_cache import TextCache
 
-from magic import detect_from_content
-
-from whoosh import index
-from whoosh.filedb.filestore import FileStorage
-from whoosh.fields   import Schema, TEXT, KEYWORD, ID, STORED
-from whoosh.qparser  import QueryParser
+# whoosh, the extractors (pypandoc, pdftotext, textract) and magic are
+# imported when first needed, they come from the 'fulltext' extra and are
+# slow to import
 
 
 # search index
 class SearchIndex:
-    def __init__(self, index_folder):
+
+    WRITER_TIMEOUT = 60.0 # seconds to wait for another writer, such as a reconciliation in the background
+    MAX_SEGMENTS = 8 # bulk writes merge the index into one segment past this many, see optimize
+    UNEXTRACTED = 'unextracted' # stored as the hash of notes about texts not extracted, so reconcile retries them
+
+    def __init__(self, index_folder, cache_folder=None, isolated=False):
+        """A whoosh index over the text of the files. With a cache_folder, extracted texts are kept
+        there by MD5 hash (see TextCache) and reused when reindexing. With isolated, texts are always
+        extracted in worker processes, see extract_texts."""
+        try:
+            from whoosh.filedb.filestore import FileStorage
+            from whoosh.fields   import Schema, TEXT, ID
+        except ImportError as e:
+            raise PaperError("The search index needs the 'fulltext' extra (pip install paperapp_DrDub[fulltext]): {}".format(e))
+
         self.storage = FileStorage(index_folder)
 
         if not self.storage.index_exists():
             schema = Schema(fileid=ID(stored=True),
-                            content=TEXT(stored=True))
+                            content=TEXT(stored=True),
+                            md5hash=ID(stored=True))
             self.storage.create_index(schema)
         self.index = self.storage.open_index()
+        if 'md5hash' not in self.index.schema:
+            # indexes made before hashes were stored, their documents are taken as up to date
+            with self.index.writer() as writer:
+                writer.add_field('md5hash', ID(stored=True))
+            self.index = self.storage.open_index()
+        self.text_cache = TextCache(cache_folder) if cache_folder else None
+        self._buffer = None # writes buffered by index_many
+        self.isolated = isolated
 
     def size(self):
         return self.index.doc_count()
@@ -35,46 +58,198 @@ class SearchIndex:
             for docnum, doc in reader.iter_docs():
                 yield doc['fileid']
 
-    def index_content(self, fileid, path_to_file, mimetype):
-        """Index one file.
+    def indexed_files(self):
+        """The indexed fileids and their stored MD5 hashes (None for documents indexed without one,
+        UNEXTRACTED for notes about a missing extractor or a timeout), as a list of pairs, a fileid
+        appears more than once if it was indexed more than once."""
+        with self.index.reader() as reader:
+            return [ (doc['fileid'], doc.get('md5hash')) for docnum, doc in reader.iter_docs() ]
+
+    def index_content(self, fileid, path_to_file, mimetype, content=None, md5hash=None):
+        """Index one file, content is its text if it was already extracted.
         """
-        with self.index.writer() as writer:
-            self._index_content(fileid, path_to_file, mimetype, writer)
+        if self._buffer is not None:
+            self._buffer['to_index'].append((fileid, path_to_file, mimetype, md5hash))
+            if content is not None:
+                self._buffer['contents'][fileid] = content
+            return
+        with self.index.writer(timeout=self.WRITER_TIMEOUT) as writer:
+            self._index_content(fileid, path_to_file, mimetype, writer, content, md5hash)
         
     def delete(self, fileid):
         """Delete one file.
         """
-        with self.index.searcher() as searcher:
-            docnum = searcher.document_number(fileid=fileid)
-        with self.index.writer() as writer:
-            writer.delete_document(docnum)
-        
-    def _index_content(self, fileid, path_to_file, mimetype, writer):
+        if self._buffer is not None:
+            self._buffer['to_index'] = [ t for t in self._buffer['to_index'] if t[0] != fileid ]
+            self._buffer['to_delete'].append(fileid)
+            return
+        with self.index.writer(timeout=self.WRITER_TIMEOUT) as writer:
+            writer.delete_by_term('fileid', fileid)
+
+    @contextlib.contextmanager
+    def index_many(self, jobs=1):
+        """Buffer the calls to index_content and delete, ``with index.index_many(): ...``, and write
+        them at the end of the block with a single writer and commit (see update). If an exception
+        is raised, the buffered writes are dropped (reconcile brings the index up to date). Nested
+        blocks write when the outermost one ends.
+        """
+        if self._buffer is not None:
+            yield
+            return
+        self._buffer = { 'to_index' : [], 'to_delete' : [], 'contents' : {} }
+        try:
+            yield
+            buffer = self._buffer
+        finally:
+            self._buffer = None
+        if buffer['to_index'] or buffer['to_delete']:
+            self.update(buffer['to_index'], buffer['to_delete'], jobs=jobs, contents=buffer['contents'])
+
+    def update(self, to_index, to_delete, jobs=1, contents=None):
+        """Delete and index several files with a single writer.
+
+        to_index is a list of (fileid, path_to_file, mimetype, md5hash) tuples, to_delete a list of
+        fileids and contents maps fileids to texts already extracted. With jobs > 1, the text is
+        extracted by that many worker processes. The segments are merged afterwards if there are
+        too many, see optimize.
+        """
+        contents = dict(contents) if contents else {}
+        missing = [ t for t in to_index if t[0] not in contents ]
+        if jobs > 1 and len(missing) > 1:
+            # extract before opening the writer, it locks the index
+            contents.update(zip([ t[0] for t in missing ],
+                                self._extract_all([ t[1] for t in missing ], [ t[2] for t in missing ],
+                                                  [ t[3] for t in missing ], jobs)))
+        with self.index.writer(timeout=self.WRITER_TIMEOUT) as writer:
+            for fileid in to_delete:
+                writer.delete_by_term('fileid', fileid)
+            for fileid, path_to_file, mimetype, md5hash in to_index:
+                self._index_content(fileid, path_to_file, mimetype, writer, contents.get(fileid), md5hash)
+        self.optimize()
+
+    def segments(self):
+        """Number of segments in the index, each write without merging adds one."""
+        with self.index.reader() as reader:
+            return len(list(reader.leaf_readers()))
+
+    def optimize(self, force=False):
+        """Merge the index into a single segment, if it has more than MAX_SEGMENTS or if forced.
+        Searches get slower with the number of segments, whoosh only merges the smaller ones when
+        committing. Returns whether the segments were merged."""
+        if not force and self.segments() <= self.MAX_SEGMENTS:
+            return False
+        self.index.optimize()
+        return True
+
+    def _index_content(self, fileid, path_to_file, mimetype, writer, content=None, md5hash=None):
         """Index one file.
         """
-        if not mimetype in EXTRACTORS:
-            content="Missing extractor for {}".format(mimetype)
-        else:
-            with open(path_to_file, 'rb') as f:
-                document_bytes = f.read()
-            magic = detect_from_content(document_bytes)
-            
-            content = EXTRACTORS[mimetype](path_to_file, document_bytes, magic)
-        writer.add_document(fileid=fileid, content=content)
+        if content is None:
+            content = self.extract(path_to_file, mimetype, md5hash)
+        writer.add_document(**_document(fileid, content, md5hash))
+
+    def extract(self, path_to_file, mimetype, md5hash=None):
+        """The text of a file, from the cache if its md5hash is given and it was extracted before."""
+        return next(self._extract_all([ path_to_file ], [ mimetype ], [ md5hash ]))
+
+    def _extract_all(self, paths, mimetypes, md5hashes, jobs=1):
+        """As extract_texts, going to the cache first and adding to it what had to be extracted."""
+        if self.text_cache is None:
+            yield from extract_texts(paths, mimetypes, jobs, self.isolated)
+            return
+        keys = [ extractor_key(mimetype) if md5hash else None for mimetype, md5hash in zip(mimetypes, md5hashes) ]
+        cached = [ self.text_cache.get(md5hash, key) if key else None for md5hash, key in zip(md5hashes, keys) ]
+        misses = [ idx for idx, content in enumerate(cached) if content is None ]
+        extracted = _extract_texts([ paths[idx] for idx in misses ], [ mimetypes[idx] for idx in misses ], jobs,
+                                   self.isolated)
+        for idx, content in enumerate(cached):
+            if content is None:
+                content, extractor = next(extracted)
+                # kept under the extractor that did the work, notes about missing extractors are not
+                if md5hashes[idx] and extractor is not None and extractor.key() is not None:
+                    self.text_cache.put(md5hashes[idx], extractor.key(), content)
+            yield content
         
-    def refresh(self, all_files, file_repo):
-        """Extract the text from all the files in the repository, purging existing repo."""
+    def refresh(self, all_files, file_repo, jobs=1, multisegment=False):
+        """Extract the text from all the files in the repository, purging existing repo. Texts in the
+        cache are not extracted again.
+
+        With jobs > 1, the text is extracted by that many worker processes while a single writer
+        adds the documents as they arrive, in order. With multisegment as well, whoosh's
+        multiprocessing writer is used, each job writing its own segment without merging them,
+        otherwise the index is left as a single segment.
+        """
+        paths = [ file_repo.get_absolute_path_to_file(node['number']) for node in all_files ]
         with self.index.reader() as reader:
             docids = list(reader.all_doc_ids())
-        with self.index.writer() as writer:
+        if multisegment and jobs > 1:
+            writer = self.index.writer(procs=jobs, multisegment=True)
+        else:
+            writer = self.index.writer()
+        with writer:
             for docid in docids:
                 writer.delete_document(docid)
 
-            for node in all_files:
-                self._index_content(node['id'],
-                                    file_repo.get_absolute_path_to_file(node['number']),
-                                    node['mimetype'],
-                                    writer)
+            contents = self._extract_all(paths, [ node['mimetype'] for node in all_files ],
+                                         [ node.get('md5hash') for node in all_files ], jobs)
+            for node, content in zip(all_files, contents):
+                writer.add_document(**_document(node['id'], content, node.get('md5hash')))
+        self.optimize(force=not (multisegment and jobs > 1))
+
+    def reconcile(self, all_files, file_repo, jobs=1, lock=None):
+        """Bring the index in line with the files in the repository without rebuilding it: documents of
+        files not in all_files are deleted, missing files are indexed and files whose MD5 hash is not
+        the one stored in the index are indexed again. Returns the number of documents 'added',
+        'deleted' and 'changed'.
+
+        With a lock (the one serializing changes to the model), all_files is a function returning the
+        files, called holding it. The texts are extracted without holding the lock and the files
+        compared again holding it before writing, so the model can change meanwhile: only what is
+        still out of date is written.
+        """
+        if lock is None:
+            lock, get_files = contextlib.nullcontext(), lambda: all_files
+        else:
+            get_files = all_files
+        with lock:
+            deleted, changed, to_index = self._out_of_date(get_files(), file_repo)
+        if not (to_index or deleted or changed):
+            return { 'added' : 0, 'deleted' : 0, 'changed' : 0 }
+        # the text is extracted before opening the writer, so other writers wait only for the writes
+        contents = dict(zip([ (t[0], t[3]) for t in to_index ],
+                            self._extract_all([ t[1] for t in to_index ], [ t[2] for t in to_index ],
+                                              [ t[3] for t in to_index ], jobs)))
+        with lock:
+            deleted, changed, to_index = self._out_of_date(get_files(), file_repo)
+            with self.index.writer(timeout=self.WRITER_TIMEOUT) as writer:
+                for fileid in deleted + changed:
+                    writer.delete_by_term('fileid', fileid)
+                for fileid, path_to_file, mimetype, md5hash in to_index:
+                    self._index_content(fileid, path_to_file, mimetype, writer,
+                                        contents.get((fileid, md5hash)), md5hash)
+        self.optimize()
+        return { 'added' : len(to_index) - len(changed), 'deleted' : len(deleted), 'changed' : len(changed) }
+
+    def _out_of_date(self, all_files, file_repo):
+        """The fileids to delete and to index again and the (fileid, path_to_file, mimetype, md5hash)
+        tuples to index for reconcile, the files to index again come last."""
+        nodes = { node['id'] : node for node in all_files }
+        indexed = {}
+        duplicated = set()
+        for fileid, md5hash in self.indexed_files():
+            if fileid in indexed:
+                duplicated.add(fileid)
+            indexed[fileid] = md5hash
+        deleted = [ fileid for fileid in indexed if fileid not in nodes ]
+        changed = [ fileid for fileid, md5hash in indexed.items() if fileid in nodes and
+                    (fileid in duplicated or md5hash is not None and md5hash != nodes[fileid].get('md5hash')) ]
+        added = [ fileid for fileid in nodes if fileid not in indexed ]
+        to_index = [ (fileid,
+                      file_repo.get_absolute_path_to_file(nodes[fileid]['number']),
+                      nodes[fileid]['mimetype'],
+                      nodes[fileid].get('md5hash'))
+                     for fileid in added + changed ]
+        return deleted, changed, to_index
 
     def similarto(self, fileid, top=20, numterms=50):
         with self.index.searcher() as searcher:
@@ -83,6 +258,8 @@ class SearchIndex:
             return list(map(lambda hit:hit['fileid'], results))
                 
     def search(self, query_str, limit=20):
+        from whoosh.qparser import QueryParser
+
         qp = QueryParser('content', schema=self.index.schema)
         query = qp.parse(query_str)
         
@@ -98,6 +275,13 @@ class SearchIndex:
             else:
                 return "File {} not in index!".format(fileid)
 
+def _document(fileid, content, md5hash):
+    if isinstance(content, _Note):
+        md5hash = SearchIndex.UNEXTRACTED
+    if md5hash is None:
+        return { 'fileid' : fileid, 'content' : content }
+    return { 'fileid' : fileid, 'content' : content, 'md5hash' : md5hash }
+
 def text_only_wrapper(text):
     if type(text) is not str:
         if type(text) is bytes:
@@ -110,31 +294,334 @@ def text_only_wrapper(text):
             text = str(text)
     return text
 
+def extract_text(path_to_file, mimetype, isolated=False):
+    """The text of a file, or a note about the missing extractor."""
+    return next(extract_texts([ path_to_file ], [ mimetype ], isolated=isolated))
+
+def extract_texts(paths, mimetypes, jobs=1, isolated=False):
+    """The texts of several files, in order, as they are consumed.
+
+    With jobs > 1, or with isolated, they are extracted by jobs worker processes (see
+    extraction_pool), where extractors that hang are stopped after their timeout and crashes do
+    not take this process with them. Otherwise they are extracted in this process, without
+    timeouts. The workers import the __main__ module again, so scripts using them must keep their
+    top-level code under ``if __name__ == '__main__':``."""
+    for content, extractor in _extract_texts(paths, mimetypes, jobs, isolated):
+        yield content
+
+class _Note(str):
+    """A note standing for the text of a file that could not be extracted."""
+    pass
+
+def _extract(path_to_file, mimetype):
+    """The text of a file and the extractor that produced it, None with a note if none did. When
+    the package of an extractor is missing, its fallback is used."""
+    extractor = EXTRACTORS.get(mimetype)
+    if extractor is None:
+        return _Note("Missing extractor for {}".format(mimetype)), None
+
+    from magic import detect_from_filename
+
+    magic = detect_from_filename(path_to_file) # libmagic reads only the start of the file
+
+    error = None
+    while extractor is not None:
+        try:
+            return _with_timeout(extractor.timeout, extractor.function, path_to_file, magic), extractor
+        except ImportError as e:
+            error = e
+            extractor = extractor.fallback
+        except _Timeout:
+            return _Note("Extraction timed out for {} after {} seconds".format(mimetype, extractor.timeout)), None
+    return _Note("Missing extractor for {}: {}".format(mimetype, error)), None
+
+def _timed_extract(path_to_file, mimetype):
+    # run in the worker processes, the extractor is sent back by name
+    start = time.perf_counter()
+    content, extractor = _extract(path_to_file, mimetype)
+    return content, extractor.name if extractor else None, time.perf_counter() - start
+
+def _extract_texts(paths, mimetypes, jobs=1, isolated=False):
+    """As extract_texts, with the extractor used for each text (None if there was none). The time
+    taken is added to the throughput of the extractors."""
+    if not paths:
+        return
+    if jobs <= 1 and not isolated:
+        results = ( _timed_extract(path_to_file, mimetype) for path_to_file, mimetype in zip(paths, mimetypes) )
+        for path_to_file, (content, name, seconds) in zip(paths, results):
+            yield content, _account(name, path_to_file, seconds)
+        return
+
+    from concurrent.futures.process import BrokenProcessPool
+
+    futures = [ extraction_pool(jobs).submit(_timed_extract, path_to_file, mimetype)
+                for path_to_file, mimetype in zip(paths, mimetypes) ]
+    try:
+        for path_to_file, future in zip(paths, futures):
+            try:
+                content, name, seconds = future.result()
+            except BrokenProcessPool:
+                shutdown_extraction_pool() # a worker died, the next call starts new ones
+                raise
+            yield content, _account(name, path_to_file, seconds)
+    finally:
+        for future in futures: # if abandoned or failed, the workers stay for the next call
+            future.cancel()
+
+def _account(name, path_to_file, seconds):
+    extractor = _BY_NAME.get(name)
+    if extractor is not None:
+        extractor.files += 1
+        extractor.bytes += os.path.getsize(path_to_file)
+        extractor.seconds += seconds
+    return extractor
+
+def extraction_pool(jobs=1):
+    """A pool of at least jobs worker processes for text extraction, kept between calls so the
+    workers have the extractors already imported. Extractors that hang or crash (see Extractor) do
+    not take this process with them. Asking for more jobs than the pool has replaces it, as does
+    shutdown_extraction_pool.
+
+    The workers are started by a fork server (spawned where there is none), not forked from this
+    process, which may have threads running. They import this module and the __main__ module
+    anew: changes to EXTRACTORS made here do not reach them, and scripts must keep their
+    top-level code under ``if __name__ == '__main__':`` or it runs again in each worker."""
+    global _POOL
+    jobs = max(jobs, 1)
+    if _POOL is not None and _POOL[0] < jobs:
+        shutdown_extraction_pool()
+    if _POOL is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _POOL = (jobs, ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context(method),
+                                           initializer=_init_worker))
+    return _POOL[1]
+
+def shutdown_extraction_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL[1].shutdown()
+        _POOL = None
+
+_POOL = None # (jobs, executor)
+atexit.register(shutdown_extraction_pool)
+
+_IN_WORKER = False # set in the worker processes of the extraction pool
+
+def _init_worker():
+    global _IN_WORKER
+    _IN_WORKER = True
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp() # the programs started by the extractors go in the group of the worker, see _kill_children
+
+class _Timeout(Exception):
+    pass
+
+def _with_timeout(timeout, function, *args):
+    """Call function, raising _Timeout after timeout seconds. This relies on SIGALRM, so the
+    timeout only applies in the worker processes of the extraction pool, where extraction runs in
+    the main thread; elsewhere function is just called. Programs started by the extractor are
+    stopped when it times out."""
+    if not timeout or not _IN_WORKER or not hasattr(signal, 'setitimer') or \
+       threading.current_thread() is not threading.main_thread():
+        return function(*args)
+
+    def expired(signum, frame):
+        _kill_children()
+        raise _Timeout()
+
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return function(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def _kill_children():
+    """Terminate the programs started by this worker process, they are in its process group."""
+    if not hasattr(os, 'killpg') or os.getpgrp() != os.getpid():
+        return # not in a group of its own, see _init_worker
+    previous = signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        os.killpg(os.getpgrp(), signal.SIGTERM)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+def extractor_key(mimetype):
+    """Name and version of the extractor for a mimetype, None if there is none installed. The
+    version is that of the package doing the work, looked up without importing it."""
+    extractor = EXTRACTORS.get(mimetype)
+    while extractor is not None:
+        if extractor.key() is not None:
+            return extractor.key()
+        extractor = extractor.fallback
+    return None
+
+def throughput():
+    """What each extractor did in this process (work done in worker processes included): a dictionary
+    from extractor name to the number of 'files', their 'bytes', the 'seconds' it took and the
+    resulting 'files_per_second' and 'bytes_per_second'."""
+    result = {}
+    for name, extractor in sorted(_BY_NAME.items()):
+        if extractor.files:
+            result[name] = { 'files'            : extractor.files,
+                             'bytes'            : extractor.bytes,
+                             'seconds'          : extractor.seconds,
+                             'files_per_second' : extractor.files / extractor.seconds if extractor.seconds else 0.0,
+                             'bytes_per_second' : extractor.bytes / extractor.seconds if extractor.seconds else 0.0 }
+    return result
+
+
+class Extractor:
+
+    def __init__(self, name, function, package=None, version=None, timeout=60, fallback=None):
+        """A way to get the text of files of a mimetype, see EXTRACTORS.
+
+        function is called with the path to the file and the magic detected for it. package is the
+        distribution doing the work, whose version goes into the key of the text cache, or None for
+        code in this module, versioned by version instead. If the package is missing (function
+        raises ImportError), the fallback extractor is used. Files taking more than timeout seconds
+        are given up in the worker processes (see extract_texts), stopping the programs started for
+        them. The files, bytes and seconds extracted are added up, see throughput.
+        """
+        self.name     = name
+        self.function = function
+        self.package  = package
+        self.version  = version
+        self.timeout  = timeout
+        self.fallback = fallback
+        self.files    = 0
+        self.bytes    = 0
+        self.seconds  = 0.0
+        self._key     = False # computed when first needed
+
+    def key(self):
+        """The name and version, None if the package is not installed."""
+        if self._key is False:
+            if self.package is None:
+                self._key = "{}-{}".format(self.name, self.version)
+            else:
+                try:
+                    from importlib.metadata import version
+                    self._key = "{}-{}".format(self.name, version(self.package))
+                except Exception: # not installed, or python < 3.8
+                    self._key = None
+        return self._key
+
+    def __call__(self, filename, magic):
+        return self.function(filename, magic)
+
+# extractors are called with the path to the file and the magic detected for it. The in-process
+# ones (python-docx, python-pptx, openpyxl, lxml) avoid starting a program per file, they fall
+# back to pandoc and textract if their package is missing
+
 def pandoc_wrapper(input_format):
-    return lambda filename, content, magic: text_only_wrapper(pypandoc.convert_file(filename, 'plain', format=input_format))
+    def extractor(filename, magic):
+        import pypandoc
+        return text_only_wrapper(pypandoc.convert_file(filename, 'plain', format=input_format))
+    return extractor
 
-def pdf_extractor(filename, content, magic):
-    return text_only_wrapper("\n\n".join(pdftotext.PDF(io.BytesIO(content))))
+def pdf_extractor(filename, magic):
+    import pdftotext
+    with open(filename, 'rb') as f:
+        return text_only_wrapper("\n\n".join(pdftotext.PDF(f)))
 
 def textractor_wrapper(extension):
-    return lambda filename, content, magic: text_only_wrapper(textract.process(filename, extension=extension))
+    def extractor(filename, magic):
+        import textract
+        return text_only_wrapper(textract.process(filename, extension=extension))
+    return extractor
+
+def text_extractor(filename, magic):
+    with open(filename, 'rb') as f:
+        return text_only_wrapper(str(f.read(), encoding=magic.encoding))
+
+def docx_extractor(filename, magic):
+    import docx
+    document = docx.Document(filename)
+    lines = [ paragraph.text for paragraph in document.paragraphs ]
+    for table in document.tables:
+        for row in table.rows:
+            lines.append("\t".join(cell.text for cell in row.cells))
+    return "\n".join(lines)
+
+def pptx_extractor(filename, magic):
+    import pptx
+    lines = []
+    for slide in pptx.Presentation(filename).slides:
+        for shape in slide.shapes:
+            if shape.has_text_frame:
+                lines.append(shape.text_frame.text)
+        lines.append("")
+    return "\n".join(lines)
+
+def xlsx_extractor(filename, magic):
+    import openpyxl
+    workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    lines = []
+    try:
+        for sheet in workbook.worksheets:
+            for row in sheet.iter_rows(values_only=True):
+                cells = [ str(cell) for cell in row if cell is not None ]
+                if cells:
+                    lines.append("\t".join(cells))
+    finally:
+        workbook.close()
+    return "\n".join(lines)
+
+def odt_extractor(filename, magic):
+    import zipfile
+    from lxml import etree
+    with zipfile.ZipFile(filename) as odt:
+        root = etree.fromstring(odt.read('content.xml'))
+    text = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+    return "\n".join("".join(element.itertext()) for element in root.iter(text + 'h', text + 'p'))
+
+def html_extractor(filename, magic):
+    import lxml.html
+    root = lxml.html.parse(filename).getroot()
+    if root is None:
+        return ""
+    for element in root.xpath('//script|//style'):
+        element.drop_tree()
+    return text_only_wrapper(root.text_content())
+
+def xml_extractor(filename, magic):
+    from lxml import etree
+    root = etree.parse(filename, etree.XMLParser(recover=True)).getroot()
+    if root is None:
+        return ""
+    return "\n".join(text.strip() for text in root.itertext() if text.strip())
+
+def _textract(extension, timeout=120):
+    return Extractor('textract-' + extension, textractor_wrapper(extension), package='textract', timeout=timeout)
 
-def text_extractor(filename, content, magic):
-    return text_only_wrapper(str(content, encoding=magic.encoding))
-        
 EXTRACTORS = {
-    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': pandoc_wrapper("docx"),
-    'application/msword': textractor_wrapper('doc'),
-    'application/pdf': pdf_extractor,
-    'application/vnd.oasis.opendocument.text': textractor_wrapper('odt'),
-    'application/vnd.openxmlformats-officedocument.presentationml.presentation': textractor_wrapper('pptx'),
-    'application/vnd.ms-powerpoint': textractor_wrapper('ppt'),
-    'text/rtf': textractor_wrapper('rtf'),
-    'application/postscript': textractor_wrapper('ps'),
-    'application/vnd.ms-excel': textractor_wrapper('xls'),
-    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': textractor_wrapper('xlsx'),
-    'text/html': textractor_wrapper('html'),
-    'text/xml': textractor_wrapper('html'),
-    'text/plain': text_extractor
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+        Extractor('python-docx', docx_extractor, package='python-docx', timeout=60,
+                  fallback=Extractor('pandoc-docx', pandoc_wrapper("docx"), package='pypandoc', timeout=120)),
+    'application/msword': _textract('doc'),
+    'application/pdf': Extractor('pdftotext', pdf_extractor, package='pdftotext', timeout=120),
+    'application/vnd.oasis.opendocument.text':
+        Extractor('lxml-odt', odt_extractor, package='lxml', timeout=60, fallback=_textract('odt')),
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation':
+        Extractor('python-pptx', pptx_extractor, package='python-pptx', timeout=60, fallback=_textract('pptx')),
+    'application/vnd.ms-powerpoint': _textract('ppt'),
+    'text/rtf': _textract('rtf'),
+    'application/postscript': _textract('ps', timeout=300),
+    'application/vnd.ms-excel': _textract('xls'),
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
+        Extractor('openpyxl', xlsx_extractor, package='openpyxl', timeout=120, fallback=_textract('xlsx')),
+    'text/html': Extractor('lxml-html', html_extractor, package='lxml', timeout=30, fallback=_textract('html')),
+    'text/xml': Extractor('lxml-xml', xml_extractor, package='lxml', timeout=30, fallback=_textract('html')),
+    'text/plain': Extractor('text', text_extractor, version=1, timeout=30)
 }
 
+_BY_NAME = {} # extractor name -> extractor, for the names sent back by the worker processes
+for _extractor in EXTRACTORS.values():
+    while _extractor is not None:
+        _BY_NAME[_extractor.name] = _extractor
+        _extractor = _extractor.fallback
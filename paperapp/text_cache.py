@@ -0,0 +1,48 @@
+import io
+import os
+import tempfile
+
+from .compression import SUFFIXES, default_codec, compress_file, open_compressed
+
+
+# extracted texts, so reindexing does not run the extractors again
+class TextCache:
+
+    def __init__(self, cache_folder):
+        """Texts extracted from files, compressed, keyed by the MD5 hash of the file and the
+        extractor (name and version) that produced them.
+
+        Texts are stored in ``<first two digits of the hash>/<hash>-<extractor><suffix>``, with
+        the suffix of their codec (see compression). As the contents of a file never change, an
+        entry only becomes stale when the extractor changes, and then it is not found anymore.
+        """
+        self.cache_folder = cache_folder
+        self.codec = default_codec()
+
+    def get(self, md5hash, extractor):
+        """The cached text, or None."""
+        for suffix in SUFFIXES.values():
+            path = self._path(md5hash, extractor, suffix)
+            if os.path.exists(path):
+                try:
+                    with open_compressed(path) as f:
+                        return f.read().decode('utf-8')
+                except Exception:
+                    return None # written by a codec not installed here, or damaged
+        return None
+
+    def put(self, md5hash, extractor, text):
+        path = self._path(md5hash, extractor, SUFFIXES[self.codec])
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(prefix='.incoming-', dir=folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                compress_file(io.BytesIO(text.encode('utf-8')), f, self.codec)
+            os.replace(tmp_file, path)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+
+    def _path(self, md5hash, extractor, suffix):
+        return os.path.join(self.cache_folder, md5hash[:2], "{}-{}{}".format(md5hash, extractor, suffix))
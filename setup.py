@@ -27,7 +27,14 @@ setuptools.setup(
             'Whoosh-2.7.4',
             'pypandoc>=1.5',
             'pdftotext>=2.1.5',
-            'textract>=1.6.3'
+            'textract>=1.6.3',
+            'python-docx>=0.8.10',
+            'python-pptx>=0.6.18',
+            'openpyxl>=3.0.0',
+            'lxml>=4.5.0'
+            ],
+        'compression' : [
+            'zstandard>=0.15.0'
             ]
         },
     tests_require=['pytest'],
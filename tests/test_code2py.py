@@ -45,7 +45,8 @@ in a Java method, from bytecodes as features.
 """
         lines = process_lines(text.split("\n"), file_folder=os.path.dirname(__file__))
         print("\n".join(lines))
-        assert len(lines) == 25
+        assert len(lines) == 29
+        assert lines[0] == "with p.batch():"
 
         with tempfile.TemporaryDirectory("pytest") as data_folder:
             p = PaperRepo(data_folder=data_folder, auto_save=True)
@@ -56,6 +57,13 @@ in a Java method, from bytecodes as features.
             assert locals()['p3']['text'] == p['paper-3']['text']
             assert p.text(p['paper-1']['id'])
 
+            # a failing line leaves no batch open
+            lines = process_lines([ "p4", "T Unfinished -- Duboue -- 2020", "S new", "O missing.pdf" ], file_folder=data_folder)
+            with pytest.raises(PaperError):
+                exec("\n".join(lines) + "\n")
+            assert p._batch is None
+            assert 'paper-4' not in p
+
             
         
         
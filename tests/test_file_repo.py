@@ -0,0 +1,257 @@
+import pytest
+import tempfile
+import hashlib
+import os
+
+from paperapp.file_repo import FileRepo
+from paperapp.pack_store import PackStore
+
+class TestFileRepo:
+
+    def test_register_file(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            content = b"Some text spanning several chunks\n" * 100
+            original = os.path.join(data_folder, 'a.txt')
+            with open(original, 'wb') as f:
+                f.write(content)
+
+            file_repo = FileRepo(file_folder)
+            file_repo.CHUNK_SIZE = 64
+            file_repo.HEADER_SIZE = 200
+            hashes = {}
+            new_file = file_repo.register_file(original, hashes)
+            assert new_file['id'] == 'file-0'
+            assert new_file['md5hash'] == hashlib.md5(content).hexdigest()
+            assert new_file['mimetype'] == 'text/plain'
+            assert hashes == { new_file['md5hash'] : 'file-0' }
+            with open(os.path.join(file_folder, '0', '0', '0', '0'), 'rb') as f:
+                assert f.read() == content
+
+            # duplicates are not copied
+            assert file_repo.register_file(original, hashes) == { 'id' : 'file-0' }
+            assert [ f for f in os.listdir(file_folder) if f.startswith('.incoming') ] == []
+
+    def test_allocator(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            paths = []
+            for i in range(4):
+                paths.append(os.path.join(data_folder, '%d.txt' % (i,)))
+                with open(paths[-1], 'w') as f:
+                    f.write("File %d" % (i,))
+
+            file_repo = FileRepo(file_folder)
+            hashes = {}
+            assert [ file_repo.register_file(path, hashes)['id'] for path in paths[:3] ] == [ 'file-0', 'file-1', 'file-2' ]
+            file_repo.delete_file('file-1')
+            del hashes[ [ k for k, v in hashes.items() if v == 'file-1' ][0] ]
+
+            # the allocator is persisted, the lowest free number is reused
+            file_repo = FileRepo(file_folder)
+            assert file_repo.register_file(paths[3], hashes)['id'] == 'file-1'
+            assert file_repo.register_file(paths[1], hashes)['id'] == 'file-3'
+
+            # without allocator, the free numbers are found from the hashes
+            os.unlink(os.path.join(file_folder, FileRepo.ALLOCATOR_FILE))
+            file_repo = FileRepo(file_folder)
+            file_repo.delete_file('file-2')
+            del hashes[ [ k for k, v in hashes.items() if v == 'file-2' ][0] ]
+            assert file_repo.register_file(paths[2], dict(hashes))['id'] == 'file-2'
+
+    def test_paths(self):
+        with tempfile.TemporaryDirectory("pytest") as file_folder:
+            file_repo = FileRepo(file_folder)
+            assert file_repo._number_to_file(12345) == os.path.join('5', '4', '3', '21')
+            assert file_repo._number_to_file(7) == os.path.join('7', '0', '0', '0')
+            with pytest.raises(Exception):
+                file_repo.get_absolute_path_to_file('file-12345')
+            assert os.listdir(file_folder) == [] # lookups do not create directories
+            assert file_repo._number_to_new_file(12345) == os.path.join('5', '4', '3', '21')
+            assert os.path.isdir(os.path.join(file_folder, '5', '4', '3'))
+
+    def test_strategies(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            file_repo = FileRepo(file_folder)
+            hashes = {}
+            for strategy in FileRepo.STRATEGIES:
+                original = os.path.join(data_folder, strategy + '.txt')
+                with open(original, 'w') as f:
+                    f.write("Registered with " + strategy)
+                if strategy == 'hardlink':
+                    os.chmod(original, 0o444)
+                inode = os.stat(original).st_ino
+                new_file = file_repo.register_file(original, hashes, strategy=strategy)
+                path = file_repo.get_absolute_path_to_file(new_file['id'])
+                with open(path) as f:
+                    assert f.read() == "Registered with " + strategy
+                assert os.stat(path).st_mode & 0o777 == 0o444
+                assert os.path.exists(original) == (strategy != 'move')
+                assert (os.stat(path).st_ino == inode) == (strategy in [ 'move', 'hardlink' ])
+
+            # files that are not read-only are copied, so they stay writable
+            original = os.path.join(data_folder, 'writable.txt')
+            with open(original, 'w') as f:
+                f.write("Writable")
+            os.chmod(original, 0o644)
+            new_file = file_repo.register_file(original, hashes, strategy='hardlink')
+            assert os.stat(original).st_mode & 0o777 == 0o644
+            assert os.stat(file_repo.get_absolute_path_to_file(new_file['id'])).st_ino != os.stat(original).st_ino
+            with pytest.raises(Exception):
+                file_repo.register_file(original, hashes, strategy='symlink')
+
+    def test_process_folder_moves(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            file_folder = os.path.join(data_folder, 'files')
+            drop_folder = os.path.join(data_folder, 'drop')
+            os.mkdir(file_folder)
+            os.mkdir(drop_folder)
+            for name in [ 'a.txt', 'b.txt', 'c.txt' ]:
+                with open(os.path.join(drop_folder, name), 'w') as f:
+                    f.write("same" if name != 'b.txt' else "other")
+            inodes = { os.stat(os.path.join(drop_folder, name)).st_ino for name in os.listdir(drop_folder) }
+
+            file_repo = FileRepo(file_folder)
+            result = file_repo.process_folder(drop_folder, {})
+            assert len(set(node['id'] for node in result)) == 2
+            assert os.listdir(drop_folder) == []
+            # renamed, not copied
+            assert set(os.stat(file_repo.get_absolute_path_to_file(node['id'])).st_ino for node in result) <= inodes
+
+    def test_fsck(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            file_repo = FileRepo(file_folder)
+            hashes = {}
+            paths = []
+            for i in range(5):
+                paths.append(os.path.join(data_folder, '%d.txt' % (i,)))
+                with open(paths[-1], 'w') as f:
+                    f.write("File %d" % (i,))
+                file_repo.register_file(paths[-1], hashes)
+            file_repo.delete_file(4)
+
+            manifest = FileRepo(file_folder).manifest()
+            assert sorted(manifest) == [ 0, 1, 2, 3 ]
+            assert hashes[manifest[2]['md5hash']] == 'file-2'
+            assert manifest[2]['mimetype'] == 'text/plain'
+            assert manifest[2]['size'] == len("File 2")
+
+            result = file_repo.fsck(jobs=2)
+            assert result == { 'missing' : [], 'corrupt' : [], 'orphan' : [], 'checked' : 4, 'skipped' : 0 }
+
+            os.unlink(file_repo.get_absolute_path_to_file(0))
+            path = file_repo.get_absolute_path_to_file(1)
+            os.chmod(path, 0o644)
+            with open(path, 'w') as f:
+                f.write("Bit rot")
+            os.makedirs(os.path.join(file_folder, '9', '0', '0'))
+            with open(os.path.join(file_folder, '9', '0', '0', '0'), 'w') as f:
+                f.write("Stray")
+            result = FileRepo(file_folder).fsck(quick=True)
+            assert result['missing'] == [ 0 ]
+            assert result['corrupt'] == [ 1 ]
+            assert result['orphan'] == [ os.path.join('9', '0', '0', '0') ]
+            assert result['checked'] == 1 and result['skipped'] == 2
+
+            # files known to the caller are added to the manifest
+            os.unlink(os.path.join(file_folder, FileRepo.MANIFEST_FILE))
+            expected = { 2 : { 'md5hash' : manifest[2]['md5hash'], 'mimetype' : 'text/plain' } }
+            result = FileRepo(file_folder).fsck(expected)
+            assert result['orphan'] == [ os.path.join(d, '0', '0', '0') for d in [ '1', '3', '9' ] ]
+            assert list(FileRepo(file_folder).manifest()) == [ 2 ]
+
+    def test_packs(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            file_repo = FileRepo(file_folder, pack_threshold=100)
+            file_repo.packs.PACK_SIZE = 30
+            hashes = {}
+            contents = [ "Small file %d" % (i,) for i in range(4) ] + [ "Large file " * 20 ]
+            nodes = []
+            for i, content in enumerate(contents):
+                path = os.path.join(data_folder, '%d.txt' % (i,))
+                with open(path, 'w') as f:
+                    f.write(content)
+                nodes.append(file_repo.register_file(path, hashes, strategy='move'))
+                assert not os.path.exists(path)
+            assert nodes[0]['mimetype'] == 'text/plain'
+            assert sorted(os.listdir(os.path.join(file_folder, '.packs'))) == [ 'index', 'pack-0', 'pack-1' ]
+            assert not os.path.exists(os.path.join(file_folder, '0', '0', '0', '0'))
+            assert os.path.exists(os.path.join(file_folder, '4', '0', '0', '0'))
+
+            file_repo = FileRepo(file_folder) # packed files are found without threshold
+            for node, content in zip(nodes, contents):
+                assert file_repo.read_file(node['id']) == content.encode('utf-8')
+                with open(file_repo.get_absolute_path_to_file(node['id'])) as f:
+                    assert f.read() == content
+            assert os.stat(file_repo.get_absolute_path_to_file(1)).st_mode & 0o777 == 0o444
+            assert file_repo.fsck(quick=True)['skipped'] == 5
+            assert file_repo.fsck() == { 'missing' : [], 'corrupt' : [], 'orphan' : [], 'checked' : 5, 'skipped' : 0 }
+
+            file_repo.delete_file('file-1')
+            with pytest.raises(Exception):
+                file_repo.get_absolute_path_to_file('file-1')
+            assert 1 not in FileRepo(file_folder).packs
+
+    def test_compression(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            file_repo = FileRepo(file_folder, compress=True)
+            content = "A line of text that repeats.\n" * 1000
+            original = os.path.join(data_folder, 'a.txt')
+            with open(original, 'w') as f:
+                f.write(content)
+            new_file = file_repo.register_file(original, {})
+            assert new_file['md5hash'] == hashlib.md5(content.encode('utf-8')).hexdigest()
+            stored = file_repo._stored_file(0)
+            assert stored.endswith(('.zst', '.gz'))
+            assert os.path.getsize(stored) < len(content) / 10
+
+            file_repo = FileRepo(file_folder)
+            with file_repo.open_file('file-0') as f:
+                assert f.read(11) == b"A line of t"
+            assert file_repo.read_file(0) == content.encode('utf-8')
+            path = file_repo.get_absolute_path_to_file(0)
+            with open(path) as f:
+                assert f.read() == content
+            assert file_repo.fsck() == { 'missing' : [], 'corrupt' : [], 'orphan' : [], 'checked' : 1, 'skipped' : 0 }
+            assert file_repo.fsck(quick=True)['skipped'] == 1
+            assert file_repo.analyze_file(0)['md5hash'] == new_file['md5hash']
+            assert file_repo.stored_path(0) is None
+
+            # copies made in a temporary_copies block are deleted when it ends, earlier ones are kept
+            with file_repo.temporary_copies():
+                assert file_repo.get_absolute_path_to_file(0) == path
+            assert os.path.exists(path)
+            file_repo.clear_cache()
+            with file_repo.temporary_copies():
+                with open(file_repo.get_absolute_path_to_file(0)) as f:
+                    assert f.read() == content
+            assert not os.path.exists(path)
+
+            file_repo.delete_file(0)
+            assert not os.path.exists(stored)
+            assert not os.path.exists(path)
+
+    def test_packs_shared(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            pack_folder = os.path.join(data_folder, 'packs')
+            first, second = PackStore(pack_folder), PackStore(pack_folder)
+            contents = {}
+            for number, packs in enumerate([ first, second, first, second ]):
+                path = os.path.join(data_folder, '%d.txt' % (number,))
+                contents[number] = ("File %d " % (number,) * (number + 1)).encode('utf-8')
+                with open(path, 'wb') as f:
+                    f.write(contents[number])
+                packs.add(number, path)
+            packs = PackStore(pack_folder)
+            for number, content in contents.items():
+                assert packs.read(number) == content
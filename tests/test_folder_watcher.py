@@ -0,0 +1,71 @@
+import pytest
+import tempfile
+import threading
+import time
+import os
+
+from paperapp                import PaperError
+from paperapp.paper_repo     import PaperRepo
+from paperapp.folder_watcher import FolderWatcher
+
+class TestFolderWatcher:
+
+    def test_scan_and_ingest(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            inbox = os.path.join(data_folder, 'inbox')
+            os.makedirs(os.path.join(inbox, 'sub'))
+            p = PaperRepo(data_folder=data_folder, auto_save=True)
+            watcher = FolderWatcher(p, inbox, settle=2.0, polling=True)
+
+            for name in [ 'a.txt', os.path.join('sub', 'b.txt'), 'c.txt.part', '.hidden' ]:
+                with open(os.path.join(inbox, name), 'w') as f:
+                    f.write("Contents of " + name)
+            assert watcher.scan(now=100) == []
+            assert watcher.scan(now=101) == []
+            ready = watcher.scan(now=102)
+            assert ready == [ os.path.join(inbox, 'a.txt'), os.path.join(inbox, 'sub', 'b.txt') ]
+
+            nodes = watcher.ingest(ready)
+            assert [ node['text'] for node in nodes ] == [ 'a.txt', 'b.txt' ]
+            assert sorted(os.listdir(inbox)) == [ '.hidden', 'c.txt.part', 'sub' ]
+            assert os.listdir(os.path.join(inbox, 'sub')) == []
+            assert PaperRepo(data_folder=data_folder).counts_by_type['file'] == 2
+
+            # a file still changing is not ready
+            path = os.path.join(inbox, 'd.txt')
+            with open(path, 'w') as f:
+                f.write("Start")
+            assert watcher.scan(now=200) == []
+            with open(path, 'a') as f:
+                f.write(", more")
+            os.utime(path, ns=(0, 1))
+            assert watcher.scan(now=203) == []
+            assert watcher.scan(now=205) == [ path ]
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            inbox = os.path.join(data_folder, 'inbox')
+            os.mkdir(inbox)
+            p = PaperRepo(data_folder=data_folder, auto_save=True)
+            watcher = FolderWatcher(p, inbox, settle=0.1, interval=0.05)
+
+            def drop():
+                time.sleep(0.1)
+                os.mkdir(os.path.join(inbox, 'new'))
+                with open(os.path.join(inbox, 'new', 'a.txt'), 'w') as f:
+                    f.write("Dropped")
+            thread = threading.Thread(target=drop)
+            thread.start()
+            deadline = time.time() + 10
+            while 'file-0' not in p and time.time() < deadline:
+                watcher.run(cycles=2)
+            thread.join()
+            watcher.close()
+            assert 'file-0' in p
+            assert not os.path.exists(os.path.join(inbox, 'new', 'a.txt'))
+
+    def test_missing_inbox(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            p = PaperRepo(data_folder=data_folder)
+            with pytest.raises(PaperError):
+                FolderWatcher(p, os.path.join(data_folder, 'inbox'))
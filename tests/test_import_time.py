@@ -0,0 +1,32 @@
+import sys
+import os.path
+import subprocess
+
+# modules from the optional extras, or slow to import, that must not be
+# loaded unless a search index, extraction or a bibtex import is used
+DEFERRED = [ 'whoosh', 'pypandoc', 'pdftotext', 'textract', 'magic', 'bibtexparser', 'jinja2' ]
+
+def imported_modules(code):
+    """Top-level names of the modules imported by running code, using python -X importtime."""
+    result = subprocess.run([ sys.executable, '-X', 'importtime', '-c', code ],
+                            cwd=os.path.join(os.path.dirname(__file__), '..'),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    modules = set()
+    for line in result.stderr.split("\n"):
+        if line.startswith('import time:') and not 'imported package' in line:
+            modules.add(line.split('|')[-1].strip().split('.')[0])
+    return modules
+
+class TestImportTime:
+
+    def test_library_import(self):
+        modules = imported_modules("import paperapp.paper_repo, paperapp.paper_bibtex, paperapp.code2py")
+        assert 'paperapp' in modules
+        for module in DEFERRED:
+            assert module not in modules
+
+    def test_cli_import(self):
+        modules = imported_modules("import paperapp.papercli")
+        for module in DEFERRED + [ 'yaml' ]:
+            assert module not in modules
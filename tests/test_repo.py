@@ -1,9 +1,21 @@
 import pytest
+import pickle
+import tempfile
+import subprocess
+import sys
 import os.path
 
-from paperapp            import PaperError
+from paperapp            import PaperError, PaperValidationError
 from paperapp.paper_repo import PaperRepo
 
+class Opener:
+    # unpickling it creates a file
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return (open, (self.path, 'w'))
+
 class TestRepo:
 
     def test_empty(self):
@@ -49,4 +61,349 @@ class TestRepo:
         p['paper-620']['lecture'] = p.new_node(None, 'lecture', 'Test')
         p.verify()
         
+    def test_journal(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            yaml_file = os.path.join(data_folder, 'paper-model.yaml')
+            p = PaperRepo(yaml_file, auto_save=True, journal=True)
+            p.checkpoint()
+            topic = p.new_topic(None, 'Vision')
+            paper = p.new_paper(None, 'Hubel', related_to=topic)
+            rl = p.new_reading_list(None, 'To read', paper)
+            paper['status'] = 'read'
+            p.touch(paper)
+            p.auto_save()
+            assert os.path.exists(yaml_file + '.journal')
+
+            p2 = PaperRepo(yaml_file)
+            assert p2['paper-1']['status'] == 'read'
+            assert p2['paper-1']['related-to'] is p2['topic-1']
+            assert p2['reading-list-1']['artifacts'][0] is p2['paper-1']
+
+            p.checkpoint()
+            assert not os.path.exists(yaml_file + '.journal')
+            p3 = PaperRepo(yaml_file)
+            assert p3['paper-1']['status'] == 'read'
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            yaml_file = os.path.join(data_folder, 'paper-model.yaml')
+            with open(os.path.join(os.path.dirname(__file__), 'paper-default-types.yaml')) as src:
+                with open(yaml_file, 'w') as dst:
+                    dst.write(src.read())
+            p = PaperRepo(yaml_file)
+            assert not os.path.exists(yaml_file + '.snapshot') # only for data folders, unless asked
+            p = PaperRepo(yaml_file, snapshot=True)
+            assert os.path.exists(yaml_file + '.snapshot')
+
+            p2 = PaperRepo(yaml_file, snapshot=True)
+            assert p2['paper-620']['bibtex'] == p2['fehlhaber2014hubel']
+            assert p2.counts_by_type == p.counts_by_type
+            assert p2.hashes == p.hashes
+
+            # stale and corrupt snapshots are ignored
+            p2['paper-620']['status'] = 'read'
+            p2.save(yaml_file)
+            assert PaperRepo(yaml_file, snapshot=True)['paper-620']['status'] == 'read'
+            with open(yaml_file + '.snapshot', 'wb') as f:
+                f.write(b'garbage')
+            assert PaperRepo(yaml_file, snapshot=True)['paper-620']['status'] == 'read'
+
+            # the pickle is not loaded unless the header matches the YAML file
+            marker = os.path.join(data_folder, 'unpickled')
+            with open(yaml_file + '.snapshot', 'wb') as f:
+                f.write(b'{"version": 1, "key": [0, 0, ""]}\n')
+                f.write(pickle.dumps(Opener(marker)))
+            assert PaperRepo(yaml_file, snapshot=True)['paper-620']['status'] == 'read'
+            assert not os.path.exists(marker)
+
+            with tempfile.TemporaryDirectory("pytest") as other_folder:
+                PaperRepo(data_folder=other_folder, auto_save=True).new_topic(None, 'Vision')
+                assert PaperRepo(data_folder=other_folder)['topic-1']['text'] == 'Vision'
+                assert os.path.exists(os.path.join(other_folder, 'paper-model.yaml.snapshot'))
+
+    def test_verify_reports_all_errors(self):
+        p = PaperRepo(os.path.join(os.path.dirname(__file__),  'paper-default-types.yaml'))
+        p['paper-620']['lecture'] = 'Test'
+        p['paper-620']['related-to'] = p['fehlhaber2014hubel']
+        with pytest.raises(PaperValidationError) as e:
+            p.verify()
+        assert len(e.value.errors) == 2
+
+    def test_nodes_by_type(self):
+        p = PaperRepo()
+        t1 = p.new_topic(None, 'Vision')
+        t2 = p.new_topic(None, 'Language')
+        paper = p.new_paper(None, 'Hubel', related_to=t1)
+        topics = p.get_nodes_by_type('topic')
+        assert topics == (t1, t2)
+        assert p.get_nodes_by_type('topic') is topics
+        assert p.get_nodes_by_type('lecture') == ()
+
+        t3 = p.new_topic(None, 'Speech')
+        assert p.get_nodes_by_type('topic') == (t1, t2, t3)
+        p._delete_node(t2)
+        assert p.get_nodes_by_type('topic') == (t1, t3)
+        assert p.get_nodes_by_type('artifact') == (paper,)
+
+    def test_backlinks(self):
+        p = PaperRepo()
+        topic = p.new_topic(None, 'Vision')
+        paper1 = p.new_paper(None, 'Hubel', related_to=topic)
+        paper2 = p.new_paper(None, 'Wiesel', related_to=[topic])
+        rl = p.new_reading_list(None, 'To read', paper1, related_to=topic)
+        assert p.backlinks(topic) == [ ('paper-1', 'related-to'), ('paper-2', 'related-to'),
+                                       ('reading-list-1', 'related-to') ]
+        assert p.backlinks('paper-1', 'artifacts') == [ ('reading-list-1', 'artifacts') ]
+        assert p.backlinks(paper2) == []
+
+        p.add_to_reading_list(rl, paper2)
+        assert p.backlinks(paper2) == [ ('reading-list-1', 'artifacts') ]
+
+        # direct edits are picked up by touch
+        del paper1['related-to']
+        p.touch(paper1)
+        assert len(p.backlinks(topic)) == 2
+
+    def test_delete_and_replace(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            p = PaperRepo(file_folder=file_folder)
+            for name in [ 'a.txt', 'b.txt' ]:
+                with open(os.path.join(data_folder, name), 'w') as f:
+                    f.write("Contents of " + name)
+            topic = p.new_topic(None, 'Vision')
+            old_file = p.register_file(os.path.join(data_folder, 'a.txt'))
+            paper1 = p.new_paper(None, 'Hubel', on_disk=old_file, related_to=topic)
+            paper2 = p.new_paper(None, 'Wiesel', related_to=[topic])
+
+            new_file = p.replace_file(old_file['id'], os.path.join(data_folder, 'b.txt'))
+            assert paper1['on-disk'] is new_file
+            assert old_file['id'] not in p
+            assert old_file['md5hash'] not in p.hashes
+            assert p.backlinks(new_file) == [ (paper1['id'], 'on-disk') ]
+
+            nodes = p.repo
+            p._delete_node(topic)
+            assert 'related-to' not in paper1
+            assert 'related-to' not in paper2
+            assert 'topic' not in p.counts_by_type
+            assert p.repo == [ paper1, paper2, new_file ]
+            assert p.repo[1] is paper2 and p.repo[-1] is new_file and p.repo[-3] is paper1
+            assert p.repo[1:] == [ paper2, new_file ] and p.repo[::-2] == [ new_file, paper1 ]
+            assert p.repo.index(new_file) == 2
+            with pytest.raises(IndexError):
+                p.repo[3]
+
+            p.delete_file(new_file['id'])
+            assert 'on-disk' not in paper1
+            assert nodes == [ paper1, paper2 ] # follows the changes
+            p.verify()
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            yaml_file = os.path.join(data_folder, 'paper-model.yaml')
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            with open(os.path.join(data_folder, 'a.txt'), 'w') as f:
+                f.write("Contents of a")
+            p = PaperRepo(yaml_file, file_folder=file_folder, auto_save=True)
+            topic = p.new_topic(None, 'Vision')
+
+            with p.batch():
+                paper = p.new_paper(None, 'Hubel', related_to=topic)
+                assert len(PaperRepo(yaml_file).repo) == 1 # not saved yet
+            assert 'paper-1' in PaperRepo(yaml_file)
+
+            with pytest.raises(PaperError):
+                with p.batch():
+                    p.new_paper(None, 'Wiesel', related_to=topic)
+                    new_file = p.register_file(os.path.join(data_folder, 'a.txt'))
+                    p._delete_node(p['paper-1'])
+                    raise PaperError("Abort")
+            assert 'paper-2' not in p
+            assert new_file['id'] not in p
+            assert not p.hashes
+            assert not os.path.exists(os.path.join(file_folder, '0', '0', '0', '0'))
+            assert p.backlinks('topic-1') == [ ('paper-1', 'related-to') ]
+            assert p.get_nodes_by_type('artifact') == (p['paper-1'],)
+
+    def test_batch_nested(self):
+        p = PaperRepo()
+        topic = p.new_topic(None, 'Vision')
+        with pytest.raises(PaperError):
+            with p.batch():
+                p.new_paper(None, 'Hubel', related_to=topic)
+                try:
+                    with p.batch():
+                        p.new_paper(None, 'Wiesel')
+                        raise PaperError("Abort")
+                except PaperError:
+                    pass
+                p.new_paper(None, 'Marr')
+        assert p._batch is None
+        assert p.get_nodes_by_type('artifact') == ()
+        assert p.backlinks(topic) == []
+
+        # only new nodes: nothing is copied, they are removed
+        with pytest.raises(PaperError):
+            with p.batch():
+                p.new_paper(None, 'Hubel', related_to=topic)
+                p.new_paper(None, 'Wiesel', related_to=topic)
+                assert p._batch['state'] is None
+                raise PaperError("Abort")
+        assert [ node['id'] for node in p.repo ] == [ 'topic-1' ]
+        assert p.counts_by_type == { 'topic' : 1 }
+        assert p.new_paper(None, 'Marr')['id'] == 'paper-1'
+
+        # changes to existing nodes are undone
+        reading_list = p.new_reading_list(None, 'To read')
+        with pytest.raises(PaperError):
+            with p.batch():
+                p.add_to_reading_list(reading_list, 'paper-1')
+                raise PaperError("Abort")
+        assert p[reading_list['id']]['artifacts'] == []
+
+    def test_batch_move(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            yaml_file = os.path.join(data_folder, 'paper-model.yaml')
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            original = os.path.join(data_folder, 'a.txt')
+            with open(original, 'w') as f:
+                f.write("Contents of a")
+            os.chmod(original, 0o644)
+            p = PaperRepo(yaml_file, file_folder=file_folder, auto_save=True)
+
+            # moved files are only deleted once the batch succeeds, and keep their permissions until then
+            with pytest.raises(PaperError):
+                with p.batch():
+                    p.register_file(original, strategy='move')
+                    assert os.path.exists(original)
+                    raise PaperError("Abort")
+            assert os.path.exists(original)
+            assert os.stat(original).st_mode & 0o777 == 0o644
+            assert not p.hashes
+
+            with p.batch():
+                new_file = p.register_file(original, strategy='move')
+                assert os.stat(original).st_mode & 0o777 == 0o644
+            assert not os.path.exists(original)
+            path = p.file_repo.get_absolute_path_to_file(new_file['id'])
+            assert os.stat(path).st_mode & 0o777 == 0o444
+
+    def test_batch_killed(self):
+        # a process dying in a batch leaves the stored files as orphans and the original files in place
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            yaml_file = os.path.join(data_folder, 'paper-model.yaml')
+            file_folder = os.path.join(data_folder, 'files')
+            inbox = os.path.join(data_folder, 'inbox')
+            os.mkdir(file_folder)
+            os.mkdir(inbox)
+            original = os.path.join(inbox, 'a.txt')
+            with open(original, 'w') as f:
+                f.write("Contents of a")
+            script = os.path.join(data_folder, 'script.py')
+            with open(script, 'w') as f:
+                f.write("import os, sys\n"
+                        "sys.path.insert(0, {!r})\n"
+                        "from paperapp.paper_repo import PaperRepo\n"
+                        "p = PaperRepo({!r}, file_folder={!r}, auto_save=True)\n"
+                        "with p.batch():\n"
+                        "    p.process_files([ {!r} ])\n"
+                        "    os._exit(1)\n".format(
+                            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), yaml_file, file_folder,
+                            original))
+            result = subprocess.run([ sys.executable, script ], capture_output=True, text=True, timeout=60)
+            assert result.returncode == 1, result.stderr
+            assert os.path.exists(original)
+
+            p = PaperRepo(yaml_file, file_folder=file_folder, auto_save=True)
+            assert len(p.get_nodes_by_type('file')) == 0
+            stored = os.path.join('0', '0', '0', '0')
+            assert os.path.exists(os.path.join(file_folder, stored))
+            assert p.fsck()['orphan'] == [ stored ]
+            assert p.file_repo.fsck()['orphan'] == [ stored ]
+
+            # ingesting again replaces the orphan
+            new_file = p.process_files([ original ])[0]
+            assert not os.path.exists(original)
+            assert p.fsck() == { 'missing' : [], 'corrupt' : [], 'orphan' : [], 'checked' : 1, 'skipped' : 0 }
+            with open(p.file_repo.get_absolute_path_to_file(new_file['id'])) as f:
+                assert f.read() == "Contents of a"
+
+    def test_fsck(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            yaml_file = os.path.join(data_folder, 'paper-model.yaml')
+            file_folder = os.path.join(data_folder, 'files')
+            os.mkdir(file_folder)
+            with open(os.path.join(data_folder, 'a.txt'), 'w') as f:
+                f.write("Contents of a")
+            p = PaperRepo(yaml_file, file_folder=file_folder, auto_save=True)
+            new_file = p.register_file(os.path.join(data_folder, 'a.txt'))
+            md5hash = new_file['md5hash']
+            assert p.fsck() == { 'missing' : [], 'corrupt' : [], 'orphan' : [], 'checked' : 1, 'skipped' : 0 }
+            assert p.fsck(quick=True)['skipped'] == 1
+
+            # a file stored but not added to the model is an orphan, even if in the manifest
+            with open(os.path.join(data_folder, 'b.txt'), 'w') as f:
+                f.write("Contents of b")
+            stray = p.file_repo.register_file(os.path.join(data_folder, 'b.txt'), dict(p.hashes))
+            assert stray['number'] in p.file_repo.manifest()
+            stray_path = os.path.relpath(p.file_repo.get_absolute_path_to_file(stray['id']), file_folder)
+            assert p.fsck()['orphan'] == [ stray_path ]
+            assert stray['number'] not in p.file_repo.manifest()
+            assert p.file_repo.fsck()['orphan'] == [ stray_path ]
+            os.unlink(p.file_repo.get_absolute_path_to_file(stray['id']))
+
+            # a file without hash in the model gets it from the manifest
+            del new_file['md5hash']
+            p.save(yaml_file)
+            p = PaperRepo(yaml_file, file_folder=file_folder, snapshot=False)
+            assert p[new_file['id']]['md5hash'] == md5hash
+            assert p.hashes == { md5hash : new_file['id'] }
+
+            os.unlink(p.file_repo.get_absolute_path_to_file(new_file['id']))
+            assert p.fsck()['missing'] == [ new_file['id'] ]
+
+    def test_topic_closure(self):
+        p = PaperRepo()
+        ml = p.new_topic(None, 'ML')
+        cv = p.new_topic(None, 'Vision', related_to=ml)
+        nlp = p.new_topic(None, 'NLP', related_to=ml)
+        mt = p.new_topic(None, 'Translation', related_to=[nlp, cv])
+        paper1 = p.new_paper(None, 'Hubel', related_to=cv)
+        paper2 = p.new_paper(None, 'Brown', related_to=mt)
+        assert p.topic_closure(ml) == ('topic-1', 'topic-2', 'topic-4', 'topic-3')
+        assert p.topic_closure('topic-3') == ('topic-3', 'topic-4')
+        assert set(n['id'] for n in p.get_nodes_on_topic(nlp)) == set([ 'topic-4', 'paper-2' ])
+        assert len(p.get_nodes_on_topic(ml)) == 5
+
+        # changing the hierarchy invalidates the cache
+        speech = p.new_topic(None, 'Speech', related_to=nlp)
+        assert p.topic_closure(nlp) == ('topic-3', 'topic-4', 'topic-5')
+        p._delete_node(mt)
+        assert p.topic_closure(ml) == ('topic-1', 'topic-2', 'topic-3', 'topic-5')
+        assert p.get_nodes_on_topic(nlp) == [ speech ]
+
+    def test_versionhash(self):
+        p = PaperRepo()
+        topic = p.new_topic(None, 'Vision')
+        paper = p.new_paper(None, 'ab', related_to=topic)
+        root = p.versionhash()
+        topic_digest = p.node_digest(topic)
+
+        paper['text'] = 'ba' # same characters
+        p.touch(paper)
+        assert p.versionhash() != root
+        assert p.node_digest(topic) == topic_digest
+
+        paper['text'] = 'ab'
+        p.touch(paper)
+        assert p.versionhash() == root
+        assert p.verify() == root
+
+        p._delete_node(paper)
+        assert p.versionhash() != root
+
     #TODO: test that functionality behaves well when a single object are multiple objects
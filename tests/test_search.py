@@ -1,10 +1,23 @@
 import pytest
+import asyncio
 import tempfile
+import shutil
+import subprocess
+import sys
+import time
 import os.path
 
 from paperapp              import PaperError
 from paperapp.paper_repo   import PaperRepo
 from paperapp.paper_bibtex import import_bibtex, import_bibtex_str
+from paperapp.search_index import SearchIndex, extract_text, extract_texts, extraction_pool, extractor_key, throughput
+from paperapp import search_index
+
+
+def _run_program(marker):
+    # waits for the program without stopping it if interrupted, as some extractors do
+    subprocess.Popen([ 'sh', '-c', 'sleep 1; touch ' + marker ]).wait()
+
 
 
 class TestSearch:
@@ -97,3 +110,272 @@ Sharing my personal story
             results = p.search("generation AND NOT statistical")
             assert len(results) == 8
             assert results[0]['paper']['text'] == 'On The Feasibility of Open Domain Referring Expression Generation Using Large Scale Folksonomies -- Pacheco, Fabian  and  Duboue, Pablo  and  Dominguez, Martin'
+
+    def test_process_folder_parallel(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            p = PaperRepo(data_folder=data_folder, auto_save=True)
+            drop_folder = os.path.join(data_folder, 'drop')
+            os.mkdir(drop_folder)
+            for name, text in [ ('a.txt', 'feature engineering'), ('b.txt', 'question answering'),
+                                ('c.txt', 'feature engineering'), ('d.txt', 'referring expressions') ]:
+                with open(os.path.join(drop_folder, name), 'w') as f:
+                    f.write(text)
+
+            nodes = p.process_folder(drop_folder, jobs=2)
+            assert len(nodes) == 4
+            assert len(set(node['id'] for node in nodes)) == 3 # a duplicate
+            assert os.listdir(drop_folder) == []
+            assert [ f for f in os.listdir(p.file_repo.file_folder) if f.startswith('.incoming') ] == []
+            assert len(p.search("engineering")) == 1
+            for node in nodes:
+                if node['text'] == 'b.txt':
+                    assert p.text(node['id']) == 'question answering'
+            assert PaperRepo(data_folder=data_folder).counts_by_type['file'] == 3
+
+    def test_async(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            p = PaperRepo(data_folder=data_folder, auto_save=True)
+            paths = []
+            for name, text in [ ('a.txt', 'feature engineering'), ('b.txt', 'question answering'),
+                                ('c.txt', 'feature engineering') ]:
+                paths.append(os.path.join(data_folder, name))
+                with open(paths[-1], 'w') as f:
+                    f.write(text)
+
+            async def register():
+                return await asyncio.gather(*[ p.aregister_file(path) for path in paths ], return_exceptions=True)
+
+            results = asyncio.run(register())
+            nodes = [ result for result in results if type(result) is dict ]
+            assert len(nodes) == 2
+            assert [ type(result) for result in results if type(result) is not dict ] == [ PaperError ]
+            assert [ f for f in os.listdir(p.file_repo.file_folder) if f.startswith('.incoming') ] == []
+            assert len(asyncio.run(p.asearch("engineering"))) == 1
+            for node in nodes:
+                assert len(asyncio.run(p.asimilarto(node['id']))) <= 1
+
+            drop_folder = os.path.join(data_folder, 'drop')
+            os.mkdir(drop_folder)
+            with open(os.path.join(drop_folder, 'd.txt'), 'w') as f:
+                f.write('referring expressions')
+            assert len(asyncio.run(p.aprocess_folder(drop_folder))) == 1
+            assert len(asyncio.run(p.asearch("referring"))) == 1
+            assert PaperRepo(data_folder=data_folder).counts_by_type['file'] == 3
+
+    def test_reindex_parallel(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            p = PaperRepo(data_folder=data_folder, auto_save=True)
+            texts = [ 'feature engineering', 'question answering', 'referring expressions', 'text planning' ]
+            for i, text in enumerate(texts):
+                path = os.path.join(data_folder, '%d.txt' % (i,))
+                with open(path, 'w') as f:
+                    f.write(text)
+                p.register_file(path)
+            ids = [ node['id'] for node in p.get_nodes_by_type('file') ]
+
+            for multisegment in [ False, True ]:
+                p.reindex(jobs=2, multisegment=multisegment)
+                assert p.search_index.size() == 4
+                assert sorted(p.search_index.list_files()) == sorted(ids)
+                assert len(p.search("answering")) == 1
+                for file_id, text in zip(ids, texts):
+                    assert p.text(file_id) == text
+
+    def test_text_cache(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            p = PaperRepo(data_folder=data_folder, auto_save=True)
+            path = os.path.join(data_folder, 'a.txt')
+            with open(path, 'w') as f:
+                f.write('feature engineering')
+            node = p.register_file(path)
+            key = extractor_key('text/plain')
+            cache = p.search_index.text_cache
+            assert cache.get(node['md5hash'], key) == 'feature engineering'
+            assert cache.get(node['md5hash'], 'text-0') is None
+
+            # reindexing takes the text from the cache
+            cache.put(node['md5hash'], key, 'cached engineering')
+            p.reindex(jobs=2)
+            assert p.text(node['id']) == 'cached engineering'
+            shutil.rmtree(os.path.join(data_folder, 'index'))
+            p = PaperRepo(data_folder=data_folder)
+            assert p.text(node['id']) == 'cached engineering'
+
+    def test_reconcile(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            p = PaperRepo(data_folder=data_folder, auto_save=True)
+            nodes = []
+            for i, text in enumerate([ 'feature engineering', 'question answering', 'text planning' ]):
+                path = os.path.join(data_folder, '%d.txt' % (i,))
+                with open(path, 'w') as f:
+                    f.write(text)
+                nodes.append(p.register_file(path))
+            paths = [ p.file_repo.get_absolute_path_to_file(node['id']) for node in nodes ]
+            assert p.reconcile_index() == { 'added' : 0, 'deleted' : 0, 'changed' : 0 }
+
+            p.search_index.delete(nodes[0]['id'])
+            p.search_index.index_content('file-99', paths[1], 'text/plain', md5hash='0' * 32)
+            p.search_index.update([ (nodes[2]['id'], paths[1], 'text/plain', '1' * 32) ], [ nodes[2]['id'] ])
+            assert p.search_index.size() == 3
+            assert p.reconcile_index() == { 'added' : 1, 'deleted' : 1, 'changed' : 1 }
+            assert sorted(p.search_index.indexed_files()) == sorted((node['id'], node['md5hash']) for node in nodes)
+            assert p.text(nodes[2]['id']) == 'text planning'
+
+            # files deleted while the texts are extracted are not indexed
+            p.search_index.delete(nodes[0]['id'])
+            p.search_index.delete(nodes[1]['id'])
+            calls = []
+            def all_files():
+                calls.append(len(calls))
+                return nodes if len(calls) == 1 else nodes[1:]
+            assert p.search_index.reconcile(all_files, p.file_repo, lock=p.lock) == { 'added' : 1, 'deleted' : 0, 'changed' : 0 }
+            assert len(calls) == 2
+            assert sorted(fileid for fileid, md5hash in p.search_index.indexed_files()) == [ nodes[1]['id'], nodes[2]['id'] ]
+            assert p.reconcile_index() == { 'added' : 1, 'deleted' : 0, 'changed' : 0 }
+
+            # out of sync when loading
+            p.search_index.delete(nodes[1]['id'])
+            p = PaperRepo(data_folder=data_folder, index_sync='later')
+            assert p.search_index.size() == 2
+            p = PaperRepo(data_folder=data_folder, index_sync='background')
+            p.index_thread.join()
+            assert p.search_index.size() == 3
+            p.search_index.delete(nodes[1]['id'])
+            p = PaperRepo(data_folder=data_folder)
+            assert p.search_index.size() == 3 and p.index_thread is None
+            assert p.search("answering")[0]['file']['id'] == nodes[1]['id']
+
+            # notes about texts that could not be extracted are indexed again
+            path = os.path.join(data_folder, 'a.bin')
+            with open(path, 'wb') as f:
+                f.write(bytes(range(256)))
+            node = p.register_file(path)
+            assert p.text(node['id']).startswith("Missing extractor")
+            assert (node['id'], SearchIndex.UNEXTRACTED) in p.search_index.indexed_files()
+            assert p.reconcile_index() == { 'added' : 0, 'deleted' : 0, 'changed' : 1 }
+
+    def test_reconcile_old_index(self):
+        from whoosh.fields import Schema, TEXT, ID
+        from whoosh.filedb.filestore import FileStorage
+
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            p = PaperRepo(data_folder=data_folder, auto_save=True)
+            path = os.path.join(data_folder, 'a.txt')
+            with open(path, 'w') as f:
+                f.write('feature engineering')
+            node = p.register_file(path)
+
+            # index without hashes, as made by earlier versions
+            shutil.rmtree(os.path.join(data_folder, 'index'))
+            os.mkdir(os.path.join(data_folder, 'index'))
+            index = FileStorage(os.path.join(data_folder, 'index')).create_index(
+                Schema(fileid=ID(stored=True), content=TEXT(stored=True)))
+            with index.writer() as writer:
+                writer.add_document(fileid=node['id'], content='feature engineering')
+            p = PaperRepo(data_folder=data_folder)
+            assert p.search_index.indexed_files() == [ (node['id'], None) ]
+            assert p.reconcile_index() == { 'added' : 0, 'deleted' : 0, 'changed' : 0 }
+            p.reindex()
+            assert p.search_index.indexed_files() == [ (node['id'], node['md5hash']) ]
+
+    def test_index_many(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            p = PaperRepo(data_folder=data_folder, auto_save=True)
+            paths = []
+            for i, text in enumerate([ 'feature engineering', 'question answering', 'text planning', 'parsing' ]):
+                paths.append(os.path.join(data_folder, '%d.txt' % (i,)))
+                with open(paths[-1], 'w') as f:
+                    f.write(text)
+            nodes = [ p.register_file(path) for path in paths[:3] ]
+            index = p.search_index
+
+            # a single commit for the whole block
+            generation = index.index.latest_generation()
+            with index.index_many():
+                index.delete(nodes[0]['id'])
+                index.index_content('file-98', paths[0], 'text/plain')
+                index.index_content('file-99', paths[1], 'text/plain', content='buffered text')
+                index.delete('file-98')
+            assert index.index.latest_generation() == generation + 1
+            assert sorted(index.list_files()) == sorted([ nodes[1]['id'], nodes[2]['id'], 'file-99' ])
+            assert index.text('file-99') == 'buffered text'
+            index.delete('file-99')
+
+            generation = index.index.latest_generation()
+            replacement = p.replace_file(nodes[1]['id'], paths[3])
+            assert index.index.latest_generation() == generation + 1
+            assert sorted(index.list_files()) == sorted([ nodes[2]['id'], replacement['id'] ])
+
+            index.MAX_SEGMENTS = 1
+            segments = index.segments()
+            assert index.optimize() == (segments > 1)
+            assert index.segments() == 1
+            assert not index.optimize()
+            assert len(p.search("parsing")) == 1
+
+    def test_extractors(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            html = os.path.join(data_folder, 'a.html')
+            with open(html, 'w') as f:
+                f.write("<html><head><style>p { color: red }</style></head><body><p>Hello <b>world</b></p></body></html>")
+            xml = os.path.join(data_folder, 'a.xml')
+            with open(xml, 'w') as f:
+                f.write("<doc><title>Parsing</title><body>text planning</body></doc>")
+            assert extract_text(html, 'text/html').strip() == "Hello world"
+            assert extract_text(xml, 'text/xml') == "Parsing\ntext planning"
+
+            pptx = pytest.importorskip('pptx')
+            presentation = pptx.Presentation()
+            slide = presentation.slides.add_slide(presentation.slide_layouts[1])
+            slide.shapes.title.text = "Question answering"
+            pptx_file = os.path.join(data_folder, 'a.pptx')
+            presentation.save(pptx_file)
+            mimetype = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+            assert "Question answering" in extract_text(pptx_file, mimetype)
+            assert extractor_key(mimetype).startswith('python-pptx-')
+
+            # parallel extraction counts the work of the workers
+            expected = [ extract_text(html, 'text/html'), extract_text(pptx_file, mimetype), extract_text(html, 'text/html') ]
+            before = throughput()['lxml-html']['files']
+            assert list(extract_texts([ html, pptx_file, html ], [ 'text/html', mimetype, 'text/html' ], jobs=2)) == expected
+            assert throughput()['lxml-html']['files'] == before + 2
+            assert extraction_pool(2) is extraction_pool(2)
+
+    def test_unguarded_script(self):
+        # scripts such as the ones code2py writes have no __main__ guard, they must not start workers
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            with open(os.path.join(data_folder, 'a.txt'), 'w') as f:
+                f.write('feature engineering')
+            script = os.path.join(data_folder, 'script.py')
+            with open(script, 'w') as f:
+                f.write("import sys\n"
+                        "sys.path.insert(0, {!r})\n"
+                        "from paperapp.paper_repo import PaperRepo\n"
+                        "print('started')\n"
+                        "p = PaperRepo(data_folder={!r})\n"
+                        "p.register_file({!r})\n"
+                        "print(p.search('engineering')[0]['file']['id'])\n".format(
+                            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), data_folder,
+                            os.path.join(data_folder, 'a.txt')))
+            result = subprocess.run([ sys.executable, script ], capture_output=True, text=True, timeout=60)
+            assert result.returncode == 0, result.stderr
+            assert result.stdout == "started\nfile-0\n"
+
+    def test_extractor_timeout(self):
+        with tempfile.TemporaryDirectory("pytest") as data_folder:
+            path = os.path.join(data_folder, 'a.txt')
+            with open(path, 'w') as f:
+                f.write('feature engineering')
+            assert extract_text(path, 'text/plain') == 'feature engineering'
+
+            # in the workers, an extractor that times out is stopped along with the programs it started
+            marker = os.path.join(data_folder, 'marker')
+            start = time.time()
+            with pytest.raises(search_index._Timeout):
+                extraction_pool().submit(search_index._with_timeout, 0.2, _run_program, marker).result()
+            assert time.time() - start < 1
+            time.sleep(1.5)
+            assert not os.path.exists(marker)
+
+            # no alarms in this process
+            assert search_index._with_timeout(0.2, time.sleep, 0.5) is None